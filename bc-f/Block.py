@@ -1,9 +1,28 @@
 from hashlib import sha256
 import json
+import struct
+
+import Merkle
+
+
+def nonce_hasher(prefix):
+    """
+    :param prefix: block JSON up to the nonce value, see `Block.hash_prefix`
+    """
+    midstate = sha256(prefix.encode())
+
+    def hash_with_nonce(nonce):
+        h = midstate.copy()
+        h.update(b"%d}" % nonce)
+        return h.hexdigest()
+    return hash_with_nonce
 
 
 class Block:
-    def __init__(self, index, info, timestamp, previous_hash, previous_idx_hash=0):
+    __slots__ = ("__index", "__info", "__timestamp", "__previous_hash",
+                 "__nonce", "__previous_idx_hash", "__target", "__hash", "__sealed")
+
+    def __init__(self, index, info, timestamp, previous_hash, previous_idx_hash=0, target=None):
         """
         Constructor for the `Block` class.
         :param index:         Unique ID of the block.
@@ -11,23 +30,95 @@ class Block:
         :param timestamp:     Time of generation of the block.
         :param previous_hash: Hash of the previous block in the chain which this block is part of.
         :param previous_idx_hash: Hash of the index file (latest version)
+        :param target: proof-of-work target (see Difficulty.py), None for
+                       blocks from before targets were recorded
         """
         self.__index = index
         self.__info = info
         self.__timestamp = timestamp
         self.__previous_hash = previous_hash  # Adding the previous hash field
-        self.nonce = 0
+        self.__nonce = 0
         self.__previous_idx_hash = previous_idx_hash
+        self.__target = target
+        self.__hash = None
+        self.__sealed = False
+
+    def to_dict(self):
+        """
+        JSON form of the block, used both on the wire and as the
+        preimage of its hash. The target is left out of blocks without
+        one, so their hash is unchanged.
+        """
+        block_data = {"_Block__index": self.__index,
+                      "_Block__info": self.__info,
+                      "_Block__timestamp": self.__timestamp,
+                      "_Block__previous_hash": self.__previous_hash,
+                      "_Block__previous_idx_hash": self.__previous_idx_hash,
+                      "nonce": self.__nonce}
+        if self.__target is not None:
+            block_data["_Block__target"] = "%064x" % self.__target
+        return block_data
 
     def compute_hash(self):
         """
         Returns the hash of the block instance by first converting it
         into JSON string.
         """
-        block_string = json.dumps(self.__dict__, sort_keys=True)
+        block_string = json.dumps(self.to_dict(), sort_keys=True)
         # The string equivalent also considers the previous_hash field now
         return sha256(block_string.encode()).hexdigest()
 
+    @property
+    def hash(self):
+        """
+        Memoized `compute_hash`. Reset whenever the nonce or the
+        previous_idx_hash of an unsealed block changes.
+        """
+        if self.__hash is None:
+            self.__hash = self.compute_hash()
+        return self.__hash
+
+    def remember_hash(self, block_hash):
+        """
+        Stores a hash already computed for the current fields,
+        e.g. the one found by proof of work.
+        """
+        self.__hash = block_hash
+
+    def seal(self):
+        """
+        Called once the block is part of a chain; from then on its
+        fields cannot change and its hash is never recomputed.
+        """
+        self.__sealed = True
+
+    @property
+    def sealed(self):
+        return self.__sealed
+
+    def _modify(self):
+        if self.__sealed:
+            raise AttributeError("A sealed block cannot be modified")
+        self.__hash = None
+
+    def hash_prefix(self):
+        """
+        Returns the JSON string of the block up to its nonce value.
+        `nonce` sorts after every `_Block__*` field, so the JSON used by
+        `compute_hash` is always this prefix + str(nonce) + "}".
+        """
+        fields = self.to_dict()
+        del fields["nonce"]
+        return json.dumps(fields, sort_keys=True)[:-1] + ', "nonce": '
+
+    def nonce_hasher(self):
+        """
+        Returns a function nonce -> hash which gives the same result as
+        `compute_hash` with that nonce set, but only hashes the nonce
+        on top of a sha256 midstate of `hash_prefix`.
+        """
+        return nonce_hasher(self.hash_prefix())
+
     @property
     def info(self):
         return self.__info
@@ -40,10 +131,233 @@ class Block:
     def index(self):
         return self.__index
 
+    @property
+    def timestamp(self):
+        return self.__timestamp
+
+    @property
+    def nonce(self):
+        return self.__nonce
+
+    @nonce.setter
+    def nonce(self, nonce):
+        self._modify()
+        self.__nonce = nonce
+
+    @property
+    def target(self):
+        return self.__target
+
     @property
     def previous_idx_hash(self):
         return self.__previous_idx_hash
 
     @previous_idx_hash.setter
     def previous_idx_hash(self, previous_idx_hash):
+        self._modify()
         self.__previous_idx_hash = previous_idx_hash
+
+
+class MerkleBlock(Block):
+    """
+    Block that commits to the Merkle root of its `info` entries.
+    Its hash covers a small fixed-size header instead of the whole
+    `info` list, and single entries can be proven with `proof`.
+    """
+    __slots__ = ("merkle_root",)
+
+    def __init__(self, index, info, timestamp, previous_hash, previous_idx_hash=0, target=None):
+        super().__init__(index, info, timestamp, previous_hash, previous_idx_hash, target)
+        self.merkle_root = Merkle.merkle_root(self.leaves())
+
+    def leaves(self):
+        return [Merkle.leaf_hash(inf) for inf in self.info]
+
+    def to_dict(self):
+        block_data = super().to_dict()
+        block_data["merkle_root"] = self.merkle_root
+        return block_data
+
+    def header(self):
+        header = {"index": self.index,
+                  "merkle_root": self.merkle_root,
+                  "previous_hash": self.previous_hash,
+                  "previous_idx_hash": self.previous_idx_hash,
+                  "timestamp": self.timestamp}
+        if self.target is not None:
+            header["target"] = "%064x" % self.target
+        return header
+
+    def hash_prefix(self):
+        return json.dumps(self.header(), sort_keys=True)[:-1] + ', "nonce": '
+
+    def compute_hash(self):
+        """
+        Returns the hash of the block header (which includes the nonce).
+        """
+        block_string = "{}{}}}".format(self.hash_prefix(), self.nonce)
+        return sha256(block_string.encode()).hexdigest()
+
+    def proof(self, tx_index=None, tx_hash=None):
+        """
+        Returns (leaf hash, inclusion proof) of one `info` entry,
+        selected by its position or its leaf hash.
+        """
+        leaves = self.leaves()
+        if tx_index is None:
+            tx_index = leaves.index(tx_hash)
+        return leaves[tx_index], Merkle.merkle_proof(leaves, tx_index)
+
+
+BLOCK_FORMATS = {"legacy": Block, "merkle": MerkleBlock}
+
+
+def block_from_dict(block_data):
+    """
+    Rebuilds a block from its JSON form (see `Block.to_dict`).
+    """
+    block_class = MerkleBlock if "merkle_root" in block_data else Block
+    block = block_class(block_data["_Block__index"],
+                        block_data["_Block__info"],
+                        block_data["_Block__timestamp"],
+                        block_data["_Block__previous_hash"],
+                        block_data.get("_Block__previous_idx_hash", 0),
+                        int(block_data["_Block__target"], 16) if "_Block__target" in block_data else None)
+    block.nonce = block_data["nonce"]
+    return block
+
+
+# Binary encoding of blocks:
+#   version (B), flags (B), index (Q), timestamp (d), nonce (Q),
+#   [target (32 bytes), version 2 only]
+#   previous_hash, previous_idx_hash, info (u32 length + JSON)
+# Hash fields holding a sha256 hex digest take 32 raw bytes,
+# anything else (e.g. the genesis "0") is stored as JSON.
+# Blocks without a target are written as version 1, which older
+# nodes can read.
+# The encoding is lossless, so a block decodes to the same hash: if the
+# timestamp is not a float (e.g. an integer received as JSON), or index,
+# nonce or target do not fit their fields, the _JSON_HEADER flag is set,
+# the fixed fields are zero and [index, timestamp, nonce, target] follow
+# the header as JSON.
+BINARY_MIMETYPE = "application/x-bc-block"
+_VERSION = 1
+_TARGET_VERSION = 2
+_MERKLE = 0x01
+_JSON_HEADER = 0x02
+_HEADER = struct.Struct(">BBQdQ")
+_LENGTH = struct.Struct(">I")
+_DIGEST, _JSON = 0, 1
+_MAX_U64 = 2 ** 64
+
+
+def _fits_header(block):
+    return (type(block.index) is int and 0 <= block.index < _MAX_U64 and
+            type(block.timestamp) is float and
+            type(block.nonce) is int and 0 <= block.nonce < _MAX_U64 and
+            (block.target is None or (type(block.target) is int and 0 <= block.target < 2 ** 256)))
+
+
+def _encode_hash_field(value):
+    if isinstance(value, str) and len(value) == 64:
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            pass
+        else:
+            if digest.hex() == value:
+                return bytes([_DIGEST]) + digest
+    return _encode_json(value)
+
+
+def _encode_json(value):
+    data = json.dumps(value).encode()
+    return bytes([_JSON]) + _LENGTH.pack(len(data)) + data
+
+
+def _decode_hash_field(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == _DIGEST:
+        return bytes(data[offset:offset + 32]).hex(), offset + 32
+    length, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    return json.loads(bytes(data[offset:offset + length])), offset + length
+
+
+def encode_block(block):
+    flags = _MERKLE if isinstance(block, MerkleBlock) else 0
+    info = json.dumps(block.info, separators=(",", ":")).encode()
+    if not _fits_header(block):
+        header = (_HEADER.pack(_VERSION, flags | _JSON_HEADER, 0, 0.0, 0) +
+                  _encode_json([block.index, block.timestamp, block.nonce, block.target]))
+    elif block.target is None:
+        header = _HEADER.pack(_VERSION, flags, block.index, block.timestamp, block.nonce)
+    else:
+        header = (_HEADER.pack(_TARGET_VERSION, flags, block.index, block.timestamp, block.nonce) +
+                  block.target.to_bytes(32, "big"))
+    return b"".join([header,
+                     _encode_hash_field(block.previous_hash),
+                     _encode_hash_field(block.previous_idx_hash),
+                     _LENGTH.pack(len(info)), info])
+
+
+def decode_block(data):
+    """
+    raises: ValueError if `data` is not an encoded block
+    """
+    try:
+        return _decode_block(data)
+    except (struct.error, IndexError, TypeError) as e:
+        raise ValueError("Invalid encoded block: {}".format(e)) from e
+
+
+def _decode_block(data):
+    version, flags, index, timestamp, nonce = _HEADER.unpack_from(data)
+    if version not in (_VERSION, _TARGET_VERSION):
+        raise ValueError("Unknown block encoding version {}".format(version))
+    offset = _HEADER.size
+    target = None
+    if version == _TARGET_VERSION:
+        if offset + 32 > len(data):
+            raise ValueError("Truncated block target")
+        target = int.from_bytes(data[offset:offset + 32], "big")
+        offset += 32
+    if flags & _JSON_HEADER:
+        fields, offset = _decode_hash_field(data, offset)
+        if not isinstance(fields, list) or len(fields) != 4:
+            raise ValueError("Invalid block header fields")
+        index, timestamp, nonce, target = fields
+    previous_hash, offset = _decode_hash_field(data, offset)
+    previous_idx_hash, offset = _decode_hash_field(data, offset)
+    length, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    if offset + length != len(data):
+        raise ValueError("Block info does not match its length")
+    info = json.loads(bytes(data[offset:offset + length]))
+
+    block_class = MerkleBlock if flags & _MERKLE else Block
+    block = block_class(index, info, timestamp, previous_hash, previous_idx_hash, target)
+    block.nonce = nonce
+    return block
+
+
+def encode_chain(blocks):
+    """
+    Length-prefixed sequence of encoded blocks.
+    """
+    parts = []
+    for block in blocks:
+        data = encode_block(block)
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_chain(data):
+    offset = 0
+    while offset < len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        yield decode_block(memoryview(data)[offset:offset + length])
+        offset += length
@@ -0,0 +1,231 @@
+"""
+Append-only, on-disk block store used behind `Blockchain.chain`.
+
+<folder>/blocks-<n>.seg   segment files, a record per sealed block:
+                          [length u32][crc32 u32][hash 32B][encoded block]
+                          (length and crc32 cover hash + encoded block)
+<folder>/offsets.idx      one entry per height: [segment u32][offset u64]
+
+Blocks are written once, segments are read through `mmap`, and the
+offset index gives O(1) lookup by height. On open, a torn or corrupt
+tail (e.g. after a crash mid-append) is cut off, so the store always
+ends with the last fully written block.
+
+Reads may run in request threads while a block is appended or the tail
+is cut: a lock is held while a record is copied out of its map and
+while maps are replaced or the files change.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from Block import decode_block, encode_block
+import config
+
+_RECORD = struct.Struct(">II")
+_OFFSET = struct.Struct(">IQ")
+_HASH_SIZE = 32
+
+
+class BlockStore:
+    """
+    :param folder: directory holding the segment and index files
+    :param segment_size: a new segment is started past this many bytes
+    :param fsync: flush every append to disk before it is indexed
+    """
+
+    def __init__(self, folder, segment_size=None, fsync=None):
+        self.folder = folder
+        self.segment_size = segment_size or config.BLOCK_SEGMENT_SIZE
+        self.fsync = config.BLOCK_STORE_FSYNC if fsync is None else fsync
+        os.makedirs(folder, exist_ok=True)
+
+        self.__offsets = []
+        self.__maps = {}
+        # (height, block) of the last block read or appended, and the
+        # number of truncations, so a read from before one is not cached
+        self.__tip = None
+        self.__truncations = 0
+        self.__lock = threading.Lock()
+        self.__index_path = os.path.join(folder, "offsets.idx")
+        self.__recover()
+        self.__index_file = open(self.__index_path, "ab")
+        self.__segment, self.__segment_file = None, None
+        self.__open_segment(self.__offsets[-1][0] if self.__offsets else 0)
+
+    def __segment_path(self, segment):
+        return os.path.join(self.folder, "blocks-{:06d}.seg".format(segment))
+
+    def __open_segment(self, segment):
+        if self.__segment_file is not None:
+            self.__segment_file.close()
+        self.__segment = segment
+        self.__segment_file = open(self.__segment_path(segment), "ab")
+
+    def __read_record(self, data, offset):
+        """
+        Returns (hash, encoded block, end offset) of the record at
+        `offset`, or None if it is incomplete or fails its checksum.
+        """
+        if offset + _RECORD.size > len(data):
+            return None
+        length, crc = _RECORD.unpack_from(data, offset)
+        start, end = offset + _RECORD.size, offset + _RECORD.size + length
+        if length < _HASH_SIZE or end > len(data):
+            return None
+        payload = data[start:end]
+        if zlib.crc32(payload) != crc:
+            return None
+        return bytes(payload[:_HASH_SIZE]).hex(), payload[_HASH_SIZE:], end
+
+    def __recover(self):
+        """
+        Loads the offset index, dropping entries whose record is torn,
+        and cuts segment bytes written after the last indexed record.
+        """
+        if os.path.exists(self.__index_path):
+            with open(self.__index_path, "rb") as f:
+                raw = f.read()
+            usable = len(raw) - len(raw) % _OFFSET.size
+            self.__offsets = [_OFFSET.unpack_from(raw, i) for i in range(0, usable, _OFFSET.size)]
+
+        end = 0
+        while self.__offsets:
+            segment, offset = self.__offsets[-1]
+            path = self.__segment_path(segment)
+            data = open(path, "rb").read() if os.path.exists(path) else b""
+            record = self.__read_record(data, offset)
+            if record is not None:
+                end = record[2]
+                break
+            self.__offsets.pop()
+
+        with open(self.__index_path, "wb") as f:
+            f.write(b"".join(_OFFSET.pack(*entry) for entry in self.__offsets))
+
+        last_segment = self.__offsets[-1][0] if self.__offsets else 0
+        for segment in range(last_segment, last_segment + 2):
+            path = self.__segment_path(segment)
+            if os.path.exists(path):
+                with open(path, "r+b") as f:
+                    f.truncate(end if segment == last_segment else 0)
+
+    def __mapped(self, segment, needed):
+        """
+        Map of `segment` covering `needed` bytes; call with the lock held.
+        """
+        data = self.__maps.get(segment)
+        if data is None or len(data) < needed:
+            if data is not None:
+                data.close()
+            with open(self.__segment_path(segment), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__maps[segment] = data
+        return data
+
+    def __load(self, height):
+        with self.__lock:
+            if height >= len(self.__offsets):
+                # Cut off since the caller checked the height
+                raise IndexError("block height out of range")
+            segment, offset = self.__offsets[height]
+            data = self.__mapped(segment, offset + _RECORD.size)
+            length, _ = _RECORD.unpack_from(data, offset)
+            data = self.__mapped(segment, offset + _RECORD.size + length)
+            # Slicing the map copies the record out of it
+            block_hash, encoded, _ = self.__read_record(data, offset)
+            truncations = self.__truncations
+        block = decode_block(encoded)
+        block.remember_hash(block_hash)
+        block.seal()
+        with self.__lock:
+            if truncations == self.__truncations and height == len(self.__offsets) - 1:
+                self.__tip = (height, block)
+        return block
+
+    def __len__(self):
+        return len(self.__offsets)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[i] for i in range(*height.indices(len(self)))]
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError("block height out of range")
+        tip = self.__tip
+        if tip is not None and tip[0] == height:
+            return tip[1]
+        return self.__load(height)
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def __delitem__(self, heights):
+        """
+        Only dropping the tail is supported: del store[height:]
+        """
+        if not isinstance(heights, slice) or heights.stop is not None or heights.step is not None:
+            raise TypeError("BlockStore only supports del store[height:]")
+        self.truncate(heights.start or 0)
+
+    def truncate(self, height):
+        """
+        Drops the blocks at `height` and above. The index is cut first,
+        so a crash in between leaves only unindexed bytes behind, which
+        the next open removes.
+        """
+        with self.__lock:
+            if height >= len(self.__offsets):
+                return
+            segment, offset = self.__offsets[height]
+            del self.__offsets[height:]
+            self.__tip = None
+            self.__truncations += 1
+            self.__index_file.truncate(height * _OFFSET.size)
+            self.__flush(self.__index_file)
+
+            # No reader is inside a map while the lock is held
+            for mapped_segment in [s for s in self.__maps if s >= segment]:
+                self.__maps.pop(mapped_segment).close()
+            later = segment + 1
+            while os.path.exists(self.__segment_path(later)):
+                os.remove(self.__segment_path(later))
+                later += 1
+            os.truncate(self.__segment_path(segment), offset)
+            self.__open_segment(segment)
+
+    def append(self, block):
+        payload = bytes.fromhex(block.hash) + encode_block(block)
+        record = _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self.__lock:
+            offset = self.__segment_file.tell()
+            if offset and offset + len(record) > self.segment_size:
+                self.__open_segment(self.__segment + 1)
+                offset = 0
+            self.__segment_file.write(record)
+            self.__flush(self.__segment_file)
+
+            entry = (self.__segment, offset)
+            self.__index_file.write(_OFFSET.pack(*entry))
+            self.__flush(self.__index_file)
+            self.__offsets.append(entry)
+            self.__tip = (len(self.__offsets) - 1, block)
+
+    def __flush(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def close(self):
+        with self.__lock:
+            for data in self.__maps.values():
+                data.close()
+            self.__maps.clear()
+            self.__segment_file.close()
+            self.__index_file.close()
@@ -1,41 +1,118 @@
 import collections
-import hashlib
-import json
+import math
 import os
-import pickle
+import threading
 
-from Block import Block
+from Block import Block, BLOCK_FORMATS
 import config
+import Difficulty
+import IndexCommitment
+import IndexStore
+from Mempool import Mempool, MempoolFull
+from Merkle import leaf_hash
+import Miner
+import Validator
 import time
 
 
+def target_history(chain, height):
+    """
+    (timestamp, target) of the blocks a TargetSchedule needs to tell
+    the target at `height`.
+    """
+    start = max(0, height - Difficulty.history_length())
+    return [(block.timestamp, block.target) for block in chain[start:height]]
+
+
 class Blockchain:
     """
     :param op: default path of index file (specified in config.py)
     """
-    difficulty = 2
     op = None
+    # Trusted (height, hash): the proofs of work up to it are not
+    # re-checked and those blocks cannot be replaced by a sync
+    checkpoint = None
 
-    def __init__(self):
+    def __init__(self, miner=None, block_format=None, store=None):
         """
         Constructor for the `Blockchain` class.
         :param bc_idx[]: index of current blockchain
+        :param miner: proof-of-work engine (see Miner.py), serial by default
+        :param block_format: "legacy" or "merkle" (see Block.py)
+        :param store: on-disk BlockStore holding the chain; kept in memory if None.
+                      A store which already has blocks is resumed as is.
         """
-        self.unconfirmed_info = []
-        self.__chain = []
-        self.__create_genesis_block()
+        self.miner = miner or Miner.create()
+        self.block_class = BLOCK_FORMATS[block_format or config.BLOCK_FORMAT]
+        self.indexes = {}
+        self.unconfirmed_info = Mempool()
+        # Held while the chain changes; mining only takes it to append
+        self.lock = threading.RLock()
+        self.__chain = [] if store is None else store
+        # Cumulative work of the chain, summed up on first use
+        self.__work = None
+        if not self.__chain:
+            self.__create_genesis_block()
+        self.__schedule = self.__target_schedule()
         self.__bc_idx = None
+        self.__idx_mutations = []
+        self.__idx_commitment = None
+        self.__saved_idx_commitment = None
+        # Inverses of the bc_idx changes of each entry (by leaf hash), kept
+        # while it is pending and for REORG_UNDO_BLOCKS blocks once sealed:
+        # (height, leaf hashes) of those blocks
+        self.__idx_undo = {}
+        self.__idx_undo_sealed = collections.deque()
+        self.index_store = None
+        self.__restored = None
 
     def __create_genesis_block(self):
         """
         A function to generate genesis block and appends it to
         the chain. The block has index 0, previous_hash as 0, and
-        a valid hash.
+        a valid hash. Its timestamp is fixed so that every node starts
+        from the same genesis block and chains can be synced between them.
         """
-        genesis_block = Block(0, [], time.time(), "0")
+        genesis_block = self.block_class(0, [], 0.0, "0")
         self.proof_of_work(genesis_block)
+        genesis_block.seal()
         self.__chain.append(genesis_block)
 
+    def __target_schedule(self):
+        """
+        TargetSchedule following the tip of the chain, see Difficulty.py.
+        """
+        return Difficulty.TargetSchedule(target_history(self.__chain, len(self.__chain)))
+
+    def next_target(self):
+        return self.__schedule.required(len(self.__chain))
+
+    def next_timestamp(self):
+        """
+        The current time, or just above the median time of the recent
+        blocks if the clock is behind it.
+        """
+        median = self.__schedule.median_time()
+        now = time.time()
+        return now if median is None or now > median else math.nextafter(median, math.inf)
+
+    @property
+    def work(self):
+        """
+        Cumulative proof of work of the chain, see Difficulty.py.
+        """
+        with self.lock:
+            if self.__work is None:
+                self.__work = Difficulty.chain_work(self.__chain)
+            return self.__work
+
+    def work_above(self, height):
+        """
+        Work of the blocks above `height`.
+        """
+        with self.lock:
+            return Difficulty.chain_work(self.__chain[height + 1:])
+
     @property
     def last_block(self) -> Block:
         """
@@ -67,65 +144,316 @@ class Blockchain:
         super(Blockchain, self).__setattr__(name, value)
         if name == 'op':
             if config.NFT_INDEX in value:
-                self.__bc_idx = collections.defaultdict(dict)
+                empty = collections.defaultdict(dict)
             elif config.TRANSACTION_INDEX in value:
-                self.__bc_idx = collections.defaultdict(list)
+                empty = collections.defaultdict(list)
             else:
                 raise IOError("config fail")
-            self.save_bc_index()
+            self.__idx_mutations = []
+            # Resume the saved index (see IndexStore.py)
+            self.index_store = IndexStore.create(value)
+            self.__bc_idx, state = self.index_store.open(empty)
+            self.__idx_commitment = IndexCommitment.IndexCommitment.from_state(state)
+            if self.__idx_commitment is None:
+                self.__idx_commitment = IndexCommitment.IndexCommitment(self.__bc_idx)
+            self.__saved_idx_commitment = self.__idx_commitment.hexdigest()
+            self.__replay_unsaved_index()
+
+    def __replay_unsaved_index(self):
+        """
+        Re-applies the index mutations of the restored snapshot which
+        were not saved yet (e.g. of the entries still pending), unless
+        the index was saved after the snapshot, which then holds them.
+        """
+        unsaved = (self.__restored or {}).get("bc_idx")
+        if unsaved is None or unsaved["commitment"] != self.__saved_idx_commitment:
+            return
+        for mutation in IndexStore.decode_mutations(unsaved["mutations"]):
+            self.__mutate_index(mutation)
 
     @property
     def bc_idx(self):
         return self.__bc_idx
 
+    def index_append(self, key, value, info=None):
+        """
+        :param info: the entry the change is made for; the change is
+                     undone if a reorg drops the entry for good
+        """
+        self.__mutate_index(("append", key, value), info)
+
+    def index_set(self, key, field, value, info=None):
+        self.__mutate_index(("set", key, field, value), info)
+
+    def index_delete(self, key, field, info=None):
+        """
+        Removes bc_idx[key][field] and returns its value.
+        """
+        with self.lock:
+            value = self.__bc_idx[key][field]
+            self.__mutate_index(("delete", key, field), info)
+        return value
+
+    def __mutate_index(self, mutation, info=None):
+        """
+        Applies a mutation to bc_idx and its commitment and keeps it
+        until the next save, see IndexStore.py.
+        """
+        with self.lock:
+            if info is not None:
+                self.__idx_undo.setdefault(leaf_hash(info), []).append(self.__inverse(mutation))
+            self.__idx_commitment.update(self.__bc_idx, mutation)
+            IndexStore.apply_mutation(self.__bc_idx, mutation)
+            self.__idx_mutations.append(mutation)
+
+    def __inverse(self, mutation):
+        """
+        The mutation which undoes `mutation`, before it is applied.
+        """
+        action, key = mutation[0], mutation[1]
+        if action == "append":
+            return "remove", key, mutation[2]
+        values = self.__bc_idx.get(key)
+        if values is not None and mutation[2] in values:
+            return "set", key, mutation[2], values[mutation[2]]
+        return "delete", key, mutation[2]
+
+    def __keep_undo(self, block):
+        """
+        Keeps the bc_idx inverses of the entries sealed in `block` for
+        REORG_UNDO_BLOCKS blocks.
+        """
+        keys = [key for key in map(leaf_hash, block.info) if key in self.__idx_undo]
+        if keys:
+            self.__idx_undo_sealed.append((block.index, keys))
+        while self.__idx_undo_sealed and \
+                self.__idx_undo_sealed[0][0] <= block.index - config.REORG_UNDO_BLOCKS:
+            for key in self.__idx_undo_sealed.popleft()[1]:
+                self.__idx_undo.pop(key, None)
+
+    def __undo_lost_entries(self, dropped, kept):
+        """
+        Undoes the bc_idx changes of the entries of `dropped` blocks
+        which are neither in the new blocks (leaf hashes `kept`) nor
+        back in unconfirmed_info (a full mempool), newest first, and
+        saves the index, so the next block commits to it. Entries which
+        went back to unconfirmed_info keep their changes, like any
+        pending entry.
+        """
+        undone = False
+        for info in reversed([info for block in dropped for info in block.info]):
+            key = leaf_hash(info)
+            if key in kept or info in self.unconfirmed_info or key not in self.__idx_undo:
+                continue
+            for mutation in reversed(self.__idx_undo.pop(key)):
+                self.__mutate_index(mutation)
+            undone = True
+        if undone:
+            self.save_bc_index()
+
     def save_bc_index(self):
         """
+        Persists the index mutations made since the last save.
         :param op: the index file name defined in config.py
         """
-        with open(self.op, "wb") as f:
-            pickle.dump(self.__bc_idx, f)
-        f.close()
+        with self.lock:
+            self.index_store.save(self.__bc_idx, self.__idx_mutations, self.__idx_commitment.state())
+            self.__idx_mutations = []
+            self.__saved_idx_commitment = self.__idx_commitment.hexdigest()
 
     def load_bc_index(self):
-        try:
-            f = open(self.op, "rb")
-        except OSError:
-            print("The index file of current blockchain does not exist")
-            return False
-        else:
-            previous_bc_idx = pickle.load(f)
-            f.close()
-        return previous_bc_idx
-
-    def compute_hash(self, data):
-        if isinstance(data, collections.defaultdict):
-            data = json.dumps(data, sort_keys=True)
-        if not isinstance(data, bytes):
-            data = data.encode('utf-8')
-        return hashlib.sha256(data).hexdigest()
+        return self.index_store.load()
 
     def compute_prev_index(self):
         """
-        returns: hash of latest saved index file
+        returns: commitment of the latest saved index (see IndexCommitment.py)
+        """
+        return self.__saved_idx_commitment
+
+    def replace_from(self, height, blocks):
+        """
+        Replaces the blocks above `height` with `blocks`, which must
+        continue the block at `height` and carry more work than the
+        blocks they replace. Entries
+        of dropped blocks that are not part of `blocks` go back to
+        unconfirmed_info; the bc_idx changes of those which do not fit
+        into it are undone.
+        Checked under the lock, as the chain may have moved since
+        `blocks` were validated (a mined block, another sync). If any
+        check fails, the chain is left as it was.
+        returns: False if `blocks` were not adopted
+        """
+        with self.lock:
+            if not blocks or not 0 <= height < len(self.__chain):
+                return False
+            if blocks[0].previous_hash != self.__chain[height].hash:
+                return False
+            if Difficulty.chain_work(blocks) <= self.work_above(height):
+                return False
+            if not self.__continues(height, blocks):
+                return False
+
+            dropped = self.__truncate(height)
+            if not all(self.add_block(block, block.hash) for block in blocks):
+                # Not expected after the checks above; put the old tail back
+                self.__truncate(height)
+                for block in dropped:
+                    self.add_block(block, block.hash)
+                return False
+
+            kept = {leaf_hash(info) for block in blocks for info in block.info}
+            try:
+                self.add_new_infos([info for block in dropped for info in block.info
+                                    if leaf_hash(info) not in kept])
+            except MempoolFull:
+                # Dropped like any submission to a full mempool
+                pass
+            if self.__idx_undo:
+                self.__undo_lost_entries(dropped, kept)
+            return True
+
+    def __continues(self, height, blocks):
+        """
+        Whether `blocks` would all pass `add_block` after the block at
+        `height`: linked, with valid proofs, the required targets and
+        acceptable timestamps.
+        """
+        schedule = Difficulty.TargetSchedule(target_history(self.__chain, height + 1))
+        previous_hash = self.__chain[height].hash
+        for next_height, block in enumerate(blocks, height + 1):
+            if block.previous_hash != previous_hash or not self.is_valid_proof(block, block.hash):
+                return False
+            if not schedule.accepts(next_height, block.target):
+                return False
+            if not schedule.accepts_timestamp(block.timestamp):
+                return False
+            schedule.append(block.timestamp, block.target)
+            previous_hash = block.hash
+        return True
+
+    def __truncate(self, height):
+        """
+        Drops the blocks above `height` and takes them out of the
+        derived state: the indexes undo them newest first (an index
+        without `remove_block` is rebuilt).
+        returns: the dropped blocks
         """
-        previous_bc_idx = self.load_bc_index()
-        return self.compute_hash(previous_bc_idx)
+        dropped = self.__chain[height + 1:]
+        if not dropped:
+            return dropped
+        if self.__work is not None:
+            self.__work -= Difficulty.chain_work(dropped)
+        rebuilt = []
+        for index in self.indexes.values():
+            if hasattr(index, "remove_block"):
+                for block in reversed(dropped):
+                    index.remove_block(block)
+            else:
+                rebuilt.append(index)
+        del self.__chain[height + 1:]
+        self.__schedule = self.__target_schedule()
+        # Their entries' inverses stay until they are sealed again or lost
+        while self.__idx_undo_sealed and self.__idx_undo_sealed[-1][0] > height:
+            self.__idx_undo_sealed.pop()
+        for index in rebuilt:
+            index.rebuild(self.__chain)
+            for info in self.unconfirmed_info:
+                index.apply_pending(info)
+        return dropped
+
+    def register_index(self, name, index):
+        """
+        Adds a derived index which follows the chain. An index has:
+        * rebuild(chain):    recompute from the sealed blocks
+        * apply_block(block): called when a block is sealed
+        * apply_pending(info): called when info enters unconfirmed_info
+        and optionally:
+        * remove_block(block): undoes apply_block of the last block, when
+                             a reorg drops it; its entries then go back
+                             to unconfirmed_info through apply_pending.
+                             An index without it is rebuilt.
+        and, to be kept in snapshots (see Snapshot.py):
+        * state():           a copy of its data, as of the tip and the
+                             mempool, in JSON types (dicts, lists, str,
+                             numbers) or frozen parts (see Snapshot.py);
+                             serialized after the lock is released
+        * load_state(state): takes back the data of state() from JSON
+        An index in the restored snapshot only replays the blocks after it.
+        """
+        restored = self.__restored
+        if restored is not None and name in restored["indexes"] and hasattr(index, "load_state"):
+            index.load_state(restored["indexes"][name])
+            for block in self.__chain[restored["height"] + 1:]:
+                index.apply_block(block)
+        else:
+            index.rebuild(self.__chain)
+            for info in self.unconfirmed_info:
+                index.apply_pending(info)
+        self.indexes[name] = index
+
+    def snapshot(self):
+        """
+        The derived state of the chain: tip, the states of the indexes,
+        the mempool and the bc_idx mutations not saved yet. Taken under
+        `lock`, so the parts fit together; they are copies (or frozen,
+        see Snapshot.py), so it can be serialized without the lock.
+        """
+        with self.lock:
+            unsaved = None
+            if self.__bc_idx is not None:
+                unsaved = {"commitment": self.__saved_idx_commitment,
+                           "mutations": IndexStore.encode_mutations(self.__idx_mutations)}
+            return {"height": len(self.__chain) - 1,
+                    "hash": self.last_block.hash,
+                    "indexes": {name: index.state() for name, index in self.indexes.items()
+                                if hasattr(index, "state")},
+                    "mempool": self.unconfirmed_info.snapshot(),
+                    "bc_idx": unsaved}
+
+    def restore(self, snapshot):
+        """
+        Takes back the mempool of `snapshot` and keeps its index states
+        for `register_index` and its bc_idx mutations for when `op` is
+        set, so call it before both. Ignored (returns False) if the
+        chain no longer has the snapshot's tip.
+        """
+        height = snapshot["height"]
+        if not height < len(self.__chain) or self.__chain[height].hash != snapshot["hash"]:
+            return False
+        self.unconfirmed_info.add_batch(snapshot["mempool"])
+        for block in self.__chain[height + 1:]:
+            self.unconfirmed_info.remove(block.info)
+        self.__restored = snapshot
+        return True
 
     def add_new_info(self, info):
-        self.unconfirmed_info.append(info)
+        """
+        returns: False if the entry is already pending
+        raises: MempoolFull
+        """
+        return bool(self.add_new_infos([info]))
+
+    def add_new_infos(self, infos):
+        """
+        Admits all of `infos` to the mempool at once, or none of them.
+        returns: the entries admitted, without duplicates
+        raises: MempoolFull
+        """
+        with self.lock:
+            admitted = self.unconfirmed_info.add_batch(infos)
+            for info in admitted:
+                for index in self.indexes.values():
+                    index.apply_pending(info)
+        return admitted
 
     def proof_of_work(self, block):
         """
         Function that tries different values of the nonce to get a hash
-        that satisfies our difficulty criteria.
+        that meets the block's target.
+        The search itself is done by the chain's mining engine.
         """
-        block.nonce = 0
-
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
-
+        computed_hash = self.miner.search(block, Difficulty.block_target(block))
+        block.remember_hash(computed_hash)
         return computed_hash
 
     def mine(self):
@@ -133,35 +461,42 @@ class Blockchain:
         This function serves as an interface to add the pending
         transactions to the blockchain by adding them to the block
         and figuring out proof of work.
+        Entries added while the proof of work runs stay pending for
+        the next block. If the chain moved on meanwhile (a block from a
+        peer, a sync), the block is dropped and False is returned.
         """
-        if not self.unconfirmed_info:
+        pending = self.unconfirmed_info.snapshot()
+        if not pending:
             return False
 
         last_block = self.last_block
 
-        new_block = Block(index=last_block.index + 1,
-                          info=self.unconfirmed_info,
-                          timestamp=time.time(),
-                          previous_hash=last_block.compute_hash())
+        new_block = self.block_class(index=last_block.index + 1,
+                                     info=pending,
+                                     timestamp=self.next_timestamp(),
+                                     previous_hash=last_block.hash,
+                                     target=self.next_target())
         if self.bc_idx is not None:
             new_block.previous_idx_hash = self.compute_prev_index()
 
         proof = self.proof_of_work(new_block)
-        self.add_block(new_block, proof)
+        with self.lock:
+            if not self.add_block(new_block, proof):
+                return False
 
-        if self.bc_idx is not None:
-            self.add_bc_index(new_block)
+            if self.bc_idx is not None:
+                self.add_bc_index(new_block)
 
-        self.unconfirmed_info = []
+            self.unconfirmed_info.remove(pending)
         return new_block.index
 
     def is_valid_proof(self, block, block_hash):
         """
-        Check if block_hash is valid hash of block and satisfies
-        the difficulty criteria.
+        Check if block_hash is valid hash of block and meets
+        the block's target.
         """
-        return (block_hash.startswith('0' * Blockchain.difficulty) and
-                block_hash == block.compute_hash())
+        return (Difficulty.meets_target(block_hash, Difficulty.block_target(block)) and
+                block_hash == block.hash)
 
     def add_bc_index(self, block):
         previous_idx_hash = self.compute_prev_index()
@@ -176,32 +511,73 @@ class Blockchain:
         * Checking if the proof is valid.
         * The previous_hash referred in the block and the hash of
           a latest block in the chain match.
-        * The
+        * The block carries the target required at its height.
+        * Its timestamp is above the median time of the recent blocks
+          and not too far ahead of our clock.
         """
-        previous_hash = self.last_block.compute_hash()
-
-        if previous_hash != block.previous_hash:
-            return False
-
         if not self.is_valid_proof(block, proof):
             return False
 
-        # block.hash = proof
-        self.__chain.append(block)
+        with self.lock:
+            if self.last_block.hash != block.previous_hash:
+                return False
+            if not self.__schedule.accepts(len(self.__chain), block.target):
+                return False
+            if not self.__schedule.accepts_timestamp(block.timestamp):
+                return False
+
+            block.seal()
+            self.__chain.append(block)
+            if self.__work is not None:
+                self.__work += Difficulty.block_work(block.target)
+            self.__schedule.append(block.timestamp, block.target)
+            self.unconfirmed_info.remove(block.info)
+            for index in self.indexes.values():
+                index.apply_block(block)
+            if self.__idx_undo:
+                self.__keep_undo(block)
         return True
 
-    def check_chain_validity(self, chain):
-        is_valid = True
-        previous_hash = "0"
-        for block in chain:
-            block_hash = block.hash
-            delattr(block, "hash")
-            if not self.is_valid_proof(block, block_hash) or previous_hash != block.previous_hash:
-                is_valid = False
-                break
-            block.hash, previous_hash = block_hash, block_hash
+    def inclusion_proof(self, height, tx_index=None, tx_hash=None):
+        """
+        Returns the data a light client needs to check that one entry
+        is part of the block at `height`, or None if the block has no
+        Merkle root or the entry does not exist.
+        """
+        if not 0 <= height < len(self.__chain):
+            return None
+        block = self.__chain[height]
+        if not hasattr(block, "merkle_root"):
+            return None
+        try:
+            leaf, proof = block.proof(tx_index, tx_hash)
+        except (IndexError, ValueError):
+            return None
+        header = block.header()
+        header["nonce"] = block.nonce
+        return {"block_hash": block.hash,
+                "header": header,
+                "leaf": leaf,
+                "proof": proof}
+
+    def check_chain_validity(self, chain, checkpoint=None):
+        """
+        Validates a whole chain (blocks or their JSON form), hashing the
+        blocks in parallel, see Validator.py.
+        :param checkpoint: trusted (height, hash), defaults to the chain's
+        returns: ValidationReport, true if the chain is valid
+        """
         # TODO: verify index file
-        return is_valid
+        return Validator.validate_chain(chain, checkpoint=checkpoint or self.checkpoint)
 
-    def check_index_validity(self, block):
-        pass
+    def check_index_validity(self, block=None):
+        """
+        Recomputes the commitment of bc_idx from scratch and compares it
+        with the incrementally maintained one. If `block` is given, also
+        checks that it commits to the latest saved index.
+        """
+        if self.__bc_idx is None:
+            return True
+        if not IndexCommitment.verify(self.__bc_idx, self.__idx_commitment.hexdigest()):
+            return False
+        return block is None or block.previous_idx_hash == self.__saved_idx_commitment
@@ -0,0 +1,111 @@
+"""
+Content-addressed storage of NFT files.
+
+<folder>/chunks/<ab>/<sha256 of chunk>   fixed-size chunks of the files
+<folder>/manifests/<tokenId>.json        {"filename", "size", "chunk_size", "chunks"}
+
+An upload is read chunk by chunk: the whole-file hash (the tokenId) is
+updated incrementally and each chunk is written once under its own
+hash, so identical chunks are shared between NFTs and memory use
+stays at one chunk regardless of the file size.
+
+Files are written to a temporary file of their own and then renamed
+into place, so concurrent uploads of the same content do not write to
+the same file; the last rename wins, with identical content.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import config
+
+
+def _write_file(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ChunkStore:
+    def __init__(self, folder, chunk_size=None):
+        self.chunk_size = chunk_size or config.NFT_CHUNK_SIZE
+        self.chunk_folder = os.path.join(folder, "chunks")
+        self.manifest_folder = os.path.join(folder, "manifests")
+        os.makedirs(self.chunk_folder, exist_ok=True)
+        os.makedirs(self.manifest_folder, exist_ok=True)
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.chunk_folder, chunk_id[:2], chunk_id)
+
+    def manifest_path(self, tokenId):
+        return os.path.join(self.manifest_folder, tokenId + ".json")
+
+    def __read_chunk(self, stream):
+        """
+        Reads exactly `chunk_size` bytes unless the stream ends first,
+        so chunk boundaries (and hence dedup) do not depend on how
+        the stream splits its reads.
+        """
+        parts, missing = [], self.chunk_size
+        while missing:
+            data = stream.read(missing)
+            if not data:
+                break
+            parts.append(data)
+            missing -= len(data)
+        return b"".join(parts)
+
+    def __put_chunk(self, chunk_id, data):
+        path = self.chunk_path(chunk_id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_file(path, data)
+
+    def put_stream(self, stream, filename):
+        """
+        Stores the content of `stream`.
+        returns: (tokenId, manifest)
+        """
+        file_hash = hashlib.sha256()
+        chunks, size = [], 0
+        while True:
+            data = self.__read_chunk(stream)
+            if not data:
+                break
+            file_hash.update(data)
+            chunk_id = hashlib.sha256(data).hexdigest()
+            self.__put_chunk(chunk_id, data)
+            chunks.append(chunk_id)
+            size += len(data)
+
+        manifest = {"filename": filename,
+                    "size": size,
+                    "chunk_size": self.chunk_size,
+                    "chunks": chunks}
+        return file_hash.hexdigest(), manifest
+
+    def save_manifest(self, tokenId, manifest):
+        path = self.manifest_path(tokenId)
+        _write_file(path, json.dumps(manifest).encode())
+        return path
+
+    def load_manifest(self, tokenId):
+        with open(self.manifest_path(tokenId)) as f:
+            return json.load(f)
+
+    def read(self, tokenId):
+        """
+        Yields the content of an NFT file chunk by chunk.
+        """
+        for chunk_id in self.load_manifest(tokenId)["chunks"]:
+            with open(self.chunk_path(chunk_id), "rb") as f:
+                yield f.read()
@@ -0,0 +1,164 @@
+"""
+Proof-of-work targets and their retargeting.
+
+A block hash is valid if, read as a 256-bit number, it is at most the
+block's target. New blocks record their target (`Block.target`); the
+target required at a height follows from the blocks before it only:
+
+* every RETARGET_INTERVAL blocks, the target of the previous block is
+  scaled by (time the last RETARGET_INTERVAL blocks took) /
+  (the time they should have taken at BLOCK_INTERVAL seconds a block),
+  by at most a factor of MAX_RETARGET_FACTOR either way
+* otherwise it is the target of the previous block
+
+Blocks without a target (mined before targets were recorded, and the
+genesis block) are checked against the leading hex zeros of
+LEGACY_DIFFICULTY, which is also their target for retargeting. Once a
+chain has a block with a target, all later blocks need one.
+
+A block timestamp must be above the median timestamp of the last
+MEDIAN_TIME_BLOCKS blocks and at most MAX_FUTURE_DRIFT seconds ahead
+of the local clock, so a miner cannot skew retargets with made-up times.
+
+Chains are compared by their work: the expected number of hashes
+behind them, 2**256 / (target + 1) per block.
+"""
+
+from collections import deque
+import time
+
+import config
+
+MAX_TARGET = 2 ** 256 - 1
+
+
+def target_from_difficulty(difficulty):
+    """
+    Target met exactly by the hashes starting with `difficulty` hex zeros.
+    """
+    return 16 ** (64 - difficulty) - 1
+
+
+LEGACY_TARGET = target_from_difficulty(config.LEGACY_DIFFICULTY)
+
+
+def _expected_ms(interval, blocks):
+    """
+    Whole milliseconds `blocks` blocks should take, the denominator of
+    `retarget`.
+    """
+    expected_ms = int(interval * blocks * 1000)
+    if blocks < 1 or expected_ms < 1:
+        raise ValueError("Retargeting needs RETARGET_INTERVAL >= 1 and "
+                         "BLOCK_INTERVAL * RETARGET_INTERVAL of at least 1 ms")
+    return expected_ms
+
+
+# Fail at startup rather than at the first retarget
+_expected_ms(config.BLOCK_INTERVAL, config.RETARGET_INTERVAL)
+
+
+def history_length():
+    """
+    Blocks a TargetSchedule keeps: a retarget window and the blocks of
+    the median time.
+    """
+    return max(config.RETARGET_INTERVAL + 1, config.MEDIAN_TIME_BLOCKS)
+
+
+def meets_target(computed_hash, target):
+    return int(computed_hash, 16) <= target
+
+
+def block_target(block):
+    """
+    Target the hash of `block` has to meet.
+    """
+    return block.target if block.target is not None else LEGACY_TARGET
+
+
+def block_work(target):
+    """
+    Expected number of hashes to meet `target` (None for a legacy block).
+    """
+    return 2 ** 256 // ((LEGACY_TARGET if target is None else target) + 1)
+
+
+def chain_work(blocks):
+    return sum(block_work(block.target) for block in blocks)
+
+
+def retarget(target, elapsed, interval=None, blocks=None):
+    """
+    :param elapsed: seconds the last `blocks` blocks took
+    """
+    interval = interval or config.BLOCK_INTERVAL
+    blocks = blocks or config.RETARGET_INTERVAL
+    expected = interval * blocks
+    factor = config.MAX_RETARGET_FACTOR
+    elapsed = min(max(elapsed, expected / factor), expected * factor)
+    # Whole milliseconds keep the arithmetic in exact integers
+    new_target = target * int(elapsed * 1000) // _expected_ms(interval, blocks)
+    return max(1, min(new_target, MAX_TARGET))
+
+
+class TargetSchedule:
+    """
+    Follows a chain block by block and tells the target required for
+    the next one. Only the last `history_length()` blocks are kept.
+    :param history: (timestamp, target) of the blocks before the next
+                    one, oldest first; targets of legacy blocks are None
+    """
+
+    def __init__(self, history=()):
+        self.__window = deque(maxlen=history_length())
+        for timestamp, target in history:
+            self.append(timestamp, target)
+
+    def append(self, timestamp, target):
+        self.__window.append((timestamp, target))
+
+    def required(self, height):
+        """
+        Target of the block at `height`, which must follow the blocks
+        appended so far.
+        """
+        window = self.__window
+        if not window:
+            return LEGACY_TARGET
+        target = window[-1][1]
+        if target is None:
+            target = LEGACY_TARGET
+        if height % config.RETARGET_INTERVAL or len(window) <= config.RETARGET_INTERVAL:
+            return target
+        return retarget(target, window[-1][0] - window[-config.RETARGET_INTERVAL - 1][0])
+
+    def accepts(self, height, target):
+        """
+        Whether a block at `height` may carry `target` (None for a
+        legacy block, only allowed after legacy blocks).
+        """
+        if target is None:
+            return not self.__window or self.__window[-1][1] is None
+        return target == self.required(height)
+
+    def median_time(self):
+        """
+        Median timestamp of the last MEDIAN_TIME_BLOCKS blocks appended,
+        or None before the first block.
+        """
+        recent = sorted(timestamp for timestamp, _ in
+                        list(self.__window)[-config.MEDIAN_TIME_BLOCKS:])
+        return recent[len(recent) // 2] if recent else None
+
+    def accepts_timestamp(self, timestamp, now=None):
+        """
+        Whether the next block may carry `timestamp`: a number above the
+        median time and at most MAX_FUTURE_DRIFT seconds ahead of `now`
+        (the local clock by default).
+        """
+        if type(timestamp) not in (int, float):
+            return False
+        now = time.time() if now is None else now
+        median = self.median_time()
+        return (median is None or timestamp > median) and timestamp <= now + config.MAX_FUTURE_DRIFT
@@ -0,0 +1,114 @@
+"""
+Order-independent commitment over a blockchain index (`bc_idx`).
+
+Each entry of the index is hashed on its own to 4096 bits and the
+state is the sum of all entry hashes modulo 2**4096 (AdHash). Adding or
+removing an entry adds or subtracts its hash, so keeping the commitment
+up to date costs O(changes), and two nodes holding the same index get
+the same value no matter in which order they built it. The digest put
+into blocks is the sha256 of the state; the state itself is what the
+index stores save.
+
+Security: two indexes with the same state are a set of entry hashes
+summing to 0. The best known way to find one is Wagner's generalized
+birthday algorithm, which over n bits costs about 2**(2 * sqrt(n)) hash
+evaluations - only 2**32 for n = 256, hence the 4096 bits here, which
+put it at about 2**128.
+
+Entries:
+    NFT index          [key, field, value]   for bc_idx[key][field] = value
+    transaction index  [key, value]          for each value in bc_idx[key]
+Tuples (e.g. the (from, to) keys of the transaction index) are tagged
+so they never collide with lists.
+"""
+
+from hashlib import sha256, shake_256
+import json
+
+_BITS = 4096
+_MODULUS = 2 ** _BITS
+
+
+def _canonical(obj):
+    if isinstance(obj, tuple):
+        return {"tuple": [_canonical(item) for item in obj]}
+    if isinstance(obj, list):
+        return [_canonical(item) for item in obj]
+    if isinstance(obj, dict):
+        return {key: _canonical(value) for key, value in obj.items()}
+    return obj
+
+
+def entry_hash(entry):
+    data = json.dumps(_canonical(entry), sort_keys=True).encode()
+    return int.from_bytes(shake_256(b"idx" + data).digest(_BITS // 8), "big")
+
+
+def entries(bc_idx):
+    for key, values in bc_idx.items():
+        if isinstance(values, dict):
+            for field, value in values.items():
+                yield [key, field, value]
+        else:
+            for value in values:
+                yield [key, value]
+
+
+class IndexCommitment:
+    def __init__(self, bc_idx=None):
+        self.__value = sum(map(entry_hash, entries(bc_idx or {}))) % _MODULUS
+
+    def add(self, entry):
+        self.__value = (self.__value + entry_hash(entry)) % _MODULUS
+
+    def remove(self, entry):
+        self.__value = (self.__value - entry_hash(entry)) % _MODULUS
+
+    def update(self, bc_idx, mutation):
+        """
+        Accounts for an IndexStore mutation. Must be called before the
+        mutation is applied to `bc_idx`.
+        """
+        action, key = mutation[0], mutation[1]
+        if action == "append":
+            self.add([key, mutation[2]])
+            return
+        if action == "remove":
+            self.remove([key, mutation[2]])
+            return
+        field = mutation[2]
+        if key in bc_idx and field in bc_idx[key]:
+            self.remove([key, field, bc_idx[key][field]])
+        if action == "set":
+            self.add([key, field, mutation[3]])
+
+    def hexdigest(self):
+        return sha256(self.__value.to_bytes(_BITS // 8, "big")).hexdigest()
+
+    def state(self):
+        """
+        returns: the sum itself, as saved with the index (see `from_state`)
+        """
+        return "%0*x" % (_BITS // 4, self.__value)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        The commitment of a saved index, without reading the index.
+        returns: None if `state` is not one (e.g. from an older version)
+        """
+        if not isinstance(state, str) or len(state) != _BITS // 4:
+            return None
+        commitment = cls()
+        try:
+            commitment.__value = int(state, 16)
+        except ValueError:
+            return None
+        return commitment
+
+
+def verify(bc_idx, digest):
+    """
+    Recomputes the commitment of `bc_idx` from scratch.
+    """
+    return IndexCommitment(bc_idx).hexdigest() == digest
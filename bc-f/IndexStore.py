@@ -0,0 +1,412 @@
+"""
+Storage of a blockchain index (`Blockchain.bc_idx`) on disk.
+
+PickleIndexStore: rewrites the whole index file on every save.
+WalIndexStore:    appends only the mutations made since the last save
+                  to a write-ahead log and folds them into a snapshot
+                  every `compact_every` saves.
+SqliteIndexStore: keeps the index in sqlite (WAL mode) instead of in
+                  memory; lookups and mutations only touch the rows of
+                  one key, and no pickle is ever loaded.
+
+A store has:
+* open(empty):  returns (bc_idx, commitment or None) - the saved index
+                (`empty`, a defaultdict, if there is none) and, if the
+                store keeps it, the commitment state of the saved index
+                (see `IndexCommitment.state`)
+* save(bc_idx, mutations, commitment): persists the mutations made
+                since the last save
+* load():       the saved index, or False
+
+Mutations are tuples:
+    ("append", key, value)          bc_idx[key].append(value)
+    ("remove", key, value)          removes the last `value` of bc_idx[key]
+    ("set", key, field, value)      bc_idx[key][field] = value
+    ("delete", key, field)          del bc_idx[key][field]
+"""
+
+import json
+import os
+import pickle
+import sqlite3
+import threading
+
+import config
+from IndexCommitment import IndexCommitment
+
+
+def apply_mutation(bc_idx, mutation):
+    if isinstance(bc_idx, SqliteIndex):
+        bc_idx.apply(mutation)
+        return
+    action, key = mutation[0], mutation[1]
+    if action == "append":
+        bc_idx[key].append(mutation[2])
+    elif action == "remove":
+        values = bc_idx[key]
+        for i in range(len(values) - 1, -1, -1):
+            if values[i] == mutation[2]:
+                del values[i]
+                break
+    elif action == "set":
+        bc_idx[key][mutation[2]] = mutation[3]
+    elif action == "delete":
+        bc_idx[key].pop(mutation[2], None)
+    else:
+        raise ValueError("Unknown index mutation: {}".format(action))
+
+
+def atomic_write(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FileIndexStore:
+    """
+    Base of the stores which keep the whole index in memory.
+    """
+    path = None
+
+    def open(self, empty):
+        saved = self.load() if os.path.exists(self.path) else False
+        if saved is False:
+            # A new index is written out empty
+            self.reset(empty)
+        else:
+            empty.update(saved)
+        return empty, None
+
+
+class PickleIndexStore(FileIndexStore):
+    def __init__(self, path):
+        self.path = path
+
+    def reset(self, bc_idx):
+        self.save(bc_idx, [])
+
+    def save(self, bc_idx, mutations, commitment=None):
+        with open(self.path, "wb") as f:
+            pickle.dump(bc_idx, f)
+
+    def load(self):
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            print("The index file of current blockchain does not exist")
+            return False
+        with f:
+            return pickle.load(f)
+
+
+class WalIndexStore(FileIndexStore):
+    """
+    <path>      snapshot: pickle of {"index", "generation"}
+    <path>.wal  pickled (generation, mutations) records appended after
+                the snapshot; records of an older generation are already
+                part of the snapshot (crash between compaction steps)
+    """
+
+    def __init__(self, path, compact_every=None):
+        self.path = path
+        self.wal_path = path + ".wal"
+        self.compact_every = compact_every or config.INDEX_COMPACT_EVERY
+        self.__records = 0
+        self.__generation = 0
+
+    def reset(self, bc_idx):
+        self.compact(bc_idx)
+
+    def save(self, bc_idx, mutations, commitment=None):
+        if not mutations:
+            return
+        record = pickle.dumps((self.__generation, mutations))
+        with open(self.wal_path, "ab") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self.__records += 1
+        if self.__records >= self.compact_every:
+            self.compact(bc_idx)
+
+    def compact(self, bc_idx):
+        """
+        Writes the full index as the new snapshot and empties the log.
+        """
+        self.__generation += 1
+        atomic_write(self.path, pickle.dumps({"index": bc_idx,
+                                               "generation": self.__generation}))
+        with open(self.wal_path, "wb"):
+            pass
+        self.__records = 0
+
+    def load(self):
+        """
+        Returns the snapshot with the log replayed on top. A torn
+        final log record (crash during save) is cut off.
+        """
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            print("The index file of current blockchain does not exist")
+            return False
+        with f:
+            snapshot = pickle.load(f)
+        bc_idx, generation, records = snapshot["index"], snapshot["generation"], 0
+
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, "r+b") as f:
+                while True:
+                    start = f.tell()
+                    try:
+                        record_generation, mutations = pickle.load(f)
+                    except Exception:
+                        f.truncate(start)
+                        break
+                    if record_generation < generation:
+                        continue
+                    for mutation in mutations:
+                        apply_mutation(bc_idx, mutation)
+                    records += 1
+
+        self.__records, self.__generation = records, generation
+        return bc_idx
+
+
+def _encode(obj):
+    """
+    JSON text of an index key or value; tuples are tagged so they come
+    back as tuples.
+    """
+    def tag(item):
+        if isinstance(item, tuple):
+            return {"tuple": [tag(i) for i in item]}
+        if isinstance(item, list):
+            return [tag(i) for i in item]
+        return item
+    return json.dumps(tag(obj), separators=(",", ":"))
+
+
+_decoder = json.JSONDecoder(object_hook=lambda d: tuple(d["tuple"]) if d.keys() == {"tuple"} else d)
+
+
+def _decode(text):
+    return _decoder.decode(text)
+
+
+def encode_mutations(mutations):
+    """
+    JSON text of index mutations, e.g. for a snapshot (see Snapshot.py).
+    """
+    return _encode(list(mutations))
+
+
+def decode_mutations(text):
+    return _decode(text)
+
+
+class SqliteIndex:
+    """
+    A bc_idx kept in sqlite, with the mapping operations the index
+    users need. bc_idx[key] reads the rows of `key` into a new dict (or
+    list); changes go through `apply`, and stay uncommitted until
+    `commit`.
+
+    entries(key, field, value)  key and value are JSON (see `_encode`);
+                                field is the field of a dict index, or
+                                the position of the value in a list index
+    meta(name, value)           "kind" ("dict" or "list"), "commitment"
+    """
+
+    def __init__(self, path, kind="dict"):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=FULL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT NOT NULL, field NOT NULL, "
+                          "value TEXT NOT NULL, PRIMARY KEY (key, field)) WITHOUT ROWID")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.__db.execute("INSERT OR IGNORE INTO meta VALUES ('kind', ?)", (kind,))
+        self.__db.commit()
+        self.kind = self.meta("kind")
+
+    def meta(self, name):
+        with self.__lock:
+            row = self.__db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def __rows(self, key):
+        with self.__lock:
+            return self.__db.execute("SELECT field, value FROM entries WHERE key = ? ORDER BY field",
+                                     (_encode(key),)).fetchall()
+
+    def __getitem__(self, key):
+        rows = self.__rows(key)
+        # One JSON document for all values of the key
+        values = _decode("[" + ",".join(value for _, value in rows) + "]")
+        if self.kind == "list":
+            return values
+        return {field: value for (field, _), value in zip(rows, values)}
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        with self.__lock:
+            return self.__db.execute("SELECT 1 FROM entries WHERE key = ? LIMIT 1",
+                                     (_encode(key),)).fetchone() is not None
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(DISTINCT key) FROM entries").fetchone()[0]
+
+    def items(self, batch=10000):
+        """
+        (key, dict or list) of every key, read `batch` rows at a time.
+        """
+        with self.__lock:
+            cursor = self.__db.execute("SELECT key, field, value FROM entries ORDER BY key, field")
+        current, values = None, None
+        while True:
+            with self.__lock:
+                rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for key, field, value in rows:
+                if key != current:
+                    if current is not None:
+                        yield _decode(current), values
+                    current, values = key, [] if self.kind == "list" else {}
+                if self.kind == "list":
+                    values.append(_decode(value))
+                else:
+                    values[field] = _decode(value)
+        if current is not None:
+            yield _decode(current), values
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def apply(self, mutation):
+        action, key = mutation[0], _encode(mutation[1])
+        with self.__lock:
+            if action == "append":
+                self.__db.execute("INSERT INTO entries SELECT ?, COALESCE(MAX(field) + 1, 0), ? "
+                                  "FROM entries WHERE key = ?", (key, _encode(mutation[2]), key))
+            elif action == "remove":
+                self.__db.execute("DELETE FROM entries WHERE key = ? AND field = (SELECT MAX(field) "
+                                  "FROM entries WHERE key = ? AND value = ?)", (key, key, _encode(mutation[2])))
+            elif action == "set":
+                self.__db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                  (key, mutation[2], _encode(mutation[3])))
+            elif action == "delete":
+                self.__db.execute("DELETE FROM entries WHERE key = ? AND field = ?", (key, mutation[2]))
+            else:
+                raise ValueError("Unknown index mutation: {}".format(action))
+
+    def insert(self, bc_idx):
+        """
+        Bulk-loads the entries of an in-memory index.
+        """
+        def rows():
+            for key, values in bc_idx.items():
+                encoded = _encode(key)
+                pairs = enumerate(values) if self.kind == "list" else values.items()
+                for field, value in pairs:
+                    yield encoded, field, _encode(value)
+        with self.__lock:
+            self.__db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows())
+
+    def commit(self, commitment=None):
+        with self.__lock:
+            if commitment is not None:
+                self.__db.execute("INSERT OR REPLACE INTO meta VALUES ('commitment', ?)", (commitment,))
+            self.__db.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+class SqliteIndexStore:
+    """
+    <name>.sqlite  the index (see SqliteIndex), next to the <name>.pkl
+                   of the other stores. A saved pickle index without a
+                   sqlite file is migrated on first open.
+    """
+
+    def __init__(self, path):
+        self.pickle_path = path
+        self.path = os.path.splitext(path)[0] + ".sqlite"
+        self.__index = None
+
+    def open(self, empty):
+        kind = "list" if empty.default_factory is list else "dict"
+        if not os.path.exists(self.path) and os.path.exists(self.pickle_path):
+            print("Migrating {} to {}".format(self.pickle_path, self.path))
+            migrate(self.pickle_path, self.path, kind)
+        self.__index = SqliteIndex(self.path, kind)
+        return self.__index, self.__index.meta("commitment")
+
+    def reset(self, bc_idx):
+        pass
+
+    def save(self, bc_idx, mutations, commitment=None):
+        bc_idx.commit(commitment)
+
+    def load(self):
+        if self.__index is None and not os.path.exists(self.path):
+            print("The index file of current blockchain does not exist")
+            return False
+        # Not `or`: the truth value of an index would count its keys
+        return self.__index if self.__index is not None else SqliteIndex(self.path)
+
+
+def load_pickle_index(path):
+    """
+    The index saved by PickleIndexStore or WalIndexStore at `path`.
+    Only for the node's own files: loading a pickle runs code.
+    """
+    with open(path, "rb") as f:
+        saved = pickle.load(f)
+    if type(saved) is dict and saved.keys() == {"index", "generation"}:
+        return WalIndexStore(path).load()
+    return saved
+
+
+def migrate(pickle_path, sqlite_path, kind=None):
+    """
+    Copies a pickle index (see `load_pickle_index`) and its commitment
+    into a new sqlite index.
+    :param kind: "dict" or "list", by default the kind of the index
+    returns: number of keys migrated
+    """
+    bc_idx = load_pickle_index(pickle_path)
+    if kind is None:
+        is_list = getattr(bc_idx, "default_factory", None) is list or \
+            any(isinstance(values, list) for values in bc_idx.values())
+        kind = "list" if is_list else "dict"
+    tmp_path = sqlite_path + ".tmp"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(tmp_path + suffix):
+            os.remove(tmp_path + suffix)
+    index = SqliteIndex(tmp_path, kind)
+    index.insert(bc_idx)
+    index.commit(IndexCommitment(bc_idx).state())
+    index.close()
+    os.replace(tmp_path, sqlite_path)
+    return len(bc_idx)
+
+
+INDEX_STORES = {"pickle": PickleIndexStore, "wal": WalIndexStore, "sqlite": SqliteIndexStore}
+
+
+def create(path, mode=None):
+    return INDEX_STORES[mode or config.INDEX_MODE](path)
@@ -0,0 +1,79 @@
+"""
+Entries waiting to be mined (`Blockchain.unconfirmed_info`).
+
+A lock-protected, insertion-ordered pool holding at most
+MEMPOOL_MAX_SIZE entries. Entries are identified by their hash (the
+Merkle leaf hash, see Merkle.py), so an entry submitted twice, or
+handed back by a chain reorganisation while it is still pending, is
+only kept once. A full pool raises MempoolFull, which the HTTP layer
+answers with 429 so clients back off.
+"""
+
+import threading
+
+import config
+from Merkle import leaf_hash
+
+
+class MempoolFull(Exception):
+    pass
+
+
+class Mempool:
+    def __init__(self, max_size=None):
+        self.max_size = max_size or config.MEMPOOL_MAX_SIZE
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __bool__(self):
+        return bool(self.__entries)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __contains__(self, info):
+        return leaf_hash(info) in self.__entries
+
+    def snapshot(self):
+        """
+        returns: the pending entries, oldest first
+        """
+        with self.__lock:
+            return list(self.__entries.values())
+
+    def add(self, info):
+        """
+        returns: False if the entry is already pending
+        """
+        return bool(self.add_batch([info]))
+
+    def add_batch(self, infos):
+        """
+        Admits all new entries of `infos` or, if they do not fit,
+        none of them.
+        returns: the entries admitted (duplicates are left out)
+        """
+        hashed = {}
+        for info in infos:
+            hashed.setdefault(leaf_hash(info), info)
+        with self.__lock:
+            new = {h: info for h, info in hashed.items() if h not in self.__entries}
+            if len(self.__entries) + len(new) > self.max_size:
+                raise MempoolFull("{} pending entries, the limit is {}".format(
+                    len(self.__entries), self.max_size))
+            self.__entries.update(new)
+        return list(new.values())
+
+    def remove(self, infos):
+        """
+        Drops `infos` (e.g. once they are mined) if they are pending.
+        """
+        if not self.__entries:
+            return
+        hashes = [leaf_hash(info) for info in infos]
+        with self.__lock:
+            for h in hashes:
+                self.__entries.pop(h, None)
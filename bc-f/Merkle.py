@@ -0,0 +1,76 @@
+"""
+Merkle tree over the `info` entries of a block.
+
+Leaves and inner nodes are hashed with different prefixes so an inner
+node can never be passed off as a transaction. A node without a
+sibling is carried up to the next level unchanged.
+
+An inclusion proof is the list of siblings from the leaf up to the root:
+    [[<sibling hash>, "L" | "R"], ...]
+where "L" means the sibling is on the left.
+"""
+
+from hashlib import sha256
+import json
+
+EMPTY_ROOT = sha256(b"").hexdigest()
+
+
+def leaf_hash(info):
+    data = json.dumps(info, sort_keys=True).encode()
+    return sha256(b"\x00" + data).hexdigest()
+
+
+def node_hash(left, right):
+    return sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def _next_level(level):
+    parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(leaves):
+    """
+    :param leaves: list of leaf hashes
+    """
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, index):
+    """
+    Returns the inclusion proof of `leaves[index]`.
+    """
+    if not 0 <= index < len(leaves):
+        raise IndexError("leaf index out of range")
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append([level[sibling], "L" if sibling < index else "R"])
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    """
+    Checks that the leaf hash `leaf` is committed to by `root`.
+    """
+    computed = leaf
+    for sibling, side in proof:
+        if side == "L":
+            computed = node_hash(sibling, computed)
+        elif side == "R":
+            computed = node_hash(computed, sibling)
+        else:
+            return False
+    return computed == root
@@ -0,0 +1,120 @@
+"""
+Proof-of-work engines used by `Blockchain.proof_of_work`.
+
+SerialMiner:   tries nonces 0, 1, 2, ... in the calling process.
+ParallelMiner: splits the nonce space into fixed-size chunks and
+               searches them on a process pool.
+
+Both return the lowest nonce whose hash meets the target, so a
+block mined in parallel has exactly the hash the serial path gives.
+"""
+
+import multiprocessing
+import os
+
+from Block import nonce_hasher
+import config
+from Difficulty import meets_target
+
+# Upper bound of the shared "best nonce so far" value
+_NO_NONCE = 2 ** 63 - 1
+# How often (in nonces) a worker checks if a lower nonce was found
+_CHECK_EVERY = 256
+
+# Workers are started from a clean process rather than forked from
+# this one, whose other threads may hold locks (see Validator.py)
+_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Per-process state of a pool worker, set by `_init_worker`
+_hasher = None
+_best = None
+
+
+class SerialMiner:
+    def search(self, block, target):
+        """
+        Tries nonces one by one until the hash of `block` meets
+        `target`. Leaves the winning nonce on the block.
+        """
+        hash_with_nonce = block.nonce_hasher()
+        nonce = 0
+
+        computed_hash = hash_with_nonce(nonce)
+        while not meets_target(computed_hash, target):
+            nonce += 1
+            computed_hash = hash_with_nonce(nonce)
+
+        block.nonce = nonce
+        return computed_hash
+
+
+def _init_worker(prefix, best):
+    global _hasher, _best
+    _hasher = nonce_hasher(prefix)
+    _best = best
+
+
+def _search_chunk(task):
+    """
+    Searches nonces in [start, stop). Gives up as soon as another
+    worker has found a nonce lower than the current one.
+    """
+    start, stop, target = task
+    hash_with_nonce = _hasher
+    for nonce in range(start, stop):
+        if nonce % _CHECK_EVERY == 0 and nonce > _best.value:
+            return None
+        computed_hash = hash_with_nonce(nonce)
+        if meets_target(computed_hash, target):
+            with _best.get_lock():
+                if nonce < _best.value:
+                    _best.value = nonce
+            return nonce, computed_hash
+    return None
+
+
+class ParallelMiner:
+    """
+    :param workers:    number of worker processes (default: all cores)
+    :param chunk_size: number of nonces handed to a worker at a time
+    """
+
+    def __init__(self, workers=None, chunk_size=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size or config.MINING_CHUNK_SIZE
+
+    def search(self, block, target):
+        """
+        Searches `workers` consecutive chunks per round. Workers on
+        chunks above a found nonce stop early; chunks below it are
+        finished so that the lowest valid nonce wins, as in the
+        serial search. The pool is torn down once a round has a hit.
+        """
+        best = _context.Value('q', _NO_NONCE)
+        span = self.chunk_size * self.workers
+
+        initargs = (block.hash_prefix(), best)
+        with _context.Pool(self.workers, _init_worker, initargs) as pool:
+            start = 0
+            while True:
+                tasks = [(s, s + self.chunk_size, target)
+                         for s in range(start, start + span, self.chunk_size)]
+                hits = [hit for hit in pool.map(_search_chunk, tasks) if hit]
+                if hits:
+                    nonce, computed_hash = min(hits)
+                    block.nonce = nonce
+                    return computed_hash
+                start += span
+
+
+def create(mode=None, workers=None):
+    """
+    Returns the mining engine for `mode` ("serial" or "parallel").
+    """
+    mode = mode or config.MINING_MODE
+    if mode == "serial":
+        return SerialMiner()
+    if mode == "parallel":
+        return ParallelMiner(workers or config.MINING_WORKERS)
+    raise ValueError("Unknown mining mode: {}".format(mode))
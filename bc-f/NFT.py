@@ -11,18 +11,21 @@ NFTS_INDEX:
         ...}
 """
 
-import json
 import hashlib
-import os
-from io import StringIO
-
-import requests
+import math
+import sqlite3
+import threading
 import time
 
 from werkzeug.utils import secure_filename
 
+from ChunkStore import ChunkStore
+from Mempool import MempoolFull
 import config
-from Block import Block
+import Peers
+import Sync
+import Users
+import Wire
 from Blockchain import Blockchain
 
 
@@ -32,10 +35,218 @@ def hash_data(data):
     return hashlib.sha256(data).hexdigest()
 
 
-def new_file(nfts: Blockchain, request):
+class TokenIndex:
+    """
+    tokenId -> {"owner", "filepath", "height"} as of the sealed blocks,
+    with the transfers waiting in `unconfirmed_info` on top
+    (their height is None). The records a transfer replaced are kept,
+    for `remove_block`.
+    """
+
+    def __init__(self, nfts: Blockchain):
+        self.nfts = nfts
+        self.confirmed = {}
+        self.pending = {}
+        self.earlier = {}
+
+    def __contains__(self, tokenId):
+        return tokenId in self.pending or tokenId in self.confirmed
+
+    def __len__(self):
+        return len(self.confirmed.keys() | self.pending.keys())
+
+    def get(self, tokenId, include_pending=True):
+        if include_pending and tokenId in self.pending:
+            return self.pending[tokenId][1]
+        return self.confirmed.get(tokenId)
+
+    def owner(self, tokenId, include_pending=True):
+        record = self.get(tokenId, include_pending)
+        return record["owner"] if record else None
+
+    def __record(self, inf, height):
+        tokenId = inf["tokenId"]
+        known = self.get(tokenId)
+        filepath = known["filepath"] if known else None
+        if filepath is None and self.nfts.bc_idx is not None and inf["to"] in self.nfts.bc_idx:
+            filepath = self.nfts.bc_idx[inf["to"]].get(tokenId)
+        return {"owner": inf["to"], "filepath": filepath, "height": height}
+
+    def rebuild(self, chain):
+        self.confirmed = {}
+        self.pending = {}
+        self.earlier = {}
+        for block in chain:
+            self.apply_block(block)
+
+    def state(self):
+        return {"confirmed": dict(self.confirmed), "pending": dict(self.pending),
+                "earlier": {tokenId: list(records) for tokenId, records in self.earlier.items()}}
+
+    def load_state(self, state):
+        self.confirmed = state["confirmed"]
+        # (info, record) pairs come back from JSON as lists
+        self.pending = {tokenId: tuple(pending) for tokenId, pending in state["pending"].items()}
+        self.earlier = state.get("earlier", {})
+
+    def apply_block(self, block):
+        for inf in block.info:
+            tokenId = inf["tokenId"]
+            record = self.__record(inf, block.index)
+            if tokenId in self.confirmed:
+                earlier = self.earlier.setdefault(tokenId, [])
+                earlier.append(self.confirmed[tokenId])
+                # On a rebuild the file may only be found in the index
+                # of its current owner: fill it in where it is missing
+                i = len(earlier) - 1
+                while i >= 0 and earlier[i]["filepath"] is None and record["filepath"] is not None:
+                    earlier[i] = dict(earlier[i], filepath=record["filepath"])
+                    i -= 1
+            self.confirmed[tokenId] = record
+            if tokenId in self.pending and self.pending[tokenId][0] == inf:
+                del self.pending[tokenId]
+
+    def remove_block(self, block):
+        for inf in reversed(block.info):
+            tokenId = inf["tokenId"]
+            earlier = self.earlier.get(tokenId)
+            if earlier:
+                self.confirmed[tokenId] = earlier.pop()
+                if not earlier:
+                    del self.earlier[tokenId]
+            else:
+                self.confirmed.pop(tokenId, None)
+
+    def apply_pending(self, info):
+        self.pending[info["tokenId"]] = (info, self.__record(info, None))
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: number of keys the false positive rate is sized for
+        """
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.__positions(key))
+
+
+class TokenSet:
+    """
+    Every tokenId minted so far, used for the originality check.
+    Kept in memory by default; with `path` the exact set is a sqlite
+    table on disk with a Bloom filter in front, so most lookups of new
+    tokens never touch the disk.
+    """
+
+    def __init__(self, path=None, bloom_capacity=None):
+        self.__lock = threading.Lock()
+        self.__db = None
+        self.__tokens = set()
+        self.__bloom = None
+        if path:
+            self.__db = sqlite3.connect(path, check_same_thread=False)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS tokens (id TEXT PRIMARY KEY)")
+            self.__bloom = BloomFilter(bloom_capacity or config.NFT_BLOOM_CAPACITY)
+            for (tokenId,) in self.__db.execute("SELECT id FROM tokens"):
+                self.__bloom.add(tokenId)
+
+    def __contains__(self, tokenId):
+        if self.__db is None:
+            return tokenId in self.__tokens
+        if tokenId not in self.__bloom:
+            return False
+        with self.__lock:
+            row = self.__db.execute("SELECT 1 FROM tokens WHERE id = ?", (tokenId,)).fetchone()
+        return row is not None
+
+    def __add(self, tokenId):
+        if self.__db is None:
+            self.__tokens.add(tokenId)
+        else:
+            self.__db.execute("INSERT OR IGNORE INTO tokens VALUES (?)", (tokenId,))
+            self.__db.commit()
+            self.__bloom.add(tokenId)
+
+    def claim(self, tokenId):
+        """
+        Adds `tokenId` if it is new. Returns False if it already
+        exists, so of concurrent uploads of one file only one wins.
+        """
+        with self.__lock:
+            if self.__db is None:
+                exists = tokenId in self.__tokens
+            else:
+                exists = tokenId in self.__bloom and self.__db.execute(
+                    "SELECT 1 FROM tokens WHERE id = ?", (tokenId,)).fetchone() is not None
+            if not exists:
+                self.__add(tokenId)
+            return not exists
+
+    def release(self, tokenId):
+        """
+        Gives back a claimed tokenId whose upload failed. (The Bloom
+        filter keeps its bits; the exact set has the final say.)
+        """
+        with self.__lock:
+            if self.__db is None:
+                self.__tokens.discard(tokenId)
+            else:
+                self.__db.execute("DELETE FROM tokens WHERE id = ?", (tokenId,))
+                self.__db.commit()
+
+    def rebuild(self, chain):
+        for block in chain:
+            self.apply_block(block)
+
+    def state(self):
+        """
+        The in-memory set, as a list; the sqlite table is on disk already.
+        """
+        return list(self.__tokens) if self.__db is None else None
+
+    def load_state(self, state):
+        if self.__db is None and state is not None:
+            self.__tokens = set(state)
+
+    def apply_block(self, block):
+        for inf in block.info:
+            if inf["tokenId"] not in self:
+                with self.__lock:
+                    self.__add(inf["tokenId"])
+
+    def remove_block(self, block):
+        # Its tokens stay minted: the entries go back to unconfirmed_info
+        pass
+
+    def apply_pending(self, info):
+        pass
+
+
+def attach_indexes(nfts: Blockchain):
+    nfts.register_index("tokens", TokenIndex(nfts))
+    nfts.register_index("token_set", TokenSet(config.NFT_TOKEN_SET))
+
+
+def new_file(nfts: Blockchain, request, registry=None):
     """
     Create an NFT if `from` == 0
     Throws if public key `to` is not verified.
+    Throws if `to` is not in the user `registry`.
     Throws if `file` is not a attached.
     """
     upload_folder = config.UPLOAD_FOLDER
@@ -57,68 +268,72 @@ def new_file(nfts: Blockchain, request):
     nft_data["to"] = request.form["to"]
     nft_data["private_key"] = request.form["private_key"]
 
-    file.seek(0)
-    file_binary_data = file.read()
-    nft_data["tokenId"] = hash_data(file_binary_data)
-
-    # Check if the NFT is original
-    if any(nft_data["tokenId"] in bc_d.keys() for bc_d in nfts.bc_idx.values()):
-        return "The NFT is not original", 403
-
     # Verify ownership
-    if nft_data["to"] != hash_data(nft_data["private_key"]):
+    if not Users.verify_keypair(nft_data["to"], nft_data["private_key"]):
         return "Forbidden", 402
     del nft_data["private_key"]
+    error = Users.check_participants(registry, nft_data["to"])
+    if error:
+        return error
+
+    # Stream the file into chunk storage while hashing it
+    chunk_store = ChunkStore(upload_folder)
+    file.stream.seek(0)
+    nft_data["tokenId"], manifest = chunk_store.put_stream(file.stream, secure_filename(file.filename))
+
+    # Check if the NFT is original; only one of concurrent
+    # uploads of the same file gets the token
+    if not nfts.indexes["token_set"].claim(nft_data["tokenId"]):
+        return "The NFT is not original", 403
 
-    # TODO: chunk large file and save data blocks
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(upload_folder, filename)
-    file.save(filepath)
+    try:
+        filepath = chunk_store.save_manifest(nft_data["tokenId"], manifest)
+    except OSError:
+        nfts.indexes["token_set"].release(nft_data["tokenId"])
+        raise
 
     nft_data["timestamp"] = time.time()
-
-    # Update index
-    nfts.bc_idx[nft_data["to"]][nft_data["tokenId"]] = filepath
-
-    nfts.add_new_info(nft_data)
+    # Pending with its index change, e.g. for a snapshot
+    with nfts.lock:
+        try:
+            nfts.add_new_info(nft_data)
+        except MempoolFull:
+            nfts.indexes["token_set"].release(nft_data["tokenId"])
+            raise
+
+        # Update index
+        nfts.index_set(nft_data["to"], nft_data["tokenId"], filepath, nft_data)
     return "Success", 201
 
 
-def balanceOf(nfts: Blockchain, owner):
+def balanceOf(nfts: Blockchain, owner, registry=None):
     """
     Get all NFTs assigned to `owner`
+    Throws if `owner` is not in the user `registry`.
     """
-    # TODO: check if valid owner ID
+    error = Users.check_participants(registry, owner)
+    if error:
+        return error
     NFTs = []
-    for _, v in nfts.bc_idx[owner]:
+    for _, v in nfts.bc_idx.get(owner, {}).items():
         NFTs.append(v)
-    return NFTs
+    return NFTs, 200
 
 
 def ownerOf(nfts: Blockchain, tokenId):
     """
-    Return the owner of NFT
+    Return the owner of NFT, including pending transfers
     """
-    owner = None
-    for block in nfts.chain[::-1]:
-        info = block.info
-        for inf in info[::-1]:
-            if inf["tokenId"] == tokenId:
-                owner = inf["to"]
-                return owner
-    # for inf in nfts.unconfirmed_info[::-1]:
-    #     if inf["tokenId"] == tokenId:
-    #         owner = inf["to"]
-    #         return owner
-    return owner
+    return nfts.indexes["tokens"].owner(tokenId)
 
 
-def transfer(nfts: Blockchain, request):
+def transfer(nfts: Blockchain, request, registry=None):
     """
     Transfer ownership of an NFT.
     Throws if `from` is not the current owner.
     Throws if `to` is the zero. (NFT is not deletable)
     Throws if public key `from` is not verified.
+    Throws if `from` or `to` is not in the user `registry`.
     Throws if `tokenId` is not a valid NFT
     """
     nft_data = request.get_json()
@@ -128,27 +343,32 @@ def transfer(nfts: Blockchain, request):
         if not nft_data.get(field):
             return "Invalid NFT data", 404
 
-    owner = ownerOf(nfts, nft_data["tokenId"])
-    print("tokenId", nft_data["tokenId"])
-    print("owner", owner)
-
     # verify if the owner authorize the transaction
-    if nft_data["from"] != hash_data(nft_data["private_key"]) or \
-            owner != nft_data["from"]:
+    if not Users.verify_keypair(nft_data["from"], nft_data["private_key"]):
         return "Forbidden", 403
     del nft_data["private_key"]
-
-    nft_data["timestamp"] = time.time()
-
-    # Update index
-    filepath = nfts.bc_idx[nft_data["from"]][nft_data["tokenId"]]
-    del nfts.bc_idx[nft_data["from"]][nft_data["tokenId"]]
-    # check if exist
-    if nft_data["tokenId"] in nfts.bc_idx[nft_data["from"]]:
-        print("Transfer failure")
-    nfts.bc_idx[nft_data["to"]][nft_data["tokenId"]] = filepath
-
-    nfts.add_new_info(nft_data)
+    error = Users.check_participants(registry, nft_data["from"], nft_data["to"])
+    if error:
+        return error
+
+    # The owner (pending transfers included) is checked and the
+    # transfer admitted in one step, so a token is only spent once
+    with nfts.lock:
+        owner = ownerOf(nfts, nft_data["tokenId"])
+        print("tokenId", nft_data["tokenId"])
+        print("owner", owner)
+        if owner != nft_data["from"]:
+            return "Forbidden", 403
+
+        nft_data["timestamp"] = time.time()
+        nfts.add_new_info(nft_data)
+
+        # Update index; tokens of blocks from peers may not be in it
+        if nft_data["tokenId"] in nfts.bc_idx.get(nft_data["from"], {}):
+            filepath = nfts.index_delete(nft_data["from"], nft_data["tokenId"], nft_data)
+        else:
+            filepath = nfts.indexes["tokens"].get(nft_data["tokenId"])["filepath"]
+        nfts.index_set(nft_data["to"], nft_data["tokenId"], filepath, nft_data)
     return "Success", 201
 
 
@@ -157,57 +377,37 @@ def mine_unconfirmed_nfts(nfts: Blockchain, peers):
     if not result:
         return "No new nfts to mine", 400
     else:
-        chain_length = len(nfts.chain)
+        tip = nfts.last_block.hash
         consensus(nfts, peers)
-        if chain_length == len(nfts.chain):
+        if tip == nfts.last_block.hash:
             announce_new_block(nfts.last_block, peers)
             return "NFT Block #{} is mined.".format(nfts.last_block.index), 201
         return "Current Chain is not the latest version. New chain is updated.", 200
 
 
-def get_chain(nfts: Blockchain):
-    chain_data = []
-    chain_len = 0
-    for block in nfts.chain:
-        chain_data.append(block.__dict__)
-        chain_len = block.index
-    return json.dumps({"length": chain_len,
-                       "chain": chain_data})
+def get_chain(nfts: Blockchain, request=None):
+    return Wire.chain_response(nfts.chain, request)
 
 
 def announce_new_block(block, peers):
-    headers = {"Content-Type": "application/json"}
-    for peer in peers:
-        url = "{}/nfts/add_block".format(peer)
-        requests.post(url, data=json.dumps(block.__dict__, sort_keys=True), headers=headers)
+    """
+    Sends the block to all peers in the background.
+    """
+    return Peers.broadcast(
+        peers, lambda peer: Wire.post_block(peer, "{}/nfts/add_block".format(peer.rstrip("/")), block))
 
 
 def consensus(nfts: Blockchain, peers):
-    longest_chain = None
-    current_len = len(nfts.chain)
-
-    for node in peers:
-        response = requests.get('{}/nfts/chain'.format(node))
-        length = response.json()["length"]
-        chain = response.json()["chain"]
-        if length > current_len and nfts.check_chain_validity(chain):
-            current_len = length
-            longest_chain = chain
-    if longest_chain:
-        config.nfts = longest_chain
-        return True
-    return False
+    """
+    Adopts a valid chain with more work from the peers, downloading only the
+    blocks after the fork point (see Sync.py).
+    """
+    return Sync.sync_chain(nfts, peers, "/nfts") > 0
 
 
 def nft_add_block(nfts: Blockchain, request):
-    block_data = request.get_json()
-    block = Block(block_data["_Block__index"],
-                  block_data["_Block__info"],
-                  block_data["_Block__timestamp"],
-                  block_data["_Block__previous_hash"],
-                  block_data["_Block__previous_idx_hash"])
-    block.nonce = block_data["nonce"]
-    proof = block.compute_hash()
+    block = Wire.block_from_request(request)
+    proof = block.hash
     added = nfts.add_block(block, proof)
     if not added:
         return "The block was discarded by the node", 400
@@ -0,0 +1,89 @@
+"""
+HTTP client for talking to peer nodes.
+
+* every thread keeps its own `requests.Session`, so connections to a
+  peer are pooled and kept alive between calls
+* every call has a timeout (PEER_TIMEOUT) and failed connections or
+  5xx answers are retried PEER_RETRIES times with exponential backoff
+* `fan_out` runs a call against all peers on a bounded thread pool
+  (PEER_WORKERS) and waits for them, so it costs about as much as the
+  slowest peer instead of the sum over all peers
+* `broadcast` does the same without waiting, so e.g. mining returns
+  as soon as the block is on our chain
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import requests
+
+import config
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.PEER_WORKERS,
+                                           thread_name_prefix="peers")
+        return _executor
+
+
+def request(method, url, **kwargs):
+    """
+    Like `requests.request`, through this thread's session, with the
+    peer timeout and retries.
+    """
+    kwargs.setdefault("timeout", config.PEER_TIMEOUT)
+    for attempt in range(config.PEER_RETRIES + 1):
+        last = attempt == config.PEER_RETRIES
+        try:
+            response = session().request(method, url, **kwargs)
+            if response.status_code < 500 or last:
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+        time.sleep(config.PEER_BACKOFF * 2 ** attempt)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def fan_out(peers, call):
+    """
+    Runs `call(peer)` for every peer concurrently.
+    returns: {peer: result} of the peers which answered; failures are
+             left out (a peer being down is not our error)
+    """
+    futures = {peer: executor().submit(call, peer) for peer in peers}
+    results = {}
+    for peer, future in futures.items():
+        try:
+            results[peer] = future.result()
+        except requests.RequestException:
+            continue
+    return results
+
+
+def broadcast(peers, call):
+    """
+    Like `fan_out`, but returns the futures right away.
+    """
+    return [executor().submit(call, peer) for peer in peers]
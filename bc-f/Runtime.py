@@ -0,0 +1,560 @@
+"""
+Node runtime: every chain (users, tx, nfts) runs in a ChainNode of its
+own, with its mempool, indexes, block store, mining scheduler and
+snapshots. `call(op, *args)` runs one of the node's request handlers
+(`ops`) and returns what the HTTP view returns.
+
+NODE_RUNTIME = "processes": each ChainNode lives in a worker process
+    and the HTTP front-end (app.py) forwards requests to it over a
+    pipe, so the chains run on separate cores and a proof of work on
+    one chain does not hold up requests to the others.
+NODE_RUNTIME = "threads": all ChainNodes live in the front-end process.
+
+Pipe protocol: the front-end sends (call id, op, args) and the worker
+runs the call on a thread pool, answering (call id, "result", value) or
+(call id, "error", exception). A Response is sent as
+(call id, "head", (status, headers)), then (call id, "chunk", bytes)
+for each part of its body and (call id, "end", None), so streamed
+replies stay streamed. Flask requests are sent as RequestData.
+
+The tx and nfts workers check participants against the registry of the
+users worker, over a pipe of their own (RemoteRegistry). A worker
+stops, writing its snapshot, once the front-end sends "stop" or its
+pipe is closed.
+"""
+
+import abc
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from flask import Request, Response
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+
+from Blockchain import Blockchain
+from BlockStore import BlockStore
+import config
+import Miner
+import NFT
+import Scheduler
+import Snapshot
+import Sync
+import Transactions
+import Users
+import Wire
+
+CHAINS = ("users", "tx", "nfts")
+
+
+def create_blockchain(name):
+    """
+    Opens the chain's block store and restores its snapshot, if any;
+    the indexes are attached afterwards.
+    """
+    bc = Blockchain(Miner.create(config.MINING_MODE, config.MINING_WORKERS),
+                    config.BLOCK_FORMAT,
+                    BlockStore(os.path.join(config.CHAIN_FOLDER, name)))
+    bc.checkpoint = config.CHAIN_CHECKPOINTS.get(name)
+    height = Snapshot.restore(bc, Snapshot.snapshot_path(name))
+    if height is not None:
+        print("{}: snapshot at height {}, {} blocks to replay".format(name, height, len(bc.chain) - 1 - height))
+    return bc
+
+
+class ChainNode(abc.ABC):
+    """
+    :param registry: Users.UserRegistry (or a RemoteRegistry) checked
+                     by the writes of the tx and nfts chains
+    """
+    name = None
+    module = None
+    nothing_to_mine = None
+    ops = ("chain", "pending", "mine", "add_block", "tip", "locate", "sync", "proof",
+           "job", "mining_status", "add_peers")
+
+    def __init__(self, registry=None):
+        self.registry = registry
+        self.peers = set()
+        self.bc = create_blockchain(self.name)
+        self.attach_indexes()
+        self.scheduler = Scheduler.MiningScheduler(self.bc, self.name, self.mine_block).start()
+        self.snapshotter = Snapshot.Snapshotter({self.name: self.bc}).start()
+
+    def attach_indexes(self):
+        pass
+
+    @abc.abstractmethod
+    def mine_block(self):
+        """
+        returns: (message, status code)
+        """
+
+    @abc.abstractmethod
+    def chain(self, request):
+        pass
+
+    @abc.abstractmethod
+    def add_block(self, request):
+        pass
+
+    def call(self, op, *args):
+        if op not in self.ops:
+            raise ValueError("Unknown operation {} of the {} chain".format(op, self.name))
+        return getattr(self, op)(*args)
+
+    def close(self):
+        self.snapshotter.save_all()
+
+    def pending(self):
+        return json.dumps(self.bc.unconfirmed_info.snapshot())
+
+    def mine(self):
+        """
+        Mining runs in the chain's scheduler; the reply points to the job.
+        """
+        if not self.bc.unconfirmed_info:
+            return self.nothing_to_mine, 400
+        job = self.scheduler.submit()
+        return Wire.json_response({"job": job["id"], "status_url": "/mining/jobs/{}".format(job["id"])}, 202)
+
+    def tip(self):
+        return Wire.json_response(Sync.tip(self.bc), 200)
+
+    def locate(self, request):
+        return Wire.json_response(*Sync.locate(self.bc, request))
+
+    def sync(self):
+        return Wire.json_response({"adopted": Sync.sync_chain(self.bc, self.peers, "/" + self.name)}, 200)
+
+    def proof(self, request):
+        """
+        Merkle inclusion proof of one entry of a block:
+        ?height=<block index>&index=<entry position> or &hash=<leaf hash>
+        Check it with `Merkle.verify_proof(leaf, proof, header["merkle_root"])`.
+        """
+        height = request.args.get("height", type=int)
+        tx_index = request.args.get("index", type=int)
+        tx_hash = request.args.get("hash")
+        if height is None or (tx_index is None and not tx_hash):
+            return "Invalid proof request", 400
+
+        data = self.bc.inclusion_proof(height, tx_index, tx_hash)
+        if data is None:
+            return "No such entry in a Merkle block", 404
+        return json.dumps(data)
+
+    def job(self, job_id):
+        return Scheduler.job_status(job_id)
+
+    def mining_status(self):
+        return self.scheduler.status()
+
+    def add_peers(self, peers):
+        self.peers.update(peers)
+
+
+class UsersNode(ChainNode):
+    name = "users"
+    nothing_to_mine = "No New Users"
+    ops = ChainNode.ops + ("new_user", "new_users", "user", "registered")
+
+    def attach_indexes(self):
+        Users.attach_indexes(self.bc)
+        self.registry = self.bc.indexes["registry"]
+
+    def mine_block(self):
+        return Users.mine_unconfirmed_users(self.bc, self.peers)
+
+    def chain(self, request):
+        return Users.get_users(self.bc, request)
+
+    def add_block(self, request):
+        return Users.users_add_block(self.bc, request)
+
+    def new_user(self, request):
+        data = Users.new_users(self.bc, request)
+        return Wire.json_response(data[0], data[1])
+
+    def new_users(self, request):
+        data = Users.new_users_bulk(self.bc, request)
+        if data[1] != 201:
+            return Wire.json_response(data[0], data[1])
+        return Response(data[0], status=201, mimetype=Wire.NDJSON_MIMETYPE)
+
+    def user(self, public_key):
+        return Wire.json_response(*Users.get_user(self.registry, public_key))
+
+    def registered(self, public_key):
+        return public_key in self.registry
+
+
+class TxNode(ChainNode):
+    name = "tx"
+    nothing_to_mine = "No transactions to mine"
+    ops = ChainNode.ops + ("new_transaction", "new_transactions", "address_history",
+                           "address_balance", "search")
+
+    def attach_indexes(self):
+        self.bc.op = os.path.join(config.UPLOAD_FOLDER, config.TRANSACTION_INDEX)
+        Transactions.attach_indexes(self.bc)
+
+    def mine_block(self):
+        return Transactions.mine_unconfirmed_tx(self.bc, self.peers)
+
+    def chain(self, request):
+        return Transactions.get_chain(self.bc, request)
+
+    def add_block(self, request):
+        return Transactions.tx_add_block(self.bc, request)
+
+    def new_transaction(self, request):
+        return Wire.json_response(*Transactions.new_transaction(self.bc, request, self.registry))
+
+    def new_transactions(self, request):
+        return Wire.json_response(*Transactions.new_transactions(self.bc, request, self.registry))
+
+    def address_history(self, address, request):
+        return Wire.json_response(*Transactions.get_history(self.bc, address, request))
+
+    def address_balance(self, address):
+        return Wire.json_response(*Transactions.get_balance(self.bc, address))
+
+    def search(self, request):
+        return Wire.json_response(*Transactions.search(self.bc, request))
+
+
+class NftNode(ChainNode):
+    name = "nfts"
+    nothing_to_mine = "No new nfts to mine"
+    ops = ChainNode.ops + ("new_file", "transfer", "balance")
+
+    def attach_indexes(self):
+        self.bc.op = os.path.join(config.UPLOAD_FOLDER, config.NFT_INDEX)
+        NFT.attach_indexes(self.bc)
+
+    def mine_block(self):
+        return NFT.mine_unconfirmed_nfts(self.bc, self.peers)
+
+    def chain(self, request):
+        return NFT.get_chain(self.bc, request)
+
+    def add_block(self, request):
+        return NFT.nft_add_block(self.bc, request)
+
+    def new_file(self, request):
+        return Wire.json_response(*NFT.new_file(self.bc, request, self.registry))
+
+    def transfer(self, request):
+        return Wire.json_response(*NFT.transfer(self.bc, request, self.registry))
+
+    def balance(self, owner):
+        return Wire.json_response(*NFT.balanceOf(self.bc, owner, self.registry))
+
+
+NODES = {"users": UsersNode, "tx": TxNode, "nfts": NftNode}
+
+
+class RequestData:
+    """
+    The parts of a Flask request the chain handlers read, in a form
+    which can be sent to a worker. Uploaded files go to temporary files
+    which the worker reads and removes.
+    """
+
+    def __init__(self, request):
+        self.mimetype = request.mimetype
+        self.args = request.args
+        self.form = request.form
+        self.accept_mimetypes = request.accept_mimetypes
+        self.host_url = request.host_url
+        self.__files = {}
+        for name, file in request.files.items():
+            fd, path = tempfile.mkstemp(prefix="upload-")
+            with os.fdopen(fd, "wb") as f:
+                file.save(f)
+            self.__files[name] = (path, file.filename)
+        self.__data, self.__json, self.__json_error = b"", None, None
+        if not self.__files and not self.form:
+            self.__data = request.get_data()
+            try:
+                self.__json = request.get_json()
+            except HTTPException as e:
+                self.__json_error = e
+        self.__opened = []
+
+    def get_json(self, silent=False):
+        if self.__json_error is not None and not silent:
+            raise self.__json_error
+        return self.__json
+
+    def get_data(self):
+        return self.__data
+
+    @property
+    def files(self):
+        files = {}
+        for name, (path, filename) in self.__files.items():
+            stream = open(path, "rb")
+            self.__opened.append(stream)
+            files[name] = FileStorage(stream, filename)
+        return files
+
+    def close(self):
+        for stream in self.__opened:
+            stream.close()
+        for path, _ in self.__files.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class WorkerError(Exception):
+    pass
+
+
+class ChainClient:
+    """
+    Calls the ChainNode of a worker process over `conn`, from any
+    number of threads.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.__ids = itertools.count()
+        self.__calls = {}
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__reader = threading.Thread(target=self.__read, name="chain-client", daemon=True)
+        self.__reader.start()
+
+    def call(self, op, *args):
+        args = tuple(RequestData(arg) if isinstance(arg, Request) else arg for arg in args)
+        call_id, replies = next(self.__ids), queue.Queue()
+        with self.__lock:
+            self.__calls[call_id] = replies
+        try:
+            with self.__send_lock:
+                self.conn.send((call_id, op, args))
+        except OSError as e:
+            self.__forget(call_id)
+            raise WorkerError("The {} worker is gone: {!r}".format(op, e))
+
+        kind, value = replies.get()
+        if kind == "head":
+            status, headers = value
+            return Response(self.__body(call_id, replies), status=status, headers=headers)
+        self.__forget(call_id)
+        if kind == "error":
+            raise value
+        return value
+
+    def __body(self, call_id, replies):
+        try:
+            while True:
+                kind, value = replies.get()
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise value
+                yield value
+        finally:
+            # Also when the client went away: later chunks are dropped
+            self.__forget(call_id)
+
+    def __forget(self, call_id):
+        with self.__lock:
+            self.__calls.pop(call_id, None)
+
+    def __read(self):
+        while True:
+            try:
+                call_id, kind, value = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.__lock:
+                replies = self.__calls.get(call_id)
+            if replies is not None:
+                replies.put((kind, value))
+        with self.__lock:
+            calls, self.__calls = list(self.__calls.values()), {}
+        for replies in calls:
+            replies.put(("error", WorkerError("The worker closed its pipe")))
+
+    def close(self):
+        # The worker would not see the pipe close while our reader
+        # thread is waiting on it
+        try:
+            with self.__send_lock:
+                self.conn.send((None, "stop", ()))
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class LocalChain:
+    """
+    ChainClient counterpart for a ChainNode in this process.
+    """
+
+    def __init__(self, node):
+        self.node = node
+
+    def call(self, op, *args):
+        return self.node.call(op, *args)
+
+    def close(self):
+        self.node.close()
+
+
+class RemoteRegistry:
+    """
+    `public_key in registry` answered by the users worker. Users are
+    never unregistered, so registered keys are remembered.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.__known = set()
+
+    def __contains__(self, public_key):
+        if public_key in self.__known:
+            return True
+        if self.client.call("registered", public_key):
+            self.__known.add(public_key)
+            return True
+        return False
+
+
+def _reply(conn, send_lock, call_id, kind, value):
+    try:
+        with send_lock:
+            conn.send((call_id, kind, value))
+    except OSError:
+        pass
+    except Exception as e:
+        # e.g. an exception which cannot be pickled
+        with send_lock:
+            conn.send((call_id, "error", WorkerError(repr(e))))
+
+
+def _run_call(node, conn, send_lock, call_id, op, args):
+    try:
+        result = node.call(op, *args)
+        if isinstance(result, Response):
+            _reply(conn, send_lock, call_id, "head", (result.status_code, list(result.headers.items())))
+            for chunk in result.iter_encoded():
+                _reply(conn, send_lock, call_id, "chunk", chunk)
+            _reply(conn, send_lock, call_id, "end", None)
+        else:
+            _reply(conn, send_lock, call_id, "result", result)
+    except Exception as e:
+        _reply(conn, send_lock, call_id, "error", e)
+    finally:
+        for arg in args:
+            if isinstance(arg, RequestData):
+                arg.close()
+
+
+def _serve_pipe(node, conn, pool):
+    send_lock = threading.Lock()
+    while True:
+        try:
+            call_id, op, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        if op == "stop":
+            return
+        pool.submit(_run_call, node, conn, send_lock, call_id, op, args)
+
+
+def _worker(name, conns, users_conn, position, inherited):
+    """
+    Worker process of one chain. conns[0] is the front-end's pipe; the
+    users worker also serves the pipes of the other workers.
+    :param inherited: pipe ends of other processes, closed here
+    """
+    for conn in inherited:
+        conn.close()
+    Scheduler.number_jobs(position + 1, len(CHAINS))
+    registry = RemoteRegistry(ChainClient(users_conn)) if users_conn is not None else None
+    startup = time.perf_counter()
+    gc.disable()
+    node = NODES[name](registry)
+    gc.freeze()
+    gc.enable()
+    print("{}: ready in {:.2f}s (pid {})".format(name, time.perf_counter() - startup, os.getpid()))
+
+    pool = ThreadPoolExecutor(config.WORKER_THREADS, thread_name_prefix=name)
+    for conn in conns[1:]:
+        threading.Thread(target=_serve_pipe, args=(node, conn, pool), daemon=True).start()
+    _serve_pipe(node, conns[0], pool)
+    node.close()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def start(mode=None):
+    """
+    Starts the chains of the node.
+    returns: {chain name: ChainClient or LocalChain}
+    """
+    mode = mode or config.NODE_RUNTIME
+    startup = time.perf_counter()
+    if mode == "threads":
+        gc.disable()
+        users = UsersNode()
+        chains = {"users": LocalChain(users),
+                  "tx": LocalChain(TxNode(users.registry)),
+                  "nfts": LocalChain(NftNode(users.registry))}
+        gc.freeze()
+        gc.enable()
+        atexit.register(stop, chains, [])
+    elif mode == "processes":
+        # fork: the workers must not import app.py again
+        context = multiprocessing.get_context("fork")
+        pipes = {name: context.Pipe() for name in CHAINS}
+        users_links = {name: context.Pipe() for name in CHAINS if name != "users"}
+        workers = []
+        for position, name in enumerate(CHAINS):
+            if name == "users":
+                conns, users_conn = [pipes[name][1]] + [link[0] for link in users_links.values()], None
+            else:
+                conns, users_conn = [pipes[name][1]], users_links[name][1]
+            # A worker holding the pipe of another one would keep it from
+            # seeing the front-end close it
+            inherited = [conn for pair in list(pipes.values()) + list(users_links.values())
+                         for conn in pair if conn not in conns and conn is not users_conn]
+            worker = context.Process(target=_worker, args=(name, conns, users_conn, position, inherited),
+                                     name="chain-" + name)
+            worker.start()
+            workers.append(worker)
+        for _, back in pipes.values():
+            back.close()
+        for link in users_links.values():
+            link[0].close()
+            link[1].close()
+        chains = {name: ChainClient(pipes[name][0]) for name in CHAINS}
+        atexit.register(stop, chains, workers)
+    else:
+        raise ValueError("Unknown node runtime: {}".format(mode))
+    print("Chains ready in {:.2f}s ({})".format(time.perf_counter() - startup, mode))
+    return chains
+
+
+def stop(chains, workers, timeout=30):
+    """
+    Closes the chains: workers write their snapshots and exit.
+    """
+    for chain in chains.values():
+        chain.close()
+    for worker in workers:
+        worker.join(timeout)
+        if worker.is_alive():
+            worker.terminate()
@@ -0,0 +1,151 @@
+"""
+Background mining.
+
+Every chain gets a MiningScheduler with its own thread, so a proof of
+work on one chain never holds up the others (with the parallel miner
+each chain also has its own process pool). A scheduler starts a
+mining job by itself once the chain has MINING_BLOCK_SIZE pending
+entries or its oldest pending entry is MINING_MAX_AGE seconds old,
+and GET /*/mine only queues a job and returns its id.
+
+Job status, as served by GET /mining/jobs/<id>:
+    {"id", "chain", "trigger": "request" | "size" | "age",
+     "status": "queued" | "running" | "done" | "failed",
+     "submitted", "started", "finished", "result": [message, status code]}
+"""
+
+import itertools
+import threading
+import time
+
+from Blockchain import Blockchain
+import config
+
+_job_ids = itertools.count(1)
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def number_jobs(first, step=1):
+    """
+    Restarts job ids at `first`, counting in `step`s, so the ids of
+    several processes (see Runtime.py) do not collide.
+    """
+    global _job_ids
+    _job_ids = itertools.count(first, step)
+
+
+def job_status(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+def _new_job(chain, trigger):
+    job = {"id": next(_job_ids), "chain": chain, "trigger": trigger, "status": "queued",
+           "submitted": time.time(), "started": None, "finished": None, "result": None}
+    with _jobs_lock:
+        _jobs[job["id"]] = job
+        while len(_jobs) > config.MINING_JOB_HISTORY:
+            del _jobs[next(iter(_jobs))]
+    return job
+
+
+def _update_job(job, **fields):
+    with _jobs_lock:
+        job.update(fields)
+
+
+class MiningScheduler:
+    """
+    :param bc: the chain to mine
+    :param name: chain name used in job records, e.g. "tx"
+    :param mine: called to mine a block (e.g. with consensus and
+                 announcement); returns (message, status code)
+    :param block_size: pending entries which trigger a block
+    :param max_age: seconds a pending entry may wait for a block
+    """
+
+    def __init__(self, bc: Blockchain, name, mine, block_size=None, max_age=None):
+        self.bc = bc
+        self.name = name
+        self.mine = mine
+        self.block_size = block_size or config.MINING_BLOCK_SIZE
+        self.max_age = config.MINING_MAX_AGE if max_age is None else max_age
+        self.__queue = []
+        self.__current = None
+        self.__pending_since = None
+        self.__wakeup = threading.Condition()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name="mining-" + self.name,
+                                             daemon=True)
+            self.__thread.start()
+        return self
+
+    def submit(self):
+        """
+        Queues a mining job, or returns the one already waiting.
+        """
+        with self.__wakeup:
+            if self.__queue:
+                return self.__queue[0]
+            job = _new_job(self.name, "request")
+            self.__queue.append(job)
+            self.__wakeup.notify()
+            return job
+
+    def status(self):
+        with self.__wakeup:
+            queued = [job["id"] for job in self.__queue]
+            current = self.__current["id"] if self.__current is not None else None
+            since = self.__pending_since
+        return {"chain": self.name,
+                "pending": len(self.bc.unconfirmed_info),
+                "pending_age": time.time() - since if since is not None else None,
+                "running": current,
+                "queued": queued}
+
+    def __due(self, now):
+        """
+        Returns the trigger of an automatic job, or None.
+        """
+        pending = len(self.bc.unconfirmed_info)
+        if not pending:
+            self.__pending_since = None
+            return None
+        if self.__pending_since is None:
+            self.__pending_since = now
+        if pending >= self.block_size:
+            return "size"
+        if now - self.__pending_since >= self.max_age:
+            return "age"
+        return None
+
+    def __next_job(self):
+        with self.__wakeup:
+            while True:
+                if self.__queue:
+                    self.__current = self.__queue.pop(0)
+                    return self.__current
+                trigger = self.__due(time.time())
+                if trigger is not None:
+                    self.__current = _new_job(self.name, trigger)
+                    return self.__current
+                self.__wakeup.wait(config.MINING_POLL_INTERVAL)
+
+    def __run(self):
+        while True:
+            job = self.__next_job()
+            _update_job(job, status="running", started=time.time())
+            try:
+                result = self.mine()
+                _update_job(job, status="done", result=list(result))
+            except Exception as e:
+                _update_job(job, status="failed", result=[repr(e), 500])
+            _update_job(job, finished=time.time())
+            with self.__wakeup:
+                self.__current = None
+                self.__pending_since = None
@@ -0,0 +1,358 @@
+"""
+Search over the sealed transactions of the tx chain.
+
+Every sealed transaction gets a document id (its rank in the chain) and
+the index keeps, per document id, its (height, position) and its value
+and timestamp, plus:
+* an inverted index: lowercase word of the description -> sorted ids
+* ids sorted by value and by timestamp, for range queries; new ids
+  are merged in lazily, by queries and saves
+
+A query starts from its most selective part (the shortest posting
+list, else a value or time range) and filters the candidates on the
+rest, newest first, so it touches the matching documents only. The
+transactions themselves are read back from the chain.
+
+The index is saved every SEARCH_SAVE_EVERY blocks with the height and
+hash of the last indexed block; on boot it is loaded and only the
+blocks sealed after that one are indexed. Those saves run on a thread
+of their own, so neither add_block nor a rebuild waits for them.
+The file is JSON, with the id and key columns as base64 of their raw
+arrays, so loading it cannot run code; a file written with another
+byte order or int size is ignored.
+
+Blocks are indexed under the chain lock while queries come from
+request threads; both take the index's `lock`, which also covers the
+merges of the sorted ids.
+"""
+
+from array import array
+import base64
+from bisect import bisect_left, bisect_right
+import json
+import math
+import re
+import sys
+import threading
+
+import config
+from IndexStore import atomic_write
+
+_WORD = re.compile(r"\w+")
+
+
+def words(text):
+    return set(_WORD.findall(str(text).lower()))
+
+
+def _timestamp(tx_data, block):
+    """
+    Finite timestamp of a transaction, else of its block, else 0.
+    """
+    for timestamp in (tx_data.get("timestamp"), block.timestamp):
+        try:
+            timestamp = float(timestamp)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        if math.isfinite(timestamp):
+            return timestamp
+    return 0.0
+
+
+def _pack(values):
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+
+def _unpack(typecode, text):
+    values = array(typecode)
+    values.frombytes(base64.b64decode(text, validate=True))
+    return values
+
+
+def _layout():
+    return [sys.byteorder, array("l").itemsize]
+
+
+def _contains(ids, doc):
+    i = bisect_left(ids, doc)
+    return i < len(ids) and ids[i] == doc
+
+
+class _SortedIds:
+    """
+    Document ids sorted by a per-document key (value or timestamp).
+    Ids added since the last merge form an unsorted tail, which queries
+    scan and which is merged in once it grows past 1/16 of the ids.
+    Not thread-safe: used under the SearchIndex lock.
+    """
+
+    def __init__(self, keys, ids=(), sorted_keys=()):
+        self.keys = keys
+        self.ids = list(ids)
+        self.sorted_keys = list(sorted_keys)
+
+    def state(self):
+        """
+        Merged ids and keys, as saved with the index.
+        """
+        self.__merge()
+        return array("l", self.ids), array("d", self.sorted_keys)
+
+    def __merge(self):
+        if len(self.ids) == len(self.keys):
+            return
+        self.ids.extend(range(len(self.ids), len(self.keys)))
+        # The ids are mostly in order already, which timsort merges in O(n)
+        self.ids.sort(key=self.keys.__getitem__)
+        self.sorted_keys = [self.keys[i] for i in self.ids]
+
+    def between(self, low, high):
+        """
+        returns: ids with low <= key <= high (a bound may be None), unordered
+        """
+        if (len(self.keys) - len(self.ids)) * 16 > len(self.ids) + 1024:
+            self.__merge()
+        first = 0 if low is None else bisect_left(self.sorted_keys, low)
+        last = len(self.ids) if high is None else bisect_right(self.sorted_keys, high)
+        tail = [i for i in range(len(self.ids), len(self.keys))
+                if (low is None or self.keys[i] >= low) and (high is None or self.keys[i] <= high)]
+        return self.ids[first:last] + tail
+
+    def truncate(self, count):
+        """
+        Drops the ids from `count` on, before their keys are dropped.
+        """
+        for doc in range(len(self.ids) - 1, count - 1, -1):
+            key = self.keys[doc]
+            i = self.ids.index(doc, bisect_left(self.sorted_keys, key), bisect_right(self.sorted_keys, key))
+            del self.ids[i]
+            del self.sorted_keys[i]
+
+
+class SearchIndex:
+    """
+    :param path: file the index is saved to
+    :param value_of: numeric value of a transaction
+    """
+
+    def __init__(self, path, value_of):
+        self.path = path
+        self.value_of = value_of
+        self.chain = None
+        self.lock = threading.RLock()
+        # Keeps the saves in order, see `save`
+        self.__save_lock = threading.Lock()
+        self.__save_due = threading.Event()
+        self.__saver = None
+        self.__reset()
+
+    def __reset(self):
+        self.heights = array("q")
+        self.positions = array("l")
+        self.values = array("d")
+        self.timestamps = array("d")
+        self.postings = {}
+        self.height = -1
+        self.saved_height = -1
+        self.__by_value = _SortedIds(self.values)
+        self.__by_time = _SortedIds(self.timestamps)
+
+    def __len__(self):
+        return len(self.heights)
+
+    def save(self):
+        """
+        Copies the index under the lock and writes it outside of it.
+        """
+        with self.__save_lock:
+            with self.lock:
+                if self.height < 0:
+                    return
+                height = self.height
+                block_hash = self.chain[height].hash
+                columns = {"heights": self.heights[:], "positions": self.positions[:],
+                           "values": self.values[:], "timestamps": self.timestamps[:]}
+                postings = {word: ids[:] for word, ids in self.postings.items()}
+                by_value, by_time = self.__by_value.state(), self.__by_time.state()
+            data = {name: _pack(column) for name, column in columns.items()}
+            data.update(height=height, hash=block_hash, layout=_layout(),
+                        postings={word: _pack(ids) for word, ids in postings.items()},
+                        by_value=[_pack(column) for column in by_value],
+                        by_time=[_pack(column) for column in by_time])
+            atomic_write(self.path, json.dumps(data, separators=(",", ":")).encode())
+            self.saved_height = height
+
+    def __save_soon(self):
+        """
+        Wakes the thread which saves the index, started on first use.
+        """
+        if self.__saver is None:
+            self.__saver = threading.Thread(target=self.__run_saver, name="search-save", daemon=True)
+            self.__saver.start()
+        self.__save_due.set()
+
+    def __run_saver(self):
+        while True:
+            self.__save_due.wait()
+            self.__save_due.clear()
+            try:
+                self.save()
+            except Exception as e:
+                print("Search index save failed:", repr(e))
+
+    def __load(self, chain):
+        """
+        Loads the saved index if it matches `chain`.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = json.loads(f.read())
+            if data["layout"] != _layout():
+                return False
+            height = data["height"]
+            if not (isinstance(height, int) and 0 <= height < len(chain)) or chain[height].hash != data["hash"]:
+                return False
+            columns = [_unpack(typecode, data[name]) for name, typecode in
+                       (("heights", "q"), ("positions", "l"), ("values", "d"), ("timestamps", "d"))]
+            postings = {word: _unpack("l", ids) for word, ids in data["postings"].items()}
+            by_value, by_time = ((_unpack("l", ids), _unpack("d", keys)) for ids, keys in
+                                 (data["by_value"], data["by_time"]))
+        except (OSError, KeyError, TypeError, ValueError):
+            # ValueError: not JSON, not base64 or a torn array
+            return False
+        if len({len(column) for column in columns}) != 1:
+            return False
+        self.heights, self.positions, self.values, self.timestamps = columns
+        self.postings = postings
+        self.height = self.saved_height = height
+        self.__by_value = _SortedIds(self.values, *by_value)
+        self.__by_time = _SortedIds(self.timestamps, *by_time)
+        return True
+
+    def rebuild(self, chain):
+        with self.lock:
+            self.chain = chain
+            if not self.__load(chain):
+                self.__reset()
+            for height in range(self.height + 1, len(chain)):
+                self.__add_block(chain[height])
+        if self.height != self.saved_height and self.height >= 0:
+            self.__save_soon()
+
+    def __add_block(self, block):
+        for position, tx_data in enumerate(block.info):
+            doc = len(self.heights)
+            self.heights.append(block.index)
+            self.positions.append(position)
+            self.values.append(self.value_of(tx_data))
+            self.timestamps.append(_timestamp(tx_data, block))
+            for word in words(tx_data.get("description", "")):
+                ids = self.postings.get(word)
+                if ids is None:
+                    ids = self.postings[word] = array("l")
+                ids.append(doc)
+        self.height = block.index
+
+    def apply_block(self, block):
+        with self.lock:
+            self.__add_block(block)
+        if self.height - self.saved_height >= config.SEARCH_SAVE_EVERY:
+            self.__save_soon()
+
+    def remove_block(self, block):
+        with self.lock:
+            count = bisect_left(self.heights, block.index)
+            self.__by_value.truncate(count)
+            self.__by_time.truncate(count)
+            for tx_data in block.info:
+                for word in words(tx_data.get("description", "")):
+                    ids = self.postings.get(word)
+                    while ids and ids[-1] >= count:
+                        ids.pop()
+                    if ids is not None and not ids:
+                        del self.postings[word]
+            for column in (self.heights, self.positions, self.values, self.timestamps):
+                del column[count:]
+            self.height = block.index - 1
+            # The saved index ends in a dropped block: save again soon
+            if self.saved_height > self.height:
+                self.saved_height = -1
+
+    def apply_pending(self, info):
+        pass
+
+    def search(self, q=None, min_value=None, max_value=None, since=None, until=None,
+               before=None, limit=None):
+        """
+        Document ids of the matching transactions, newest first.
+        Hold `lock` until their transactions are read, as a reorg
+        renumbers them.
+        :param q: words which must all occur in the description
+        :param before: only ids below it (the cursor of the next page)
+        """
+        with self.lock:
+            limit = limit or config.SEARCH_PAGE_LIMIT
+            if q:
+                postings = sorted((self.postings.get(word, ()) for word in words(q)), key=len)
+                candidates, others = (postings[0], postings[1:]) if postings else ((), [])
+            else:
+                candidates, others = range(len(self)), []
+                ranges = []
+                if min_value is not None or max_value is not None:
+                    ranges.append(self.__by_value.between(min_value, max_value))
+                if since is not None or until is not None:
+                    ranges.append(self.__by_time.between(since, until))
+                narrowest = min(ranges, key=len, default=None)
+                # A wide range is cheaper to filter while scanning newest first
+                # than to sort; that scan stops after `limit` matches
+                if narrowest is not None and len(narrowest) * 8 <= len(self):
+                    candidates = sorted(narrowest)
+
+            end = len(candidates) if before is None else bisect_left(candidates, before)
+            matches = []
+            for i in range(end - 1, -1, -1):
+                doc = candidates[i]
+                if min_value is not None and self.values[doc] < min_value:
+                    continue
+                if max_value is not None and self.values[doc] > max_value:
+                    continue
+                if since is not None and self.timestamps[doc] < since:
+                    continue
+                if until is not None and self.timestamps[doc] > until:
+                    continue
+                if not all(_contains(ids, doc) for ids in others):
+                    continue
+                matches.append(doc)
+                if len(matches) == limit:
+                    break
+            return matches
+
+    def transaction(self, doc):
+        """
+        returns: (height, position, transaction) of a document id
+        """
+        height, position = self.heights[doc], self.positions[doc]
+        return height, position, self.chain[height].info[position]
+
+
+def search_request(index: SearchIndex, request):
+    """
+    GET /tx/search?q=&min_value=&max_value=&since=&until=&limit=&cursor=
+    Matches come newest first; next_cursor continues after the last one.
+    """
+    args = request.args
+    limit = max(1, min(args.get("limit", config.SEARCH_PAGE_LIMIT, type=int), config.SEARCH_PAGE_LIMIT))
+    with index.lock:
+        matches = index.search(q=args.get("q"),
+                               min_value=args.get("min_value", type=float),
+                               max_value=args.get("max_value", type=float),
+                               since=args.get("since", type=float),
+                               until=args.get("until", type=float),
+                               before=args.get("cursor", type=int),
+                               limit=limit)
+        results = []
+        for doc in matches:
+            height, position, tx_data = index.transaction(doc)
+            results.append({"height": height, "position": position, "tx": tx_data})
+    return {"results": results,
+            "next_cursor": matches[-1] if len(matches) == limit else None}
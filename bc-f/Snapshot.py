@@ -0,0 +1,148 @@
+"""
+Snapshots of a chain's derived state, for fast restarts.
+
+Blocks are kept by the BlockStore, but the indexes (see
+`Blockchain.register_index`) would have to be rebuilt from every block
+and the mempool would be lost, along with the changes its entries made
+to the index file (`Blockchain.bc_idx`), which is only saved when a
+block is mined. A snapshot holds the tip, the index states, the mempool
+and those unsaved changes (`Blockchain.snapshot`); on startup it is
+read through `mmap` and only the blocks after its tip are replayed.
+
+<folder>/<chain>.snap   [magic 8B][length u64][crc32 u32][JSON]
+
+The payload is plain JSON (the index states are in JSON types, see
+`Blockchain.register_index`), so loading a snapshot cannot run code.
+The snapshot is taken under the chain lock and encoded after it; parts
+of a state which are too large to copy under the lock can be frozen
+instead, as objects with a `to_json()` method called by the encoding.
+
+Snapshots are written to a temporary file which then replaces the old
+one, so a crash leaves either snapshot intact. A snapshot which is
+torn, fails its checksum or does not match the chain is ignored, and
+the indexes are rebuilt from the blocks.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import config
+from IndexStore import atomic_write
+
+# Version 1 snapshots were pickles, which are ignored
+_MAGIC = b"BCSNAP2\n"
+_HEADER = struct.Struct(">8sQI")
+
+
+def snapshot_path(name, folder=None):
+    return os.path.join(folder or config.SNAPSHOT_FOLDER, name + ".snap")
+
+
+def _to_json(obj):
+    if not hasattr(obj, "to_json"):
+        raise TypeError("{} is not JSON serializable".format(type(obj).__name__))
+    return obj.to_json()
+
+
+def save(bc, path):
+    """
+    Writes the snapshot of `bc` to `path`.
+    returns: height of the snapshot's tip
+    """
+    snapshot = bc.snapshot()
+    payload = json.dumps(snapshot, separators=(",", ":"), default=_to_json).encode()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write(path, _HEADER.pack(_MAGIC, len(payload), zlib.crc32(payload)) + payload)
+    return snapshot["height"]
+
+
+def load(path):
+    """
+    returns: the snapshot at `path`, or None if there is no usable one
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, length, crc = _HEADER.unpack_from(data, 0)
+            if magic != _MAGIC or _HEADER.size + length > len(data):
+                return None
+            with memoryview(data)[_HEADER.size:_HEADER.size + length] as payload:
+                if zlib.crc32(payload) != crc:
+                    return None
+                try:
+                    snapshot = json.loads(bytes(payload))
+                except ValueError:
+                    return None
+    if not (isinstance(snapshot, dict) and isinstance(snapshot.get("height"), int) and
+            isinstance(snapshot.get("indexes"), dict) and isinstance(snapshot.get("mempool"), list)):
+        return None
+    unsaved = snapshot.get("bc_idx")
+    if unsaved is not None and not (isinstance(unsaved, dict) and isinstance(unsaved.get("mutations"), str)):
+        return None
+    return snapshot
+
+
+def restore(bc, path):
+    """
+    Restores `bc` from the snapshot at `path`, before its indexes are
+    registered (see `Blockchain.restore`).
+    returns: height of the snapshot's tip, or None if none was used
+    """
+    snapshot = load(path)
+    if snapshot is None or not bc.restore(snapshot):
+        return None
+    return snapshot["height"]
+
+
+class Snapshotter:
+    """
+    Writes a snapshot of every chain whose tip or mempool changed, every
+    `interval` seconds, from a background thread.
+    :param chains: {name: Blockchain}
+    """
+
+    def __init__(self, chains, folder=None, interval=None):
+        self.chains = chains
+        self.folder = folder or config.SNAPSHOT_FOLDER
+        self.interval = interval or config.SNAPSHOT_INTERVAL
+        self.__written = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name="snapshots", daemon=True)
+            self.__thread.start()
+        return self
+
+    def save_all(self):
+        """
+        returns: {name: height} of the snapshots written
+        """
+        written = {}
+        with self.__lock:
+            for name, bc in self.chains.items():
+                version = (len(bc.chain), bc.last_block.hash, len(bc.unconfirmed_info))
+                if self.__written.get(name) == version:
+                    continue
+                written[name] = save(bc, snapshot_path(name, self.folder))
+                self.__written[name] = version
+        return written
+
+    def __run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save_all()
+            except Exception as e:
+                print("Snapshot failed:", repr(e))
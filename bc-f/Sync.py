@@ -0,0 +1,147 @@
+"""
+Header-first chain sync between nodes.
+
+1. GET  /*/tip     -> {"height", "hash"} of the peer's last block and
+   the "work" of its chain (hex, see Difficulty.py). Peers whose chain
+   has no more work than ours are skipped.
+2. POST /*/locate  with {"locator": [[height, hash], ...]}, hashes of our
+   chain at exponentially spaced heights from the tip down to genesis.
+   The peer answers with the highest of them that is on its chain.
+3. GET  /*/chain?cursor=<fork + 1>, page by page, and validate only
+   those blocks against our block at the fork point before replacing
+   our blocks above it, if they carry more work.
+
+The cost of a sync is proportional to how far the chains diverge,
+not to their length.
+"""
+
+import requests
+
+from Blockchain import Blockchain, target_history
+import Difficulty
+import Peers
+import Validator
+import Wire
+
+# Locator entries taken one by one below the tip before the steps double
+_DENSE_ENTRIES = 10
+# What a peer which is down or answers nonsense (a missing key, a bad
+# block or height) raises during a sync
+_PEER_ERRORS = (requests.RequestException, KeyError, ValueError, TypeError, AttributeError)
+
+
+def block_locator(bc: Blockchain):
+    chain = bc.chain
+    heights, step, height = [], 1, len(chain) - 1
+    while height > 0:
+        heights.append(height)
+        if len(heights) >= _DENSE_ENTRIES:
+            step *= 2
+        height -= step
+    heights.append(0)
+    return [[height, chain[height].hash] for height in heights]
+
+
+def find_fork(bc: Blockchain, locator):
+    """
+    Returns the highest locator height at which our chain has the
+    same block, or -1 if none (e.g. a different genesis block).
+    Malformed entries are skipped.
+    """
+    chain = bc.chain
+    entries = [entry for entry in locator
+               if isinstance(entry, (list, tuple)) and len(entry) == 2 and isinstance(entry[0], int)]
+    for height, block_hash in sorted(entries, key=lambda entry: entry[0], reverse=True):
+        if 0 <= height < len(chain) and chain[height].hash == block_hash:
+            return height
+    return -1
+
+
+def validate_blocks(bc: Blockchain, fork_height, blocks):
+    """
+    Checks that `blocks` form a valid continuation of our block at
+    `fork_height` (and contain our checkpoint, if they reach over it).
+    """
+    checkpoint = bc.checkpoint
+    if checkpoint is None or fork_height >= checkpoint[0]:
+        checkpoint = None
+    elif checkpoint[0] < len(bc.chain):
+        # The peer forked below our checkpoint block
+        return False
+    return Validator.validate_chain(blocks, start_height=fork_height + 1,
+                                    previous_hash=bc.chain[fork_height].hash,
+                                    history=target_history(bc.chain, fork_height + 1),
+                                    checkpoint=checkpoint)
+
+
+def sync_chain(bc: Blockchain, peers, prefix):
+    """
+    Adopts the valid chain with the most work among `peers`. The tips
+    are asked for concurrently; peers are then tried from the most
+    work down.
+    :param prefix: URL prefix of the chain's endpoints, e.g. "/tx"
+    returns: number of blocks taken over from peers
+    """
+    tips = Peers.fan_out([node.rstrip("/") for node in peers],
+                         lambda node: _fetch_tip("{}{}/tip".format(node, prefix)))
+    adopted = 0
+    for node, work in sorted(((node, _tip_work(tip)) for node, tip in tips.items()),
+                             key=lambda item: item[1], reverse=True):
+        if work <= bc.work:
+            break
+        try:
+            adopted += _sync_from(bc, node, prefix)
+        except _PEER_ERRORS as e:
+            print("Sync from {} failed: {!r}".format(node, e))
+            continue
+    return adopted
+
+
+def _fetch_tip(url):
+    try:
+        return Peers.get(url).json()
+    except ValueError:
+        # Not JSON
+        return None
+
+
+def _tip_work(tip):
+    try:
+        return int(tip["work"], 16)
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def _sync_from(bc: Blockchain, node, prefix):
+    response = Peers.post("{}{}/locate".format(node, prefix),
+                          json={"locator": block_locator(bc)})
+    fork_height = response.json()["fork_height"]
+    if not isinstance(fork_height, int) or fork_height >= len(bc.chain):
+        raise ValueError("Invalid fork height {!r}".format(fork_height))
+    if fork_height < 0:
+        return 0
+
+    blocks = list(Wire.fetch_blocks("{}{}/chain".format(node, prefix), fork_height + 1))
+    # Targets are only checked by the validation, so this is an upper
+    # bound, enough to skip a fork with less work
+    if Difficulty.chain_work(blocks) <= bc.work_above(fork_height):
+        return 0
+    report = validate_blocks(bc, fork_height, blocks)
+    if not report:
+        return 0
+    report.remember_hashes(blocks)
+    if bc.replace_from(fork_height, blocks):
+        return len(blocks)
+    return 0
+
+
+def tip(bc: Blockchain):
+    with bc.lock:
+        return {"height": len(bc.chain) - 1, "hash": bc.last_block.hash, "work": "%x" % bc.work}
+
+
+def locate(bc: Blockchain, request):
+    locator = (request.get_json() or {}).get("locator")
+    if not isinstance(locator, list):
+        return {"error": "Invalid locator"}, 400
+    return {"fork_height": find_fork(bc, locator), **tip(bc)}, 200
@@ -7,71 +7,428 @@ TRANSACTION_INDEX:
         ...}
 """
 
+from bisect import bisect_left
+import itertools
+import math
+
 from Blockchain import Blockchain
 import time
 import json
-from Block import Block
-import requests
-import random
-import hashlib
+import config
+from Mempool import MempoolFull
+from Merkle import leaf_hash
+import os
+import threading
+import Search
+import Peers
+import Sync
+import Users
+import Wire
 
 
-def new_transaction(tx: Blockchain, request):
-    tx_data = request.get_json()
+def amount(tx_data):
+    """
+    Numeric value of a transaction; values which are not finite numbers
+    (including NaN and infinities) count 0.
+    """
+    value = tx_data.get("value")
+    try:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            value = float(value)
+        return value if math.isfinite(value) else 0
+    except (TypeError, ValueError, OverflowError):
+        # OverflowError: an int too large for a float
+        return 0
+
+
+def _finite(value):
+    """
+    Whether a submitted value is not NaN or an infinity, given as a
+    number or a numeric string.
+    """
+    try:
+        return math.isfinite(float(value))
+    except (TypeError, ValueError):
+        # Not a number at all, which amount() counts as 0
+        return True
+    except OverflowError:
+        return False
+
+
+class AddressHistory:
+    """
+    Transactions of one address in one role, ordered by
+    (height, position in the block).
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.txs = []
+
+    def append(self, key, tx_data):
+        self.keys.append(key)
+        self.txs.append(tx_data)
+
+    def page(self, start, limit):
+        """
+        returns: ([(key, tx), ...] from key `start` on, next key or None)
+        """
+        first = bisect_left(self.keys, start)
+        last = min(first + limit, len(self.keys))
+        entries = list(zip(self.keys[first:last], self.txs[first:last]))
+        return entries, self.keys[last] if last < len(self.keys) else None
+
+    def flat_keys(self, height):
+        """
+        Keys up to block `height`, as [height, position, height, ...].
+        """
+        return list(itertools.chain.from_iterable(self.keys[:bisect_left(self.keys, (height + 1,))]))
+
+    @classmethod
+    def from_flat_keys(cls, flat, txs):
+        """
+        :param txs: the transactions by key
+        """
+        history = cls()
+        pairs = iter(flat)
+        history.keys = list(zip(pairs, pairs))
+        history.txs = list(map(txs.__getitem__, history.keys))
+        return history
+
+    def copy(self):
+        history = AddressHistory()
+        history.keys, history.txs = self.keys[:], self.txs[:]
+        return history
+
+
+class _FrozenHistories:
+    """
+    The histories of an AddressIndex as of block `height`, encoded (see
+    Snapshot.py) after the chain lock is released. Histories are only
+    appended to, and a rebuild replaces them all, so their entries up
+    to `height` stay as they are meanwhile. (A reorg below `height`
+    cuts them, but then the snapshot's tip is no longer on the chain
+    and the snapshot is not restored.)
+
+    JSON: address -> {"sent": [keys, transactions], "received": keys,
+    "all": keys}, keys flattened to [height, position, height, ...].
+    Every transaction is kept once, with the "sent" history of its
+    sender. Empty histories, and "all" when it equals one of the
+    others, are left out.
+    :param stored: histories still in that form, see AddressIndex.load_state
+    """
+
+    def __init__(self, histories, stored, height):
+        self.histories = histories
+        self.stored = stored
+        self.height = height
+
+    def to_json(self):
+        state = dict(self.stored)
+        for address, histories in self.histories.items():
+            roles = {role: histories[role].flat_keys(self.height) for role in AddressIndex.ROLES}
+            if roles["sent"]:
+                roles["sent"] = [roles["sent"], histories["sent"].txs[:len(roles["sent"]) // 2]]
+            if not roles["sent"] or not roles["received"]:
+                del roles["all"]
+            state[address] = {role: keys for role, keys in roles.items() if keys}
+        return state
+
+    @staticmethod
+    def transactions(state):
+        """
+        The transactions of the JSON `state`, by key.
+        """
+        txs = {}
+        for roles in state.values():
+            if "sent" in roles:
+                flat, sent = roles["sent"]
+                pairs = iter(flat)
+                txs.update(zip(zip(pairs, pairs), sent))
+        return txs
+
+    @staticmethod
+    def histories_of(roles, txs):
+        """
+        The histories of one address from its JSON `roles`.
+        """
+        empty = ()
+        sent = AddressHistory.from_flat_keys(roles["sent"][0] if "sent" in roles else empty, txs)
+        received = AddressHistory.from_flat_keys(roles.get("received", empty), txs)
+        if "all" in roles:
+            everything = AddressHistory.from_flat_keys(roles["all"], txs)
+        else:
+            everything = (sent if sent.keys else received).copy()
+        return {"sent": sent, "received": received, "all": everything}
+
+
+class AddressIndex:
+    """
+    address -> its transactions as sender ("sent"), as recipient
+    ("received") and both ("all"), with running totals, as of the sealed
+    blocks. Admitted transactions are kept apart until they are sealed.
+    """
+    ROLES = ("sent", "received", "all")
+
+    def __init__(self):
+        self.histories = {}
+        self.totals = {}
+        self.pending = {}
+        self.pending_totals = {}
+        # Last block applied
+        self.height = -1
+        # Histories restored from a snapshot are built on first use:
+        # address -> JSON (see _FrozenHistories), and their transactions
+        self.__stored = {}
+        self.__stored_txs = {}
+        self.__stored_lock = threading.Lock()
+
+    def __histories(self, address):
+        histories = self.histories.get(address)
+        if histories is None and self.__stored:
+            with self.__stored_lock:
+                histories = self.histories.get(address)
+                roles = self.__stored.pop(address, None)
+                if histories is None and roles is not None:
+                    histories = self.histories[address] = _FrozenHistories.histories_of(
+                        roles, self.__stored_txs)
+                if not self.__stored:
+                    self.__stored_txs = {}
+        return histories
+
+    def history(self, address, role="all"):
+        histories = self.__histories(address)
+        return histories.get(role) if histories is not None else None
+
+    def balance(self, address):
+        sent, received = self.totals.get(address, (0, 0))
+        pending_sent, pending_received = self.pending_totals.get(address, (0, 0))
+        return {"sent": sent, "received": received, "balance": received - sent,
+                "pending_sent": pending_sent, "pending_received": pending_received,
+                "pending_balance": received - sent + pending_received - pending_sent}
+
+    @staticmethod
+    def __add_totals(totals, tx_data, sign=1):
+        value = amount(tx_data) * sign
+        sent, received = totals.get(tx_data["from"], (0, 0))
+        totals[tx_data["from"]] = (sent + value, received)
+        sent, received = totals.get(tx_data["to"], (0, 0))
+        totals[tx_data["to"]] = (sent, received + value)
+
+    def rebuild(self, chain):
+        self.histories, self.totals = {}, {}
+        self.pending, self.pending_totals = {}, {}
+        self.height = -1
+        with self.__stored_lock:
+            self.__stored, self.__stored_txs = {}, {}
+        for block in chain:
+            self.apply_block(block)
+
+    def state(self):
+        """
+        The histories are frozen rather than copied, see _FrozenHistories.
+        """
+        with self.__stored_lock:
+            histories = _FrozenHistories(dict(self.histories), dict(self.__stored), self.height)
+        return {"height": self.height, "histories": histories,
+                "totals": dict(self.totals), "pending": dict(self.pending),
+                "pending_totals": dict(self.pending_totals)}
+
+    def load_state(self, state):
+        self.height = state["height"]
+        with self.__stored_lock:
+            self.histories = {}
+            self.__stored = state["histories"]
+            self.__stored_txs = _FrozenHistories.transactions(self.__stored)
+        self.totals = {address: tuple(totals) for address, totals in state["totals"].items()}
+        self.pending = state["pending"]
+        self.pending_totals = {address: tuple(totals)
+                               for address, totals in state["pending_totals"].items()}
+
+    def apply_block(self, block):
+        self.height = block.index
+        for position, tx_data in enumerate(block.info):
+            key = (block.index, position)
+            for address, role in ((tx_data["from"], "sent"), (tx_data["to"], "received")):
+                histories = self.__histories(address)
+                if histories is None:
+                    histories = self.histories[address] = {r: AddressHistory() for r in self.ROLES}
+                histories[role].append(key, tx_data)
+            for address in {tx_data["from"], tx_data["to"]}:
+                self.histories[address]["all"].append(key, tx_data)
+            self.__add_totals(self.totals, tx_data)
+
+            if self.pending:
+                pending = self.pending.pop(leaf_hash(tx_data), None)
+                if pending is not None:
+                    self.__add_totals(self.pending_totals, pending, -1)
+
+    def remove_block(self, block):
+        for position in range(len(block.info) - 1, -1, -1):
+            key, tx_data = (block.index, position), block.info[position]
+            self.__add_totals(self.totals, tx_data, -1)
+            for address in {tx_data["from"], tx_data["to"]}:
+                histories = self.__histories(address)
+                for history in histories.values():
+                    if history.keys and history.keys[-1] == key:
+                        history.keys.pop()
+                        history.txs.pop()
+                if not histories["all"].keys:
+                    del self.histories[address]
+                    del self.totals[address]
+        self.height = block.index - 1
+
+    def apply_pending(self, info):
+        self.pending[leaf_hash(info)] = info
+        self.__add_totals(self.pending_totals, info)
+
+
+def attach_indexes(tx: Blockchain):
+    tx.register_index("addresses", AddressIndex())
+    tx.register_index("search", Search.SearchIndex(
+        os.path.join(config.UPLOAD_FOLDER, config.TRANSACTION_SEARCH_INDEX), amount))
+
+
+def get_history(tx: Blockchain, address, request):
+    """
+    Sealed transactions of `address`, oldest first.
+    Query arguments: role (sent, received or all), from_height, limit,
+    cursor (next_cursor of the previous page)
+    """
+    role = request.args.get("role", "all")
+    if role not in AddressIndex.ROLES:
+        return "Invalid role", 400
+    limit = max(1, min(request.args.get("limit", config.ADDRESS_PAGE_LIMIT, type=int),
+                       config.ADDRESS_PAGE_LIMIT))
+    cursor = request.args.get("cursor")
+    try:
+        start = tuple(int(part) for part in cursor.split("-")) if cursor else \
+            (request.args.get("from_height", 0, type=int), 0)
+    except ValueError:
+        return "Invalid cursor", 400
+
+    history = tx.indexes["addresses"].history(address, role)
+    entries, next_key = history.page(start, limit) if history else ([], None)
+    return {"address": address,
+            "role": role,
+            "transactions": [{"height": key[0], "position": key[1], "tx": tx_data}
+                             for key, tx_data in entries],
+            "next_cursor": "{}-{}".format(*next_key) if next_key else None}, 200
+
+
+def get_balance(tx: Blockchain, address):
+    return dict(tx.indexes["addresses"].balance(address), address=address), 200
+
+
+def search(tx: Blockchain, request):
+    return Search.search_request(tx.indexes["search"], request), 200
+
+
+def check_transaction(tx_data, registry=None):
+    """
+    Checks a submitted transaction and strips its private key.
+    :param registry: Users.UserRegistry both parties must be registered in
+    returns: (error message, status code), or None if it is valid
+    """
     required_fields = ["from", "to", "value", "private_key", "description"]
 
+    if not isinstance(tx_data, dict):
+        return "Invalid transaction data", 404
     for field in required_fields:
         if not tx_data.get(field):
             return "Invalid transaction data", 404
+    if not _finite(tx_data["value"]):
+        return "Invalid transaction value", 404
 
     # check key pair
-    if tx_data['from'] != hashlib.sha256(tx_data["private_key"].encode('utf-8')).hexdigest():
+    if not Users.verify_keypair(tx_data["from"], tx_data["private_key"]):
         return "Forbidden", 403
+    error = Users.check_participants(registry, tx_data["from"], tx_data["to"])
+    if error:
+        return error
 
     del tx_data["private_key"]
-    tx_data["timestamp"] = time.time()
+    return None
+
 
-    # Update index
-    tx.bc_idx[(tx_data["from"], tx_data["to"])].append((tx_data["value"], tx_data["description"]))
+def admit_transactions(tx: Blockchain, txs):
+    """
+    Adds checked transactions to the mempool at once and indexes the
+    ones which were not pending yet.
+    """
+    with tx.lock:
+        admitted = tx.add_new_infos(txs)
+        for tx_data in admitted:
+            tx.index_append((tx_data["from"], tx_data["to"]), (tx_data["value"], tx_data["description"]),
+                            tx_data)
+    return admitted
+
+
+def new_transaction(tx: Blockchain, request, registry=None):
+    tx_data = request.get_json()
+    error = check_transaction(tx_data, registry)
+    if error:
+        return error
+    tx_data["timestamp"] = time.time()
 
-    tx.add_new_info(tx_data)
+    try:
+        admit_transactions(tx, [tx_data])
+    except MempoolFull:
+        return "Too many pending transactions", 429
     return "Success", 201
 
 
-def get_chain(tx: Blockchain):
-    chain_data = []
-    length = 0
-    for block in tx.chain:
-        chain_data.append(block.__dict__)
-        length = block.index
-    return json.dumps({"length": length,
-                       "chain": chain_data})
+def new_transactions(tx: Blockchain, request, registry=None):
+    """
+    Batch version of `new_transaction`: the body is a list of
+    transactions, which are admitted together only if all of them are
+    valid and fit into the mempool. They share a timestamp, so two equal
+    transactions in one batch are refused (409) rather than merged;
+    send them in separate batches or tell them apart, e.g. by the
+    description.
+    """
+    txs = request.get_json()
+    if not isinstance(txs, list) or not txs:
+        return "Invalid transaction data", 404
+    if len(txs) > config.TX_BATCH_LIMIT:
+        return "At most {} transactions per batch".format(config.TX_BATCH_LIMIT), 413
+
+    timestamp = time.time()
+    positions = {}
+    for position, tx_data in enumerate(txs):
+        error = check_transaction(tx_data, registry)
+        if error:
+            return {"position": position, "error": error[0]}, error[1]
+        first = positions.setdefault(json.dumps(tx_data, sort_keys=True), position)
+        if first != position:
+            return {"position": position, "error": "Same as transaction {} of the batch".format(first)}, 409
+        tx_data["timestamp"] = timestamp
+
+    try:
+        admitted = admit_transactions(tx, txs)
+    except MempoolFull:
+        return "Too many pending transactions", 429
+    return {"admitted": len(admitted), "duplicates": len(txs) - len(admitted)}, 201
+
+
+def get_chain(tx: Blockchain, request=None):
+    return Wire.chain_response(tx.chain, request)
 
 
 def consensus(tx: Blockchain, peers):
-    longest_chain = None
-    current_len = len(tx.chain)
-
-    for node in peers:
-        response = requests.get('{}/tx/chain'.format(node))
-        length = response.json()['length']
-        chain = response.json()['chain']
-        if length > current_len and tx.check_chain_validity(chain):
-            # Longer valid chain found!
-            current_len = length
-            longest_chain = chain
-
-    if longest_chain:
-        blockchain = longest_chain  # 选择最长链
-        return True
-    return False
+    """
+    Adopts a valid chain with more work from the peers, downloading only the
+    blocks after the fork point (see Sync.py).
+    """
+    return Sync.sync_chain(tx, peers, "/tx") > 0
 
 
 def announce_new_block(block, peers):
-    headers = {'Content-Type': "application/json"}
-    for peer in peers:
-        url = "{}/tx/add_block".format(peer)
-        requests.post(url, data=json.dumps(block.__dict__, sort_keys=True), headers=headers)
+    """
+    Sends the block to all peers in the background.
+    """
+    return Peers.broadcast(
+        peers, lambda peer: Wire.post_block(peer, "{}/tx/add_block".format(peer.rstrip("/")), block))
 
 
 def mine_unconfirmed_tx(tx: Blockchain, peers):
@@ -79,11 +436,11 @@ def mine_unconfirmed_tx(tx: Blockchain, peers):
     if not result:
         return "No transactions to mine", 400
     else:
-        # Making sure we have the longest chain before announcing to the network
-        chain_length = len(tx.chain)
+        # Making sure we have the chain with the most work before announcing to the network
+        tip = tx.last_block.hash
         consensus(tx, peers)
 
-        if chain_length == len(tx.chain):
+        if tip == tx.last_block.hash:
             # announce the recently mined block to the network
             announce_new_block(tx.last_block, peers)
             return "Transaction Block #{} is mined.".format(tx.last_block.index), 201
@@ -92,15 +449,9 @@ def mine_unconfirmed_tx(tx: Blockchain, peers):
 
 
 def tx_add_block(tx: Blockchain, request):
-    block_data = request.get_json()
-    block = Block(block_data["_Block__index"],
-                  block_data["_Block__info"],
-                  block_data["_Block__timestamp"],
-                  block_data["_Block__previous_hash"],
-                  block_data["_Block__previous_idx_hash"])
-    block.nonce = block_data["nonce"]
-
-    proof = block.compute_hash()
+    block = Wire.block_from_request(request)
+
+    proof = block.hash
     added = tx.add_block(block, proof)
 
     if not added:
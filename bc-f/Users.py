@@ -1,12 +1,137 @@
 from Blockchain import Blockchain
+import functools
+import os
 import time
 import json
-from Block import Block
-import requests
-import random
+import config
+from Mempool import MempoolFull
+import Peers
+import Sync
+import Wire
 import hashlib
 
 
+@functools.lru_cache(maxsize=config.KEYPAIR_CACHE_SIZE)
+def public_key_of(private_key):
+    """
+    The sha256 private -> public key derivation, cached for the keys
+    which sign requests again and again.
+    """
+    return hashlib.sha256(private_key.encode('utf-8')).hexdigest()
+
+
+def verify_keypair(public_key, private_key):
+    return isinstance(private_key, str) and public_key_of(private_key) == public_key
+
+
+class UserRegistry:
+    """
+    public key -> {"name", "description", "height"} of the registered
+    users, as of the sealed user blocks, with the registrations waiting
+    in `unconfirmed_info` on top (their height is None). A key sealed
+    again keeps its earlier records, for `remove_block`.
+    """
+
+    def __init__(self):
+        self.confirmed = {}
+        self.pending = {}
+        self.earlier = {}
+
+    def __contains__(self, public_key):
+        return public_key in self.confirmed or public_key in self.pending
+
+    def __len__(self):
+        return len(self.confirmed.keys() | self.pending.keys())
+
+    def get(self, public_key, include_pending=True):
+        if include_pending and public_key in self.pending:
+            return self.pending[public_key]
+        return self.confirmed.get(public_key)
+
+    @staticmethod
+    def __record(user_data, height):
+        return {"name": user_data.get("name"), "description": user_data.get("description"), "height": height}
+
+    def rebuild(self, chain):
+        self.confirmed = {}
+        self.pending = {}
+        self.earlier = {}
+        for block in chain:
+            self.apply_block(block)
+
+    def state(self):
+        return {"confirmed": dict(self.confirmed), "pending": dict(self.pending),
+                "earlier": {public_key: list(records) for public_key, records in self.earlier.items()}}
+
+    def load_state(self, state):
+        self.confirmed, self.pending = state["confirmed"], state["pending"]
+        self.earlier = state.get("earlier", {})
+
+    def apply_block(self, block):
+        for user_data in block.info:
+            public_key = user_data.get("public_key")
+            if public_key is None:
+                continue
+            if public_key in self.confirmed:
+                self.earlier.setdefault(public_key, []).append(self.confirmed[public_key])
+            self.confirmed[public_key] = self.__record(user_data, block.index)
+            self.pending.pop(public_key, None)
+
+    def remove_block(self, block):
+        for user_data in reversed(block.info):
+            public_key = user_data.get("public_key")
+            if public_key is None:
+                continue
+            earlier = self.earlier.get(public_key)
+            if earlier:
+                self.confirmed[public_key] = earlier.pop()
+                if not earlier:
+                    del self.earlier[public_key]
+            else:
+                self.confirmed.pop(public_key, None)
+
+    def apply_pending(self, info):
+        if info.get("public_key") is not None:
+            self.pending[info["public_key"]] = self.__record(info, None)
+
+
+def attach_indexes(users: Blockchain):
+    users.register_index("registry", UserRegistry())
+
+
+def check_participants(registry, *public_keys):
+    """
+    returns: (error message, status code) if one of `public_keys` is not
+             a registered user, else None. Not checked without a registry.
+    """
+    if registry is None or not config.REQUIRE_REGISTERED_USERS:
+        return None
+    for public_key in public_keys:
+        if public_key not in registry:
+            return "Unknown user {}".format(public_key), 404
+    return None
+
+
+def get_user(registry, public_key):
+    user = registry.get(public_key)
+    if user is None:
+        return "Unknown user", 404
+    return dict(user, public_key=public_key, pending=user["height"] is None), 200
+
+
+def generate_keypairs(count):
+    """
+    `count` (private key, public key) pairs; the private keys are 32
+    random bytes each, hex encoded, all drawn from os.urandom at once.
+    """
+    private_keys = os.urandom(32 * count).hex()
+    keypairs = []
+    for start in range(0, 64 * count, 64):
+        private_key = private_keys[start:start + 64]
+        keypairs.append((private_key, hashlib.sha256(private_key.encode('utf-8')).hexdigest()))
+    return keypairs
+
+
 def new_users(users: Blockchain, request):
     user_data = request.get_json()
     required_fields = ["access_key", "name", "description"]
@@ -21,12 +146,7 @@ def new_users(users: Blockchain, request):
     del user_data["access_key"]
 
     # generate key pair
-    res = [random.randrange(1, 16, 1) for i in range(64)]
-
-    # private key
-    private_key = hashlib.sha256(str(res).encode('utf-8')).hexdigest()
-    # public key
-    public_key = hashlib.sha256(private_key.encode('utf-8')).hexdigest()
+    private_key, public_key = generate_keypairs(1)[0]
 
     response = {}
     response['public_key'] = str(public_key)
@@ -39,40 +159,64 @@ def new_users(users: Blockchain, request):
     return response, 201
 
 
-def get_users(users: Blockchain):
-    chain_data = []
-    length = 0
-    for block in users.chain:
-        chain_data.append(block.__dict__)
-        length = block.index
-    return json.dumps({"length": length,
-                       "chain": chain_data})
+def new_users_bulk(users: Blockchain, request):
+    """
+    Registers a batch of users: {"access_key", "users": [{"name",
+    "description"}, ...]}. All of them enter the mempool at once, or
+    none of them.
+    returns: (JSON lines {"name", "public_key", "private_key"}, one per
+             user in request order, 201), or (error, status code)
+    """
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("users"), list) or not data["users"]:
+        return "Invalid User Info", 404
+    if data.get("access_key") != "PASSWORD":
+        return "Forbidden", 403
+    if len(data["users"]) > config.USER_BATCH_LIMIT:
+        return "At most {} users per batch".format(config.USER_BATCH_LIMIT), 413
 
+    timestamp = time.time()
+    batch = []
+    for position, user in enumerate(data["users"]):
+        if not isinstance(user, dict) or not user.get("name") or not user.get("description"):
+            return {"position": position, "error": "Invalid User Info"}, 404
+        batch.append({"name": user["name"], "description": user["description"]})
 
-def consensus(users: Blockchain, peers):
-    longest_chain = None
-    current_len = len(users.chain)
+    keypairs = generate_keypairs(len(batch))
+    for user_data, (_, public_key) in zip(batch, keypairs):
+        user_data["public_key"] = public_key
+        user_data["timestamp"] = timestamp
+    try:
+        users.add_new_infos(batch)
+    except MempoolFull:
+        return "Too many pending users", 429
+
+    def lines():
+        for user_data, (private_key, public_key) in zip(batch, keypairs):
+            yield json.dumps({"name": user_data["name"], "public_key": public_key,
+                              "private_key": private_key}) + "\n"
 
-    for node in peers:
-        response = requests.get('{}/users/chain'.format(node))
-        length = response.json()['length']
-        chain = response.json()['chain']
-        if length > current_len and users.check_chain_validity(chain):
-            # Longer valid chain found!
-            current_len = length
-            longest_chain = chain
+    return lines(), 201
 
-    if longest_chain:
-        blockchain = longest_chain  # 选择最长链
-        return True
-    return False
+
+def get_users(users: Blockchain, request=None):
+    return Wire.chain_response(users.chain, request)
+
+
+def consensus(users: Blockchain, peers):
+    """
+    Adopts a valid chain with more work from the peers, downloading only the
+    blocks after the fork point (see Sync.py).
+    """
+    return Sync.sync_chain(users, peers, "/users") > 0
 
 
 def announce_new_block(block, peers):
-    headers = {'Content-Type': "application/json"}
-    for peer in peers:
-        url = "{}/users/add_block".format(peer)
-        requests.post(url, data=json.dumps(block.__dict__, sort_keys=True), headers=headers)
+    """
+    Sends the block to all peers in the background.
+    """
+    return Peers.broadcast(
+        peers, lambda peer: Wire.post_block(peer, "{}/users/add_block".format(peer.rstrip("/")), block))
 
 
 def mine_unconfirmed_users(users: Blockchain, peers):
@@ -80,11 +224,11 @@ def mine_unconfirmed_users(users: Blockchain, peers):
     if not result:
         return "No New Users", 400
     else:
-        # Making sure we have the longest chain before announcing to the network
-        chain_length = len(users.chain)
+        # Making sure we have the chain with the most work before announcing to the network
+        tip = users.last_block.hash
         consensus(users, peers)
 
-        if chain_length == len(users.chain):
+        if tip == users.last_block.hash:
             # announce the recently mined block to the network
             announce_new_block(users.last_block, peers)
             return "User Block #{} is mined.".format(users.last_block.index), 201
@@ -93,14 +237,9 @@ def mine_unconfirmed_users(users: Blockchain, peers):
 
 
 def users_add_block(users: Blockchain, request):
-    block_data = request.get_json()
-    block = Block(block_data["_Block__index"],
-                  block_data["_Block__info"],
-                  block_data["_Block__timestamp"],
-                  block_data["_Block__previous_hash"])
-    block.nonce = block_data["nonce"]
-
-    proof = block.compute_hash()
+    block = Wire.block_from_request(request)
+
+    proof = block.hash
     added = users.add_block(block, proof)
 
     if not added:
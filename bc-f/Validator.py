@@ -0,0 +1,153 @@
+"""
+Full-chain validation, e.g. of a chain received from a peer.
+
+Block hashes are independent of each other, so they are computed on a
+process pool, VALIDATION_CHUNK_SIZE blocks per task. The results come
+back in chain order and the linkage (index, previous_hash) and the
+proof of work are checked in a single pass over them, stopping at the
+first bad block; the pool is torn down with the remaining tasks.
+
+Each block must carry the target its predecessors require (see
+Difficulty.py) and its hash must meet it.
+
+Blocks up to a trusted checkpoint (height, hash) are still hashed and
+linked, so they cannot be altered, and the block at the checkpoint
+height must have its hash; only their targets, timestamps and proofs
+of work are not checked.
+
+The pool is started through a fork server (or spawned), not forked
+from the node, whose other threads may hold locks at the time.
+"""
+
+import multiprocessing
+import os
+import time
+
+from Block import block_from_dict
+import config
+import Difficulty
+
+
+_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+def _as_block(block):
+    return block_from_dict(block) if isinstance(block, dict) else block
+
+
+def _block_hashes(blocks):
+    """
+    Pool task: (index, previous_hash, hash, timestamp, target) of every
+    block in `blocks`, which are Block objects or their JSON form.
+    """
+    result = []
+    for block in map(_as_block, blocks):
+        result.append((block.index, block.previous_hash, block.compute_hash(),
+                       block.timestamp, block.target))
+    return result
+
+
+class ValidationReport:
+    """
+    Outcome of `validate_chain`; true if the chain is valid.
+    :param hashes: computed hashes of the checked blocks, in chain order
+                   (see `remember_hashes`)
+    :param failed_height: height of the first bad block
+    """
+
+    def __init__(self, blocks, seconds, hashes, failed_height=None, reason=None):
+        self.blocks = blocks
+        self.seconds = seconds
+        self.hashes = hashes
+        self.failed_height = failed_height
+        self.reason = reason
+
+    def __bool__(self):
+        return self.failed_height is None
+
+    @property
+    def blocks_per_sec(self):
+        return self.blocks / self.seconds if self.seconds else float("inf")
+
+    def remember_hashes(self, blocks):
+        """
+        Stores the computed hashes on `blocks` (the validated ones), so
+        adding them does not hash them again.
+        """
+        for block, block_hash in zip(blocks, self.hashes):
+            block.remember_hash(block_hash)
+
+    def __repr__(self):
+        if self:
+            return "<valid: {} blocks, {:.0f} blocks/s>".format(self.blocks, self.blocks_per_sec)
+        return "<invalid at height {}: {}>".format(self.failed_height, self.reason)
+
+
+def validate_chain(chain, start_height=0, previous_hash="0", history=(),
+                   checkpoint=None, workers=None, chunk_size=None):
+    """
+    :param chain: blocks (or their JSON form) from `start_height` on
+    :param previous_hash: hash the first block must point to
+    :param history: target history before `start_height`, see
+                    `Blockchain.target_history`
+    :param checkpoint: trusted (height, hash); the proofs of work up to it
+                       are not checked
+    :param workers: worker processes (default VALIDATION_WORKERS, or all
+                    cores); chains of one chunk or less are checked in
+                    this process
+    returns: ValidationReport
+    """
+    start = time.perf_counter()
+    workers = workers or config.VALIDATION_WORKERS or os.cpu_count() or 1
+    chunk_size = chunk_size or config.VALIDATION_CHUNK_SIZE
+
+    # Only a checkpoint among the blocks is trusted; otherwise all of
+    # them are checked in full
+    trusted_height = start_height - 1
+    if checkpoint is not None and 0 <= checkpoint[0] - start_height < len(chain):
+        trusted_height = checkpoint[0]
+    schedule = Difficulty.TargetSchedule(history)
+
+    # Sliced lazily, so a BlockStore is read one chunk at a time
+    tasks = (chain[i:i + chunk_size] for i in range(0, len(chain), chunk_size))
+    hashes = []
+    height = start_height
+    failed_height, reason = None, None
+
+    def check(results):
+        nonlocal previous_hash, height, failed_height, reason
+        for index, block_previous_hash, block_hash, timestamp, target in results:
+            if index != height:
+                failed_height, reason = height, "wrong index"
+            elif block_previous_hash != previous_hash:
+                failed_height, reason = height, "previous_hash mismatch"
+            elif height == trusted_height and block_hash != checkpoint[1]:
+                failed_height, reason = height, "checkpoint mismatch"
+            elif height <= trusted_height:
+                pass
+            elif not schedule.accepts(height, target):
+                failed_height, reason = height, "wrong target"
+            elif not schedule.accepts_timestamp(timestamp):
+                failed_height, reason = height, "timestamp out of range"
+            elif not Difficulty.meets_target(block_hash, Difficulty.LEGACY_TARGET if target is None else target):
+                failed_height, reason = height, "insufficient proof of work"
+            if failed_height is not None:
+                return False
+            schedule.append(timestamp, target)
+            hashes.append(block_hash)
+            previous_hash = block_hash
+            height += 1
+        return True
+
+    if workers == 1 or len(chain) <= chunk_size:
+        for task in tasks:
+            if not check(_block_hashes(task)):
+                break
+    else:
+        with _context.Pool(workers) as pool:
+            for results in pool.imap(_block_hashes, tasks):
+                if not check(results):
+                    break
+
+    return ValidationReport(len(hashes), time.perf_counter() - start, hashes, failed_height, reason)
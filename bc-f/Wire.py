@@ -0,0 +1,145 @@
+"""
+Block transfer between nodes.
+Blocks travel as JSON (see `Block.to_dict`) or, when both nodes
+support it, in the compact binary encoding of Block.py:
+* GET  /*/chain     binary if the Accept header asks for BINARY_MIMETYPE
+* POST /*/add_block binary if sent with Content-Type BINARY_MIMETYPE;
+                    nodes which answer 415 get JSON from then on
+
+GET /*/chain takes optional range arguments:
+    from_height, to_height (inclusive), limit, cursor
+With any of them the reply is a page of at most CHAIN_PAGE_LIMIT
+blocks, and "next_cursor" (X-Next-Cursor header for streams) is the
+cursor of the following page, or null after the last one. Without
+them the whole chain is returned, as older nodes expect.
+Asking for NDJSON_MIMETYPE (or ?stream=1) streams one JSON block per
+line; binary replies are always streamed.
+"""
+
+import json
+
+from flask import Response
+from werkzeug.exceptions import BadRequest
+
+from Block import (BINARY_MIMETYPE, block_from_dict, decode_block, decode_chain,
+                   encode_block, encode_chain)
+import config
+import Peers
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Peers that rejected a binary block (older nodes)
+_json_only_peers = set()
+
+
+def wants_binary(request):
+    if request is None:
+        return False
+    best = request.accept_mimetypes.best_match(["application/json", BINARY_MIMETYPE])
+    return best == BINARY_MIMETYPE
+
+
+def wants_stream(request):
+    if request is None:
+        return False
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE or request.args.get("stream") == "1"
+
+
+def requested_range(request, chain_len):
+    """
+    Returns (start, stop, end): this page covers heights [start, stop)
+    of the requested range [start, end). end is None if no range
+    argument was given.
+    """
+    args = request.args if request is not None else {}
+    if not any(name in args for name in ("from_height", "to_height", "limit", "cursor")):
+        return 0, chain_len, None
+
+    start = args.get("cursor", type=int)
+    if start is None:
+        start = args.get("from_height", 0, type=int)
+    start = max(start, 0)
+    end = min(args.get("to_height", chain_len - 1, type=int) + 1, chain_len)
+    limit = max(1, min(args.get("limit", config.CHAIN_PAGE_LIMIT, type=int), config.CHAIN_PAGE_LIMIT))
+    stop = max(start, min(end, start + limit))
+    return start, stop, end
+
+
+def json_response(data, status):
+    return Response(json.dumps(data), status=status, mimetype="application/json")
+
+
+def chain_response(chain, request=None):
+    """
+    Serves `chain` (or the requested range of it), reading the blocks
+    lazily so streamed replies never hold the whole chain.
+    """
+    chain_len = len(chain)
+    length = chain[-1].index if chain_len else 0
+    start, stop, end = requested_range(request, chain_len)
+    next_cursor = stop if end is not None and stop < end else None
+
+    def blocks():
+        for height in range(start, stop):
+            yield chain[height]
+
+    headers = {"X-Chain-Length": str(length)}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+
+    if wants_binary(request):
+        return Response((encode_chain([block]) for block in blocks()),
+                        mimetype=BINARY_MIMETYPE, headers=headers)
+    if wants_stream(request):
+        return Response((json.dumps(block.to_dict(), sort_keys=True) + "\n" for block in blocks()),
+                        mimetype=NDJSON_MIMETYPE, headers=headers)
+
+    data = {"length": length,
+            "chain": [block.to_dict() for block in blocks()]}
+    if end is not None:
+        data["next_cursor"] = next_cursor
+    return json.dumps(data)
+
+
+def block_from_request(request):
+    """
+    raises: BadRequest (answered with 400) if the body is not a block
+    """
+    try:
+        if request.mimetype == BINARY_MIMETYPE:
+            return decode_block(request.get_data())
+        return block_from_dict(request.get_json())
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise BadRequest("Invalid block: {}".format(e))
+
+
+def post_block(peer, url, block):
+    if peer not in _json_only_peers:
+        response = Peers.post(url, data=encode_block(block),
+                              headers={"Content-Type": BINARY_MIMETYPE})
+        if response.status_code != 415:
+            return response
+        _json_only_peers.add(peer)
+    return Peers.post(url, data=json.dumps(block.to_dict(), sort_keys=True),
+                      headers={"Content-Type": "application/json"})
+
+
+def fetch_blocks(url, from_height):
+    """
+    Yields the blocks of a peer's /*/chain from `from_height` on,
+    following the page cursors.
+    """
+    cursor = from_height
+    while cursor is not None:
+        response = Peers.get(url, params={"cursor": cursor},
+                             headers={"Accept": BINARY_MIMETYPE + ", application/json;q=0.9"})
+        if response.headers.get("Content-Type", "").startswith(BINARY_MIMETYPE):
+            blocks = list(decode_chain(response.content))
+            next_cursor = response.headers.get("X-Next-Cursor")
+            cursor = int(next_cursor) if next_cursor is not None else None
+        else:
+            data = response.json()
+            blocks = [block_from_dict(block_data) for block_data in data["chain"]]
+            cursor = data.get("next_cursor")
+        yield from blocks
@@ -1,30 +1,31 @@
 import json
-import os
-import requests
-import time
 
 from flask import Flask, request
 
-import config
-import NFT
-from Blockchain import Blockchain
-from Block import Block
-import Users
-import Transactions
+import Peers
+from Mempool import MempoolFull
+import Runtime
+from Wire import json_response
 
 
 app = Flask(__name__)
 
-tx = Blockchain()
-users = Blockchain()
-nfts = Blockchain()
-peers = set()
+# Every chain runs in a worker of its own (see Runtime.py); the views
+# forward their requests to it. Not in the helper processes of
+# multiprocessing (e.g. the validation pool), which import the main
+# script again as __mp_main__.
+if __name__ != "__mp_main__":
+    chains = Runtime.start()
 
-CONNECTED_NODE_ADDRESS = "http://127.0.0.1:5000"
-posts = []
 
-tx.op = os.path.join(config.UPLOAD_FOLDER, config.TRANSACTION_INDEX)
-nfts.op = os.path.join(config.UPLOAD_FOLDER, config.NFT_INDEX)
+@app.errorhandler(MempoolFull)
+def mempool_full(e):
+    return "Too many pending entries", 429
+
+
+@app.errorhandler(Runtime.WorkerError)
+def worker_gone(e):
+    return "Chain unavailable", 503
 
 
 def verify_author():
@@ -38,110 +39,197 @@ def new_user():
     if not verify_author():
         return "Forbidden", 403
 
-    data = Users.new_users(users, request)
+    return chains["users"].call("new_user", request)
+
+
+@app.route('/users/new_users', methods=['POST'])
+def new_users():
+    if not verify_author():
+        return "Forbidden", 403
 
-    response = app.response_class(
-        response=json.dumps(data[0]),
-        status=data[1],
-        mimetype='application/json'
-    )
-    return response
+    return chains["users"].call("new_users", request)
 
 
 @app.route('/users/chain', methods=['GET'])
 def get_users_chain():
-    return Users.get_users(users)
+    return chains["users"].call("chain", request)
 
 
 @app.route('/users/pending_user', methods=['GET'])
 def get_pending_user():
-    return json.dumps(users.unconfirmed_info)
+    return chains["users"].call("pending")
 
 
 @app.route('/users/mine', methods=['GET'])
 def mine_unconfirmed_users():
-    return Users.mine_unconfirmed_users(users, peers)
+    return chains["users"].call("mine")
 
 
 @app.route('/users/add_block', methods=['POST'])
 def users_add_block():
-    return Users.users_add_block(users, request)
+    return chains["users"].call("add_block", request)
+
+
+@app.route('/users/registry/<public_key>', methods=['GET'])
+def get_registered_user(public_key):
+    return chains["users"].call("user", public_key)
+
+
+@app.route('/users/tip', methods=['GET'])
+def get_users_tip():
+    return chains["users"].call("tip")
+
+
+@app.route('/users/locate', methods=['POST'])
+def locate_users_fork():
+    return chains["users"].call("locate", request)
+
+
+@app.route('/users/sync', methods=['GET'])
+def sync_users_chain():
+    return chains["users"].call("sync")
 
 
 # Transaction API
 @app.route('/tx/new_transaction', methods=['POST'])
 def new_transaction():
-    data = Transactions.new_transaction(tx, request)
-    response = app.response_class(
-        response=json.dumps(data[0]),
-        status=data[1],
-        mimetype='application/json'
-    )
-    return response
+    return chains["tx"].call("new_transaction", request)
+
+
+@app.route('/tx/new_transactions', methods=['POST'])
+def new_transactions():
+    return chains["tx"].call("new_transactions", request)
+
+
+@app.route('/tx/address/<address>/history', methods=['GET'])
+def get_address_history(address):
+    return chains["tx"].call("address_history", address, request)
+
+
+@app.route('/tx/address/<address>/balance', methods=['GET'])
+def get_address_balance(address):
+    return chains["tx"].call("address_balance", address)
+
+
+@app.route('/tx/search', methods=['GET'])
+def search_transactions():
+    return chains["tx"].call("search", request)
 
 
 @app.route('/tx/chain', methods=['GET'])
 def get_chain():
-    return Transactions.get_chain(tx)
+    return chains["tx"].call("chain", request)
 
 
 @app.route('/tx/pending_tx', methods=['GET'])
 def get_pending_tx():
-    return json.dumps(tx.unconfirmed_info)
+    return chains["tx"].call("pending")
 
 
 @app.route('/tx/mine', methods=['GET'])
 def mine_unconfirmed_tx():
-    return Transactions.mine_unconfirmed_tx(tx, peers)
+    return chains["tx"].call("mine")
 
 
 @app.route('/tx/add_block', methods=['POST'])
 def tx_add_block():
-    return Transactions.tx_add_block(tx, request)
+    return chains["tx"].call("add_block", request)
+
+
+@app.route('/tx/tip', methods=['GET'])
+def get_tx_tip():
+    return chains["tx"].call("tip")
+
+
+@app.route('/tx/locate', methods=['POST'])
+def locate_tx_fork():
+    return chains["tx"].call("locate", request)
+
+
+@app.route('/tx/sync', methods=['GET'])
+def sync_tx_chain():
+    return chains["tx"].call("sync")
+
+
+@app.route('/tx/proof', methods=['GET'])
+def get_tx_proof():
+    return chains["tx"].call("proof", request)
 
 
 # NFT API
 @app.route('/nfts/new_file', methods=['POST'])
 def new_nft_file():
-    data = NFT.new_file(nfts, request)
-    response = app.response_class(
-        response=json.dumps(data[0]),
-        status=data[1],
-        mimetype='application/json'
-    )
-    return response
+    return chains["nfts"].call("new_file", request)
 
 
 @app.route('/nfts/transfer', methods=['POST'])
 def transfer():
-    data = NFT.transfer(nfts, request)
-    response = app.response_class(
-        response=json.dumps(data[0]),
-        status=data[1],
-        mimetype='application/json'
-    )
-    return response
+    return chains["nfts"].call("transfer", request)
+
+
+@app.route('/nfts/balance/<owner>', methods=['GET'])
+def get_nft_balance(owner):
+    return chains["nfts"].call("balance", owner)
 
 
 @app.route('/nfts/pending_nfts')
 def get_pending_nfts():
-    print(nfts.unconfirmed_info)
-    return json.dumps(nfts.unconfirmed_info)
+    return chains["nfts"].call("pending")
 
 
 @app.route('/nfts/mine', methods=['GET'])
 def mine_unconfirmed_nfts():
-    return NFT.mine_unconfirmed_nfts(nfts, peers)
+    return chains["nfts"].call("mine")
 
 
 @app.route('/nfts/chain', methods=['GET'])
 def get_nft_chain():
-    return NFT.get_chain(nfts)
+    return chains["nfts"].call("chain", request)
 
 
 @app.route('/nfts/add_block', methods=['POST'])
 def nft_add_block():
-    return NFT.nft_add_block(nfts, request)
+    return chains["nfts"].call("add_block", request)
+
+
+@app.route('/nfts/tip', methods=['GET'])
+def get_nft_tip():
+    return chains["nfts"].call("tip")
+
+
+@app.route('/nfts/locate', methods=['POST'])
+def locate_nft_fork():
+    return chains["nfts"].call("locate", request)
+
+
+@app.route('/nfts/sync', methods=['GET'])
+def sync_nft_chain():
+    return chains["nfts"].call("sync")
+
+
+@app.route('/nfts/proof', methods=['GET'])
+def get_nft_proof():
+    return chains["nfts"].call("proof", request)
+
+
+@app.route('/mining/jobs/<int:job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    # Job ids are unique across the chains, only one of them knows it
+    for chain in chains.values():
+        job = chain.call("job", job_id)
+        if job is not None:
+            return json_response(job, 200)
+    return "No such mining job", 404
+
+
+@app.route('/mining/status', methods=['GET'])
+def get_mining_status():
+    return json_response([chain.call("mining_status") for chain in chains.values()], 200)
+
+
+def add_peers(addresses):
+    for chain in chains.values():
+        chain.call("add_peers", set(addresses))
 
 
 # Endpoint to add new peers to the network
@@ -153,7 +241,7 @@ def register_new_peers():
         return "Invalid data", 400
 
     # Add the node to the peer list
-    peers.add(node_address)
+    add_peers([node_address])
 
     # Return the blockchain to the newly registered node so that it can sync
     return get_chain()
@@ -165,7 +253,7 @@ def register_with_existing_node():
     """
     Internally calls the `register_node` endpoint to
     register current node with the remote node specified in the
-    request, and sync the blockchain as well with the remote node.
+    request, and sync the chains as well with the remote node.
     """
     node_address = request.get_json()["node_address"]
     if not node_address:
@@ -175,142 +263,24 @@ def register_with_existing_node():
     headers = {'Content-Type': "application/json"}
 
     # Make a request to register with remote node and obtain information 放入节点名单
-    response = requests.post(node_address + "/register_node",
-                             data=json.dumps(data), headers=headers)
+    response = Peers.post(node_address + "/register_node",
+                          data=json.dumps(data), headers=headers)
 
     if response.status_code == 200:
-        global blockchain
-        global peers
-        # update chain and the peers
-        chain_dump = response.json()['chain']
-        blockchain = create_chain_from_dump(chain_dump)
-        peers.update(response.json()['peers'])
+        # update the peers, then the chains (see Sync.py)
+        add_peers([node_address.rstrip("/")] + list(response.json().get('peers', [])))
+        for chain in chains.values():
+            chain.call("sync")
         return "Registration successful", 200
     else:
         # if something goes wrong, pass it on to the API response
         return response.content, response.status_code
 
 
-def create_chain_from_dump(chain_dump):
-    blockchain = Blockchain()
-    for idx, block_data in enumerate(chain_dump):
-        block = Block(block_data["_Block__index"],
-                      block_data["_Block__info"],
-                      block_data["_Block__timestamp"],
-                      block_data["_Block__previous_hash"])
-        block.nonce = block_data["nonce"]
-        proof = block.compute_hash()
-
-        if idx > 0:
-            added = blockchain.add_block(block, proof)
-            if not added:
-                raise Exception("The chain dump is tampered!!")
-        else:  # the block is a genesis block, no verification needed
-            blockchain.chain.append(block)
-    return blockchain
-
-
-def check_chain_validity(cls, chain):
-    """
-    A helper method to check if the entire blockchain is valid.
-    """
-    result = True
-    previous_hash = "0"
-
-    # Iterate through every block
-    for block in chain:
-        block_hash = block.compute_hash()
-        # remove the hash field to recompute the hash again
-        # using `compute_hash` method.
-        # delattr(block, "hash")
-
-        if not cls.is_valid_proof(block, block.hash) or \
-                previous_hash != block.previous_hash:
-            result = False
-            break
-
-        # block.hash, previous_hash = block_hash, block_hash
-        previous_hash = block_hash
-
-    return result
-
-
-def consensus():
-    """
-    Our simple consensus algorithm. If a longer valid chain is
-    found, our chain is replaced with it.
-    """
-    global blockchain
-
-    longest_chain = None
-    current_len = len(blockchain.chain)
-
-    for node in peers:
-        response = requests.get('{}/chain'.format(node))
-        length = response.json()['length']
-        chain = response.json()['chain']
-        if length > current_len and blockchain.check_chain_validity(chain):
-            # Longer valid chain found!
-            current_len = length
-            longest_chain = chain
-
-    if longest_chain:
-        blockchain = longest_chain  # 选择最长链
-        return True
-
-    return False
-
-
-# endpoint to add a block mined by someone else to
-# the node's chain. The node first verifies the block
-# and then adds it to the chain.
-@app.route('/add_block', methods=['POST'])
-def verify_and_add_block():
-    block_data = request.get_json()
-    block = Block(block_data["_Block__index"],
-                  block_data["_Block__info"],
-                  block_data["_Block__timestamp"],
-                  block_data["_Block__previous_hash"])
-    block.nonce = block_data["nonce"]
-
-    proof = block.compute_hash()
-    added = blockchain.add_block(block, proof)
-
-    if not added:
-        return "The block was discarded by the node", 400
-
-    return "Block added to the chain", 201
-
-
-def announce_new_block(block):
-    """
-    A function to announce to the network once a block has been mined.
-    Other blocks can simply verify the proof of work and add it to their
-    respective chains.
-    """
-    headers = {'Content-Type': "application/json"}
-    for peer in peers:
-        url = "{}add_block".format(peer)
-        requests.post(url, data=json.dumps(block.__dict__, sort_keys=True), headers=headers)
-
-
-@app.route('/mine', methods=['GET'])
-def mine_unconfirmed_transactions():
-    result = blockchain.mine()
-    if not result:
-        return "No transactions to mine"
-    else:
-        # Making sure we have the longest chain before announcing to the network
-        chain_length = len(blockchain.chain)
-        consensus()
-
-        if chain_length == len(blockchain.chain):
-            # announce the recently mined block to the network
-            announce_new_block(blockchain.last_block)
-            return "Block #{} is mined.".format(blockchain.last_block.index)
-
-        return "Current Chain is not the latest version. New chain is updated."
-
-
 if __name__ == '__main__':
-    app.run()
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    args = parser.parse_args()
+    app.run(port=args.port)
@@ -0,0 +1,742 @@
+"""
+Micro-benchmarks for the blockchain node.
+Run from this folder, e.g.:
+    python benchmark.py hashing
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import gc
+import hashlib
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+from Block import Block, encode_block
+from ChunkStore import ChunkStore
+from Blockchain import Blockchain
+from IndexCommitment import IndexCommitment
+import config
+import Difficulty
+import IndexStore
+import Miner
+import NFT
+import Peers
+import Validator
+import Wire
+
+
+def sample_tx(i):
+    return {"from": "%064x" % i, "to": "%064x" % (i + 1), "value": i,
+            "description": "donation #%d" % i, "timestamp": 1600000000.0 + i}
+
+
+def sample_block(index, n_tx, previous_hash="0"):
+    return Block(index, [sample_tx(i) for i in range(n_tx)],
+                 1600000000.0 + index, previous_hash)
+
+
+def rate(fn, seconds=1.0):
+    """
+    Calls fn(i) for about `seconds` and returns calls per second.
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(64):
+            fn(calls)
+            calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def bench_hashing(args):
+    """
+    Hashes/sec of `Block.compute_hash` vs. the midstate nonce hasher.
+    """
+    print("{:>8} {:>14} {:>14} {:>8}".format("txs", "compute_hash", "nonce_hasher", "speedup"))
+    for n_tx in (1, 100, 10000):
+        block = sample_block(1, n_tx)
+        hash_with_nonce = block.nonce_hasher()
+
+        for nonce in (0, 7, 123456):
+            block.nonce = nonce
+            assert hash_with_nonce(nonce) == block.compute_hash()
+
+        def full(nonce):
+            block.nonce = nonce
+            block.compute_hash()
+
+        old = rate(full, args.seconds)
+        new = rate(hash_with_nonce, args.seconds)
+        print("{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x".format(n_tx, old, new, new / old))
+
+
+def bench_append(args):
+    """
+    Cost of `Blockchain.add_block` on a chain of `--blocks` blocks,
+    for blocks of growing size. Blocks arrive with their hash already
+    computed once (as `block.hash` in the add_block endpoints), so
+    the timing only covers linking the block to the tip. The legacy
+    column adds the three full re-hashes the old code did per append.
+    """
+    Difficulty.LEGACY_TARGET = Difficulty.MAX_TARGET
+    print("{:>8} {:>16} {:>16}".format("txs", "append (us)", "legacy (us)"))
+    for n_tx in (1, 10, 100):
+        chain = Blockchain()
+        info = [sample_tx(i) for i in range(n_tx)]
+        append = legacy = 0.0
+        for index in range(1, args.blocks + 1):
+            block = Block(index, info, 1600000000.0 + index, chain.last_block.hash)
+            block.hash
+
+            start = time.perf_counter()
+            chain.add_block(block, block.hash)
+            append += time.perf_counter() - start
+
+            if index % 100 == 0:
+                start = time.perf_counter()
+                chain.chain[-2].compute_hash()
+                block.compute_hash()
+                block.compute_hash()
+                legacy += (time.perf_counter() - start) * 100
+        print("{:>8} {:>16.2f} {:>16.2f}".format(n_tx, append / args.blocks * 1e6,
+                                                 (append + legacy) / args.blocks * 1e6))
+
+
+class DictBlock:
+    """
+    The block layout before __slots__, for comparison.
+    """
+
+    def __init__(self, index, info, timestamp, previous_hash, previous_idx_hash=0):
+        self.__index = index
+        self.__info = info
+        self.__timestamp = timestamp
+        self.__previous_hash = previous_hash
+        self.nonce = 0
+        self.__previous_idx_hash = previous_idx_hash
+
+
+def bench_memory(args):
+    """
+    Memory held by `--blocks` block objects (their info lists are
+    shared, so only the block objects themselves are counted),
+    extrapolated to 1M blocks, plus wire size of one block.
+    """
+    info = [sample_tx(0)]
+    print("{:>12} {:>16}".format("layout", "MB per 1M blocks"))
+    for name, block_class in (("__dict__", DictBlock), ("__slots__", Block)):
+        tracemalloc.start()
+        blocks = [block_class(i, info, 1600000000.0 + i, "%064x" % i, "%064x" % i)
+                  for i in range(args.blocks)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{:>12} {:>16.1f}".format(name, size / len(blocks) * 1e6 / 2 ** 20))
+        del blocks
+
+    block = sample_block(1, 10, "%064x" % 1)
+    print("wire bytes for a 10-tx block: json {}, binary {}".format(
+        len(json.dumps(block.to_dict(), sort_keys=True)), len(encode_block(block))))
+
+
+def bench_index(args):
+    """
+    Per-block cost of persisting the index and committing to it, for a
+    block of 100 NFT mints, as the index grows to `--entries` entries.
+    The pickle column is the old path: rewrite the whole file and
+    hash its sorted JSON dump.
+    """
+    folder = tempfile.mkdtemp()
+    sizes = [n for n in (10000, 100000, 1000000) if n <= args.entries]
+    print("{:>10} {:>14} {:>14}".format("entries", "pickle (ms)", "wal (ms)"))
+    for size in sizes:
+        bc_idx = collections.defaultdict(dict)
+        for i in range(size):
+            bc_idx["%064x" % (i % 1000)]["%064x" % i] = "/nfts/%d.png" % i
+        timings = []
+        for mode in ("pickle", "wal"):
+            store = IndexStore.create(os.path.join(folder, "%s-%d.idx" % (mode, size)), mode)
+            store.reset(bc_idx)
+            commitment = IndexCommitment()
+            blocks = 5
+            start = time.perf_counter()
+            for block in range(blocks):
+                mutations = [("set", "%064x" % i, "new-%d-%d-%s" % (block, i, mode), "/nfts/x.png")
+                             for i in range(100)]
+                for mutation in mutations:
+                    if mode == "wal":
+                        commitment.update(bc_idx, mutation)
+                    IndexStore.apply_mutation(bc_idx, mutation)
+                store.save(bc_idx, mutations)
+                if mode == "pickle":
+                    json.dumps(store.load(), sort_keys=True)
+                else:
+                    commitment.hexdigest()
+            timings.append((time.perf_counter() - start) / blocks * 1e3)
+        print("{:>10} {:>14.2f} {:>14.2f}".format(size, *timings))
+
+
+def bench_indexdb(args):
+    """
+    Index stores compared on an NFT index of `--entries` tokens, 10 per
+    owner: opening the saved index, looking up an owner's tokens, and
+    saving a block of 100 mints (mutations applied, then saved). The
+    sqlite index is created by the migration from the pickle file.
+    """
+    import random
+
+    folder = tempfile.mkdtemp()
+    owners = max(1, args.entries // 10)
+    bc_idx = collections.defaultdict(dict)
+    for i in range(args.entries):
+        bc_idx["%064x" % (i % owners)]["%064x" % i] = "/nfts/%d.json" % i
+    pickle_path = os.path.join(folder, "nfts_idx.pkl")
+    wal_path = os.path.join(folder, "wal", "nfts_idx.pkl")
+    os.makedirs(os.path.dirname(wal_path))
+    IndexStore.PickleIndexStore(pickle_path).save(bc_idx, [])
+    IndexStore.WalIndexStore(wal_path).compact(bc_idx)
+    start = time.perf_counter()
+    IndexStore.migrate(pickle_path, IndexStore.SqliteIndexStore(pickle_path).path)
+    print("migrated {} entries in {:.1f}s".format(args.entries, time.perf_counter() - start))
+    del bc_idx
+
+    print("{:>8} {:>10} {:>10} {:>14} {:>14}".format("store", "size (MB)", "open (s)", "lookup (us)", "block (ms)"))
+    paths = {"pickle": pickle_path, "wal": wal_path, "sqlite": pickle_path}
+    for mode, path in paths.items():
+        store = IndexStore.create(path, mode)
+        start = time.perf_counter()
+        index, _ = store.open(collections.defaultdict(dict))
+        opened = time.perf_counter() - start
+        size = sum(os.path.getsize(f) for f in (store.path, store.path + ".wal", store.path + "-wal")
+                   if os.path.exists(f))
+
+        keys = ["%064x" % random.randrange(owners) for _ in range(10000)]
+        start = time.perf_counter()
+        for key in keys:
+            index[key]
+        lookup = (time.perf_counter() - start) / len(keys)
+
+        blocks = 0
+        start = time.perf_counter()
+        while blocks == 0 or time.perf_counter() - start < args.seconds:
+            mutations = [("set", "%064x" % random.randrange(owners), "new-%d-%d" % (blocks, i), "/nfts/x.json")
+                         for i in range(100)]
+            for mutation in mutations:
+                IndexStore.apply_mutation(index, mutation)
+            store.save(index, mutations)
+            blocks += 1
+        block = (time.perf_counter() - start) / blocks
+        print("{:>8} {:>10.1f} {:>10.2f} {:>14.2f} {:>14.2f}".format(
+            mode, size / 2 ** 20, opened, lookup * 1e6, block * 1e3))
+        del index
+
+
+def legacy_owner_of(nfts, tokenId):
+    for block in nfts.chain[::-1]:
+        for inf in block.info[::-1]:
+            if inf["tokenId"] == tokenId:
+                return inf["to"]
+    return None
+
+
+def bench_ownership(args):
+    """
+    Latency of the owner lookup done by every NFT transfer, as the
+    history grows to `--entries` NFTs (1000 mints per block). The
+    token index is compared with the old scan over the chain, for the
+    oldest token (worst case of the scan).
+    """
+    Difficulty.LEGACY_TARGET = Difficulty.MAX_TARGET
+    nfts = Blockchain()
+    NFT.attach_indexes(nfts)
+    per_block = 1000
+    checkpoints = [n for n in (1000, 10000, 100000, 1000000) if n <= args.entries]
+    print("{:>10} {:>14} {:>14}".format("nfts", "index (us)", "scan (us)"))
+    minted = 0
+    for checkpoint in checkpoints:
+        while minted < checkpoint:
+            info = [{"from": "0", "to": "%064x" % (i % 97), "tokenId": "%064x" % i,
+                     "timestamp": 1600000000.0 + i} for i in range(minted, minted + per_block)]
+            block = Block(nfts.last_block.index + 1, info, 1600000000.0 + minted, nfts.last_block.hash)
+            nfts.add_block(block, block.hash)
+            minted += per_block
+
+        oldest = "%064x" % 0
+        tokens = nfts.indexes["tokens"]
+        start = time.perf_counter()
+        for _ in range(1000):
+            tokens.owner(oldest)
+        index_us = (time.perf_counter() - start) / 1000 * 1e6
+
+        runs = 3
+        start = time.perf_counter()
+        for _ in range(runs):
+            assert legacy_owner_of(nfts, oldest) == tokens.owner(oldest)
+        scan_us = (time.perf_counter() - start) / runs * 1e6
+        print("{:>10} {:>14.2f} {:>14.0f}".format(checkpoint, index_us, scan_us))
+
+
+class SyntheticFile:
+    """
+    Readable stream of `size` pseudo-random bytes produced on the fly.
+    """
+
+    def __init__(self, size, seed=b"nft"):
+        self.remaining = size
+        self.block = hashlib.sha256(seed).digest() * (2 ** 15)
+        self.counter = 0
+
+    def read(self, n=-1):
+        n = self.remaining if n < 0 else min(n, self.remaining)
+        parts = []
+        while sum(len(p) for p in parts) < n:
+            self.counter += 1
+            parts.append(self.counter.to_bytes(8, "big") + self.block)
+        self.remaining -= n
+        return b"".join(parts)[:n]
+
+
+def bench_upload(args):
+    """
+    Streams a synthetic `--size-mb` file through ChunkStore and reports
+    throughput and the peak Python memory, which stays around one
+    chunk no matter how large the file is.
+    """
+    store = ChunkStore(tempfile.mkdtemp())
+    size = args.size_mb * 2 ** 20
+    tracemalloc.start()
+    start = time.perf_counter()
+    tokenId, manifest = store.put_stream(SyntheticFile(size), "synthetic.bin")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{} MB in {} chunks: {:.0f} MB/s, peak memory {:.1f} MB (chunk size {:.1f} MB)".format(
+        args.size_mb, len(manifest["chunks"]), args.size_mb / elapsed,
+        peak / 2 ** 20, store.chunk_size / 2 ** 20))
+
+    start = time.perf_counter()
+    store.put_stream(SyntheticFile(size), "again.bin")
+    print("re-upload of the same file (all chunks deduplicated): {:.0f} MB/s".format(
+        args.size_mb / (time.perf_counter() - start)))
+
+
+class SlowPeer(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every POST after `delay` seconds, like a slow or far node.
+    """
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.delay)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_slow_peers(count, delay):
+    peers = []
+    for i in range(count):
+        handler = type("SlowPeer%d" % i, (SlowPeer,), {"delay": delay * (i + 1) / count})
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        peers.append("http://127.0.0.1:%d" % server.server_port)
+    return peers
+
+
+def bench_peers(args):
+    """
+    Announces a block to `--peers` local peers answering after up to
+    `--delay` seconds: one after the other as before, through
+    Peers.fan_out (about the slowest peer) and through Peers.broadcast
+    (returns at once).
+    """
+    peers = start_slow_peers(args.peers, args.delay)
+    block = sample_block(1, 100)
+
+    start = time.perf_counter()
+    for peer in peers:
+        requests.post(peer + "/tx/add_block", data=json.dumps(block.to_dict(), sort_keys=True))
+    print("sequential: {:.3f}s".format(time.perf_counter() - start))
+
+    start = time.perf_counter()
+    Peers.fan_out(peers, lambda peer: Wire.post_block(peer, peer + "/tx/add_block", block))
+    print("fan-out:    {:.3f}s (slowest peer {:.3f}s)".format(time.perf_counter() - start, args.delay))
+
+    start = time.perf_counter()
+    futures = Peers.broadcast(peers, lambda peer: Wire.post_block(peer, peer + "/tx/add_block", block))
+    returned = time.perf_counter() - start
+    concurrent.futures.wait(futures)
+    print("broadcast:  returned after {:.3f}s, delivered after {:.3f}s".format(
+        returned, time.perf_counter() - start))
+
+
+def use_temp_node(args):
+    """
+    Points the node imported from app.py to a temporary folder, with
+    mining only on request.
+    """
+    config.UPLOAD_FOLDER = tempfile.mkdtemp()
+    config.CHAIN_FOLDER = os.path.join(config.UPLOAD_FOLDER, "chains")
+    config.SNAPSHOT_FOLDER = os.path.join(config.UPLOAD_FOLDER, "snapshots")
+    config.MINING_MAX_AGE = float("inf")
+    config.NODE_RUNTIME = args.runtime
+
+
+def bench_ingest(args):
+    """
+    Transactions per second admitted through POST /tx/new_transaction,
+    one per request, and through POST /tx/new_transactions in batches
+    of 1000, using Flask's test client on a node in a temporary folder.
+    """
+    use_temp_node(args)
+    import app
+
+    client = app.app.test_client()
+    # Participants must be registered users (pending registrations count)
+    body = {"access_key": "PASSWORD", "users": [{"name": "bench", "description": "d"}] * 1001}
+    users = [json.loads(line) for line in client.post("/users/new_users", json=body).get_data().splitlines()]
+    key, sender = users[0]["private_key"], users[0]["public_key"]
+    recipients = [user["public_key"] for user in users[1:]]
+
+    def tx_data(i):
+        return {"from": sender, "to": recipients[i % 1000], "value": i + 1,
+                "private_key": key, "description": "donation #%d" % i}
+
+    count = 0
+
+    def single(i):
+        nonlocal count
+        client.post("/tx/new_transaction", json=tx_data(count))
+        count += 1
+
+    def batch(i):
+        nonlocal count
+        client.post("/tx/new_transactions", json=[tx_data(count + j) for j in range(1000)])
+        count += 1000
+
+    print("single: {:.0f} tx/s".format(rate(single, args.seconds)))
+    print("batch:  {:.0f} tx/s".format(rate(batch, args.seconds) * 1000))
+
+
+def bench_isolation(args):
+    """
+    Latency of POST /tx/new_transaction on an idle node, and while the
+    nfts chain mines blocks of 5 leading hex zeros back to back, for
+    `--seconds` each, in the `--runtime` given. With a worker per chain
+    the proof of work only slows the tx chain down if they have to
+    share a core.
+    """
+    use_temp_node(args)
+    config.MINING_BLOCK_SIZE = 10 ** 8
+    Difficulty.LEGACY_TARGET = Difficulty.target_from_difficulty(5)
+    import app
+
+    client = app.app.test_client()
+    body = {"access_key": "PASSWORD", "users": [{"name": "bench", "description": "d"}] * 2}
+    users = [json.loads(line) for line in client.post("/users/new_users", json=body).get_data().splitlines()]
+    count = 0
+
+    def latencies(running):
+        nonlocal count
+        samples = []
+        while running():
+            start = time.perf_counter()
+            client.post("/tx/new_transaction", json={
+                "from": users[0]["public_key"], "to": users[1]["public_key"], "value": count + 1,
+                "private_key": users[0]["private_key"], "description": "isolation"})
+            samples.append(time.perf_counter() - start)
+            count += 1
+        samples.sort()
+        return "p50 {:.2f} ms, p99 {:.2f} ms ({} requests)".format(
+            samples[len(samples) // 2] * 1000, samples[len(samples) * 99 // 100] * 1000, len(samples))
+
+    deadline = time.perf_counter() + args.seconds
+    print("{}, idle:        {}".format(args.runtime, latencies(lambda: time.perf_counter() < deadline)))
+
+    blocks, job = 0, None
+
+    def mining():
+        # nfts blocks back to back until the time is up
+        nonlocal blocks, job
+        if job is not None and client.get("/mining/jobs/{}".format(job)).get_json()["status"] in ("queued", "running"):
+            return True
+        if time.perf_counter() >= deadline:
+            return False
+        with io.BytesIO(os.urandom(1024)) as f:
+            client.post("/nfts/new_file", data={"from": "0", "to": users[0]["public_key"],
+                                                "private_key": users[0]["private_key"], "file": (f, "nft.bin")})
+        job = client.get("/nfts/mine").get_json()["job"]
+        blocks += 1
+        return True
+
+    deadline = time.perf_counter() + args.seconds
+    print("{}, nfts mining: {}, {} blocks".format(args.runtime, latencies(mining), blocks))
+
+
+def bench_registry(args):
+    """
+    Participant checks per second against a registry of `--entries`
+    users, and keypair verifications per second with and without the
+    cache of derived public keys.
+    """
+    import Users
+    registry = Users.UserRegistry()
+    keys = ["key%d" % i for i in range(args.entries)]
+    for key in keys:
+        registry.apply_pending({"name": key, "public_key": Users.public_key_of(key)})
+    public_keys = [Users.public_key_of(key) for key in keys]
+
+    def check(i):
+        Users.check_participants(registry, public_keys[i % len(keys)], public_keys[-1 - i % len(keys)])
+
+    def uncached(i):
+        key = keys[i % len(keys)]
+        return hashlib.sha256(key.encode('utf-8')).hexdigest() == public_keys[i % len(keys)]
+
+    def cached(i):
+        Users.verify_keypair(public_keys[i % len(keys)], keys[i % len(keys)])
+
+    print("participant checks: {:.0f}/s".format(rate(check, args.seconds)))
+    print("keypair, sha256:    {:.0f}/s".format(rate(uncached, args.seconds)))
+    print("keypair, cached:    {:.0f}/s".format(rate(cached, args.seconds)))
+
+
+def bench_users(args):
+    """
+    Users registered per second through POST /users/new_user, one per
+    request, and through POST /users/new_users in batches of 1, 1k and
+    100k (reading the whole streamed reply), on a node in a temporary
+    folder.
+    """
+    use_temp_node(args)
+    config.MEMPOOL_MAX_SIZE = 10 ** 8
+    import app
+
+    client = app.app.test_client()
+
+    def single():
+        client.post("/users/new_user", json={"access_key": "PASSWORD", "name": "u", "description": "d"})
+        return 1
+
+    def bulk(size):
+        body = {"access_key": "PASSWORD", "users": [{"name": "u%d" % i, "description": "d"} for i in range(size)]}
+        return lambda: client.post("/users/new_users", json=body).get_data().count(b"\n")
+
+    for name, register in [("new_user", single), ("batch 1", bulk(1)),
+                           ("batch 1k", bulk(1000)), ("batch 100k", bulk(100000))]:
+        registered = 0
+        start = time.perf_counter()
+        while registered == 0 or time.perf_counter() - start < args.seconds:
+            registered += register()
+        print("{:10} {:.0f} users/s".format(name + ":", registered / (time.perf_counter() - start)))
+
+
+def bench_validate(args):
+    """
+    Validates a chain of `--blocks` mined blocks in JSON form, as
+    received from a peer: on one core, on all cores, from a checkpoint
+    at 90% of the chain, and with a tampered block at 10% (early exit).
+    """
+    miner = Miner.SerialMiner()
+    chain, previous_hash = [], "0"
+    for index in range(args.blocks):
+        block = sample_block(index, 10, previous_hash)
+        previous_hash = miner.search(block, Difficulty.block_target(block))
+        chain.append(block.to_dict())
+
+    def run(label, dump, **kwargs):
+        report = Validator.validate_chain(dump, **kwargs)
+        print("{:<22} {!r} in {:.2f}s".format(label, report, report.seconds))
+
+    run("1 worker:", chain, workers=1)
+    run("{} workers:".format(os.cpu_count()), chain)
+    height = args.blocks * 9 // 10
+    checkpoint_hash = chain[height + 1]["_Block__previous_hash"]
+    run("checkpoint at 90%:", chain, checkpoint=(height, checkpoint_hash))
+    tampered = list(chain)
+    tampered[args.blocks // 10] = dict(chain[args.blocks // 10], nonce=-1)
+    run("tampered at 10%:", tampered)
+
+
+def bench_retarget(args):
+    """
+    Simulates mining under a hashrate (hashes/s) that jumps 10x up,
+    then 50x down, and prints the average block time every 5 retarget periods: it
+    should return to BLOCK_INTERVAL after each jump. Block times are
+    drawn from the exponential distribution of a proof-of-work search
+    at the current target; no hashing is done.
+    """
+    import random
+
+    random.seed(1)
+    period = config.RETARGET_INTERVAL * 5
+    phases = [(1e3, 4 * period), (1e4, 4 * period), (2e2, 4 * period)]
+    schedule = Difficulty.TargetSchedule([(0.0, None)])
+    now, height = 0.0, 1
+    print("{:>8} {:>12} {:>16}".format("height", "hashrate", "block time (s)"))
+    for hashrate, blocks in phases:
+        window_start = now
+        for _ in range(blocks):
+            target = schedule.required(height)
+            expected_hashes = (Difficulty.MAX_TARGET + 1) / (target + 1)
+            now += random.expovariate(hashrate / expected_hashes)
+            schedule.append(now, target)
+            if height % period == 0:
+                print("{:>8} {:>12.0f} {:>16.2f}".format(height, hashrate, (now - window_start) / period))
+                window_start = now
+            height += 1
+
+
+def bench_search(args):
+    """
+    Builds the transaction search index over `--entries` transactions
+    (1000 per block), then times its save and load and a few queries,
+    each a median of 20 runs.
+    """
+    import statistics
+    import Search
+    import Transactions
+
+    topics = ["flood", "school", "hospital", "relief", "books", "water", "food", "shelter"]
+    blocks, per_block = [], 1000
+    for index in range(args.entries // per_block):
+        info = [{"from": "%064x" % (i % 5000), "to": "%064x" % (i % 77), "value": i % 1000,
+                 "description": "{} {} donation {}".format(topics[i % 8], topics[i * 7 % 5], i),
+                 "timestamp": 1600000000.0 + i}
+                for i in range(index * per_block, (index + 1) * per_block)]
+        blocks.append(Block(index, info, 1600000000.0 + index * per_block, "0"))
+
+    path = os.path.join(tempfile.mkdtemp(), "search.json")
+    index = Search.SearchIndex(path, Transactions.amount)
+    start = time.perf_counter()
+    index.rebuild(blocks)
+    print("indexed {} transactions in {:.1f}s".format(len(index), time.perf_counter() - start))
+    start = time.perf_counter()
+    index.save()
+    print("saved in {:.2f}s".format(time.perf_counter() - start))
+    start = time.perf_counter()
+    Search.SearchIndex(path, Transactions.amount).rebuild(blocks)
+    print("boot from the saved index: {:.2f}s".format(time.perf_counter() - start))
+
+    queries = {"q=flood": {"q": "flood"},
+               "q=flood school": {"q": "flood school"},
+               "q=donation 123456": {"q": "donation 123456"},
+               "min_value=990": {"min_value": 990},
+               "since (last 1%)": {"since": 1600000000.0 + args.entries * 0.99},
+               "q=water, value 100-120": {"q": "water", "min_value": 100, "max_value": 120}}
+    for label, query in queries.items():
+        timings = []
+        for _ in range(20):
+            start = time.perf_counter()
+            matches = index.search(**query)
+            for doc in matches:
+                index.transaction(doc)
+            timings.append(time.perf_counter() - start)
+        print("{:<24} {:>4} results {:>8.2f} ms".format(label, len(matches), statistics.median(timings) * 1e3))
+
+
+def bench_startup(args):
+    """
+    Cold start of a transaction chain of `--blocks` blocks (10
+    transactions each) from its block store: with the indexes rebuilt
+    from every block, and restored from a snapshot taken 100 blocks
+    before the tip, so only those are replayed.
+    """
+    from BlockStore import BlockStore
+    import Snapshot
+    import Transactions
+
+    Difficulty.LEGACY_TARGET = Difficulty.MAX_TARGET
+    config.UPLOAD_FOLDER = tempfile.mkdtemp()
+    config.BLOCK_STORE_FSYNC = False
+    # The search index is saved along with the snapshot instead
+    config.SEARCH_SAVE_EVERY = args.blocks
+    folder = os.path.join(config.UPLOAD_FOLDER, "tx")
+    path = Snapshot.snapshot_path("tx", config.UPLOAD_FOLDER)
+
+    def open_chain(snapshot):
+        # As in Runtime.py
+        gc.disable()
+        bc = Blockchain(store=BlockStore(folder))
+        if snapshot:
+            Snapshot.restore(bc, path)
+        Transactions.attach_indexes(bc)
+        gc.freeze()
+        gc.enable()
+        return bc
+
+    bc = open_chain(False)
+    start = time.perf_counter()
+    for index in range(1, args.blocks):
+        info = [dict(sample_tx(index * 10 + i), **{"from": "%064x" % (i % 1000)}) for i in range(10)]
+        block = Block(index, info, 1600000000.0 + index, bc.last_block.hash)
+        bc.add_block(block, block.hash)
+        if index == args.blocks - 101:
+            Snapshot.save(bc, path)
+            bc.indexes["search"].save()
+    bc.chain.close()
+    print("built {} blocks in {:.1f}s".format(args.blocks, time.perf_counter() - start))
+
+    for label, snapshot in (("full rebuild", False), ("from snapshot", True)):
+        start = time.perf_counter()
+        bc = open_chain(snapshot)
+        elapsed = time.perf_counter() - start
+        print("{:<14} {:>8.2f}s  ({} blocks, {} addresses)".format(
+            label + ":", elapsed, len(bc.chain), len(bc.indexes["addresses"].totals)))
+        bc.chain.close()
+    print("snapshot size: {:.1f} MB".format(os.path.getsize(path) / 2 ** 20))
+
+
+BENCHMARKS = {
+    "hashing": bench_hashing,
+    "append": bench_append,
+    "memory": bench_memory,
+    "index": bench_index,
+    "ownership": bench_ownership,
+    "upload": bench_upload,
+    "peers": bench_peers,
+    "ingest": bench_ingest,
+    "validate": bench_validate,
+    "retarget": bench_retarget,
+    "search": bench_search,
+    "registry": bench_registry,
+    "users": bench_users,
+    "startup": bench_startup,
+    "indexdb": bench_indexdb,
+    "isolation": bench_isolation,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--seconds", type=float, default=1.0,
+                        help="time spent on each measurement")
+    parser.add_argument("--blocks", type=int, default=100000,
+                        help="chain length")
+    parser.add_argument("--entries", type=int, default=1000000,
+                        help="index size")
+    parser.add_argument("--size-mb", type=int, default=2048,
+                        help="size of the synthetic upload")
+    parser.add_argument("--peers", type=int, default=20,
+                        help="number of simulated peers")
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="answer time of the slowest simulated peer (seconds)")
+    parser.add_argument("--runtime", choices=["processes", "threads"], default=config.NODE_RUNTIME,
+                        help="where the chains of a benchmarked node run (see Runtime.py)")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -3,6 +3,118 @@ Define shared global data between modules,
 i.e., users, nfts, transactions
 """
 
-UPLOAD_FOLDER = '/Users/zhangxinyu/Downloads/nfts'
+import os
+
+UPLOAD_FOLDER = os.environ.get('BC_UPLOAD_FOLDER', '/Users/zhangxinyu/Downloads/nfts')
 NFT_INDEX = 'nfts_idx.pkl'
 TRANSACTION_INDEX = 'transactions_idx.pkl'
+# Search index over the sealed transactions (see Search.py)
+TRANSACTION_SEARCH_INDEX = 'transactions_search.json'
+# NFT files are stored in chunks of this size (bytes), see ChunkStore.py
+NFT_CHUNK_SIZE = 4 * 2 ** 20
+# sqlite file of all minted tokenIds; None keeps the set in memory
+NFT_TOKEN_SET = None
+# Keys the Bloom filter in front of the on-disk token set is sized for
+NFT_BLOOM_CAPACITY = 10 * 10 ** 6
+# How index files are written: "pickle" (whole index per save),
+# "wal" (append mutations to a log) or "sqlite" (the index lives in
+# sqlite, not in memory), see IndexStore.py
+INDEX_MODE = "sqlite"
+# Saves folded into a new index snapshot in "wal" mode
+INDEX_COMPACT_EVERY = 1000
+# Index changes of the entries sealed in the last REORG_UNDO_BLOCKS
+# blocks are kept, to be undone if a reorg drops those entries
+REORG_UNDO_BLOCKS = 1000
+
+# Proof-of-work engine: "serial" or "parallel"
+MINING_MODE = "serial"
+# Worker processes of the parallel engine (None: all cores)
+MINING_WORKERS = None
+# Nonces searched by a parallel worker per task
+MINING_CHUNK_SIZE = 4096
+
+# Block format of new blocks: "legacy" or "merkle"
+BLOCK_FORMAT = "legacy"
+
+# On-disk block stores, one sub-folder per chain (see BlockStore.py)
+CHAIN_FOLDER = os.path.join(UPLOAD_FOLDER, 'chains')
+# A new segment file is started past this size (bytes)
+BLOCK_SEGMENT_SIZE = 64 * 2 ** 20
+# fsync every appended block before it is indexed
+BLOCK_STORE_FSYNC = True
+
+# Snapshots of the indexes and mempools for fast restarts, one file per
+# chain, written every SNAPSHOT_INTERVAL seconds (see Snapshot.py)
+SNAPSHOT_FOLDER = os.path.join(UPLOAD_FOLDER, 'snapshots')
+SNAPSHOT_INTERVAL = 60.0
+
+# Most blocks returned by one page of GET /*/chain
+CHAIN_PAGE_LIMIT = 500
+
+# Requests to peers (see Peers.py): concurrent requests, (connect, read)
+# timeout in seconds, retries of a failed request and the first backoff
+# in seconds, doubled on each retry
+PEER_WORKERS = 16
+PEER_TIMEOUT = (3.05, 10)
+PEER_RETRIES = 2
+PEER_BACKOFF = 0.2
+
+# Background mining (see Scheduler.py): a block is mined once this many
+# entries are pending, or once the oldest one waited this many seconds
+MINING_BLOCK_SIZE = 100
+MINING_MAX_AGE = 10.0
+# Seconds between checks of the thresholds
+MINING_POLL_INTERVAL = 0.5
+# Finished jobs kept for GET /mining/jobs/<id>
+MINING_JOB_HISTORY = 1000
+
+# Most entries waiting to be mined per chain; more are refused with 429
+# (see Mempool.py)
+MEMPOOL_MAX_SIZE = 100000
+# Most transactions accepted by one POST /tx/new_transactions
+TX_BATCH_LIMIT = 10000
+# Most users registered by one POST /users/new_users
+USER_BATCH_LIMIT = 100000
+
+# Full-chain validation (see Validator.py): worker processes (None: all
+# cores) and blocks hashed per task
+VALIDATION_WORKERS = None
+VALIDATION_CHUNK_SIZE = 1000
+# Trusted (height, hash) per chain, e.g. {"tx": (100000, "00ab...")}:
+# the proofs of work up to it are not re-checked (the blocks are still
+# hashed and linked) and those blocks are never replaced by a sync
+CHAIN_CHECKPOINTS = {}
+
+# Proof of work (see Difficulty.py): targets are retargeted every
+# RETARGET_INTERVAL blocks towards one block per BLOCK_INTERVAL seconds,
+# by at most MAX_RETARGET_FACTOR at a time. Blocks without a recorded
+# target need LEGACY_DIFFICULTY leading hex zeros.
+LEGACY_DIFFICULTY = 2
+BLOCK_INTERVAL = 10.0
+RETARGET_INTERVAL = 20
+MAX_RETARGET_FACTOR = 4
+# A block timestamp must be above the median of the last
+# MEDIAN_TIME_BLOCKS blocks and at most MAX_FUTURE_DRIFT seconds ahead
+# of the local clock
+MEDIAN_TIME_BLOCKS = 11
+MAX_FUTURE_DRIFT = 2 * 60 * 60
+
+# Most transactions returned by one page of GET /tx/address/<address>/history
+ADDRESS_PAGE_LIMIT = 100
+
+# The transaction search index is saved every this many blocks
+SEARCH_SAVE_EVERY = 100
+# Most transactions returned by one page of GET /tx/search
+SEARCH_PAGE_LIMIT = 100
+
+# Senders and recipients of transactions and NFTs must be registered
+# on the users chain (see Users.UserRegistry)
+REQUIRE_REGISTERED_USERS = True
+# Private -> public key derivations kept by Users.public_key_of
+KEYPAIR_CACHE_SIZE = 100000
+
+# Where the chains run (see Runtime.py): "processes" (a worker process
+# per chain behind the HTTP front-end) or "threads" (all in one process)
+NODE_RUNTIME = "processes"
+# Requests a chain worker handles at once
+WORKER_THREADS = 16
@@ -0,0 +1,98 @@
+"""
+Runs a few nodes on local ports to try out chain sync.
+
+    python localnet.py --nodes 2 --blocks 20
+
+Every node gets its own data folder (BC_UPLOAD_FOLDER). The first node
+mines `--blocks` blocks on the users chain, the others register it as a
+peer and sync; then it mines one more block and they sync again, which
+should only download that block.
+
+tests/test_sync.py runs the same over in-process nodes, with a fork
+and a reorg, as part of the test suite.
+"""
+
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+
+def start_node(port, folder):
+    env = dict(os.environ, BC_UPLOAD_FOLDER=folder)
+    return subprocess.Popen([sys.executable, "app.py", "--port", str(port)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url + "/users/tip")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError("node {} did not start".format(url))
+
+
+def mine_users(url, count):
+    for i in range(count):
+        requests.post(url + "/users/new_user",
+                      json={"access_key": "PASSWORD", "name": "user%d" % i, "description": "localnet"})
+        response = requests.get(url + "/users/mine")
+        if response.status_code == 202:
+            wait_for_job(url, response.json()["job"])
+
+
+def wait_for_job(url, job_id):
+    while requests.get("{}/mining/jobs/{}".format(url, job_id)).json()["status"] in ("queued", "running"):
+        time.sleep(0.05)
+
+
+def sync(url):
+    start = time.perf_counter()
+    adopted = requests.get(url + "/users/sync").json()["adopted"]
+    return adopted, time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--nodes", default=2, type=int)
+    parser.add_argument("--blocks", default=20, type=int)
+    parser.add_argument("--port", default=5100, type=int, help="port of the first node")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="localnet-")
+    urls = ["http://127.0.0.1:{}".format(args.port + i) for i in range(args.nodes)]
+    nodes = [start_node(args.port + i, os.path.join(root, "node%d" % i)) for i in range(args.nodes)]
+    try:
+        for url in urls:
+            wait_for(url)
+        miner, followers = urls[0], urls[1:]
+
+        mine_users(miner, args.blocks)
+        for url in followers:
+            requests.post(url + "/register_node", json={"node_address": miner})
+        print("miner height", requests.get(miner + "/users/tip").json()["height"])
+
+        for url in followers:
+            print("{} initial sync: {} blocks in {:.2f}s".format(url, *sync(url)))
+
+        mine_users(miner, 1)
+        for url in followers:
+            print("{} incremental sync: {} blocks in {:.2f}s".format(url, *sync(url)))
+            assert requests.get(url + "/users/tip").json() == requests.get(miner + "/users/tip").json()
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait()
+    print("data in", root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Converts the pickle index files of a node to sqlite (see IndexStore.py).
+
+    python migrate_index.py
+    python migrate_index.py /path/to/nfts_idx.pkl /path/to/transactions_idx.pkl
+
+Without arguments, the index files in UPLOAD_FOLDER are migrated. A node
+with INDEX_MODE = "sqlite" migrates them on its first start as well;
+this does it ahead of time, e.g. for large indexes. The pickle files
+are left in place.
+"""
+
+from argparse import ArgumentParser
+import os
+import time
+
+import config
+import IndexStore
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("paths", nargs="*", help="pickle index files (default: the node's)")
+    args = parser.parse_args()
+
+    paths = args.paths or [os.path.join(config.UPLOAD_FOLDER, name)
+                           for name in (config.NFT_INDEX, config.TRANSACTION_INDEX)]
+    for path in paths:
+        if not os.path.exists(path):
+            print("{}: not found".format(path))
+            continue
+        target = IndexStore.SqliteIndexStore(path).path
+        if os.path.exists(target):
+            print("{}: {} exists, skipped".format(path, target))
+            continue
+        start = time.perf_counter()
+        keys = IndexStore.migrate(path, target)
+        print("{}: {} keys -> {} in {:.1f}s".format(path, keys, target, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+
+import pytest
+
+# The modules of the node are flat files next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Peers  # noqa: E402
+
+
+class Reply:
+    """
+    The parts of a requests.Response that Sync and Wire read.
+    """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.get_data()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class Network:
+    """
+    Nodes of this process, reached at http://<name> through Peers.
+    """
+
+    def __init__(self, monkeypatch):
+        self.clients = {}
+        monkeypatch.setattr(Peers, "request", self.request)
+
+    def add(self, name, app):
+        self.clients["http://" + name] = app.test_client()
+        return "http://" + name
+
+    def request(self, method, url, **kwargs):
+        host, _, path = url[len("http://"):].partition("/")
+        response = self.clients["http://" + host].open("/" + path, method=method, json=kwargs.get("json"),
+                                                       data=kwargs.get("data"),
+                                                       query_string=kwargs.get("params"),
+                                                       headers=kwargs.get("headers"))
+        return Reply(response)
+
+
+@pytest.fixture
+def network(monkeypatch):
+    return Network(monkeypatch)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+
+from flask import Flask
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from Block import (BINARY_MIMETYPE, Block, MerkleBlock, block_from_dict, decode_block,
+                   decode_chain, encode_block, encode_chain)
+import Wire
+
+DIGEST = "ab" * 32
+
+
+def sample(block_class=Block, timestamp=1600000000.25, target=None, nonce=42, index=7,
+           previous_hash=DIGEST, previous_idx_hash=0):
+    block = block_class(index, [{"from": "a", "to": "b", "value": 1.5}, {"n": [1, None, "x"]}],
+                        timestamp, previous_hash, previous_idx_hash, target)
+    block.nonce = nonce
+    return block
+
+
+def assert_round_trip(block):
+    decoded = decode_block(encode_block(block))
+    assert type(decoded) is type(block)
+    assert decoded.to_dict() == block.to_dict()
+    assert decoded.compute_hash() == block.compute_hash()
+    assert json.dumps(decoded.to_dict(), sort_keys=True) == json.dumps(block.to_dict(), sort_keys=True)
+
+
+@pytest.mark.parametrize("block_class", [Block, MerkleBlock])
+@pytest.mark.parametrize("target", [None, 2 ** 240 - 1])
+def test_round_trip(block_class, target):
+    assert_round_trip(sample(block_class, target=target))
+
+
+@pytest.mark.parametrize("fields", [
+    {"timestamp": 1600000000},          # integer timestamp, e.g. received as JSON
+    {"timestamp": 0},
+    {"timestamp": True},
+    {"timestamp": "1600000000"},
+    {"nonce": -1},
+    {"nonce": 2 ** 64},
+    {"index": 2 ** 70},
+    {"target": 2 ** 256},
+])
+def test_round_trip_of_values_outside_the_fixed_header(fields):
+    for block_class in (Block, MerkleBlock):
+        assert_round_trip(sample(block_class, **fields))
+
+
+def test_integer_timestamp_keeps_its_hash_through_json_and_binary():
+    block = block_from_dict(json.loads(json.dumps(sample(timestamp=1600000000).to_dict())))
+    assert isinstance(block.timestamp, int)
+    assert decode_block(encode_block(block)).hash == block.hash
+
+
+def test_hash_fields_which_are_not_digests():
+    assert_round_trip(sample(previous_hash="0", previous_idx_hash=DIGEST))
+    assert_round_trip(sample(previous_hash=DIGEST.upper(), previous_idx_hash=None))
+
+
+def test_chain_round_trip():
+    blocks = [sample(index=i, timestamp=float(i)) for i in range(3)] + [sample(MerkleBlock, timestamp=5)]
+    decoded = list(decode_chain(encode_chain(blocks)))
+    assert [block.hash for block in decoded] == [block.hash for block in blocks]
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\x09" + bytes(30),                              # unknown version
+    encode_block(sample())[:-3],                      # truncated info
+    encode_block(sample(target=5))[:30],              # truncated target
+    encode_block(sample(timestamp=1))[:25],           # truncated header fields
+    encode_block(sample()) + b"x",                    # trailing bytes
+])
+def test_malformed_data_raises_value_error(data):
+    with pytest.raises(ValueError):
+        decode_block(data)
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b"\x01\x00", BINARY_MIMETYPE),
+    (encode_block(sample())[:-1], BINARY_MIMETYPE),
+    (b'{"nonce": 1}', "application/json"),
+    (b"[1, 2]", "application/json"),
+    (b'{"_Block__index": 1, "_Block__info": [], "_Block__timestamp": 1.0, '
+     b'"_Block__previous_hash": "0", "_Block__target": "xyz", "nonce": 0}', "application/json"),
+])
+def test_block_from_request_rejects_malformed_bodies(body, content_type):
+    with Flask(__name__).test_request_context(data=body, content_type=content_type):
+        from flask import request
+        with pytest.raises(BadRequest):
+            Wire.block_from_request(request)
+
+
+def test_block_from_request_reads_both_encodings():
+    block = sample(MerkleBlock, timestamp=3)
+    for body, content_type in [(encode_block(block), BINARY_MIMETYPE),
+                               (json.dumps(block.to_dict()), "application/json")]:
+        with Flask(__name__).test_request_context(data=body, content_type=content_type):
+            from flask import request
+            assert Wire.block_from_request(request).hash == block.hash
+
+
+# Around every change in the length of the nonce's digits, and the ends
+# of the integer ranges the nonce could be packed into
+NONCES = sorted({n + d for n in [10 ** k for k in range(1, 20)] + [2 ** 31, 2 ** 32, 2 ** 63, 2 ** 64]
+                 for d in (-1, 0, 1)} | {0, 1, 2 ** 70})
+
+
+@pytest.mark.parametrize("block_class", [Block, MerkleBlock])
+@pytest.mark.parametrize("target", [None, 2 ** 240 - 1])
+def test_nonce_hasher_matches_sha256_of_the_full_header(block_class, target):
+    block = sample(block_class, target=target, nonce=0)
+    hash_with_nonce = block.nonce_hasher()
+    for nonce in NONCES:
+        block.nonce = nonce
+        if block_class is MerkleBlock:
+            # The nonce follows the sorted header fields
+            full_header = json.dumps(dict(sorted(block.header().items()), nonce=nonce))
+        else:
+            full_header = json.dumps(block.to_dict(), sort_keys=True)
+        full_header = full_header.encode()
+        assert hash_with_nonce(nonce) == hashlib.sha256(full_header).hexdigest() == block.compute_hash()
@@ -0,0 +1,242 @@
+import json
+import time
+
+import pytest
+
+from Block import Block
+from Blockchain import Blockchain
+import config
+import Difficulty
+from IndexCommitment import IndexCommitment
+import Miner
+import NFT
+import Search
+import Transactions
+import Users
+
+
+def new_chain():
+    return Blockchain(Miner.SerialMiner(), "legacy")
+
+
+def mine_blocks(bc, count, tag):
+    for i in range(count):
+        bc.add_new_info({"tag": tag, "n": i})
+        assert bc.mine()
+
+
+def fork_of(bc, height, count, tag):
+    """
+    A chain sharing bc's blocks up to `height`, with `count` blocks of
+    its own on top.
+    returns: the blocks above `height`
+    """
+    fork = new_chain()
+    for block in bc.chain[1:height + 1]:
+        assert fork.add_block(block, block.hash)
+    mine_blocks(fork, count, tag)
+    return fork.chain[height + 1:]
+
+
+def unsealed(block):
+    copy = Block(block.index, block.info, block.timestamp, block.previous_hash,
+                 block.previous_idx_hash, block.target)
+    copy.nonce = block.nonce
+    return copy
+
+
+@pytest.fixture
+def bc():
+    bc = new_chain()
+    mine_blocks(bc, 5, "ours")
+    return bc
+
+
+def test_replace_from_adopts_a_longer_fork(bc):
+    blocks = fork_of(bc, 2, 5, "theirs")
+    assert bc.replace_from(2, blocks)
+    assert [block.hash for block in bc.chain[3:]] == [block.hash for block in blocks]
+    # Entries of the dropped blocks are pending again
+    assert sorted(info["n"] for info in bc.unconfirmed_info) == [2, 3, 4]
+
+
+def test_replace_from_with_a_bad_block_keeps_the_chain(bc):
+    before = [block.hash for block in bc.chain]
+    blocks = [unsealed(block) for block in fork_of(bc, 2, 5, "theirs")]
+    blocks[2].nonce += 1
+    assert not bc.replace_from(2, blocks)
+    assert [block.hash for block in bc.chain] == before
+    assert len(bc.unconfirmed_info) == 0
+
+
+def test_replace_from_with_an_unlinked_block_keeps_the_chain(bc):
+    before = [block.hash for block in bc.chain]
+    blocks = fork_of(bc, 2, 5, "theirs")
+    blocks[3] = fork_of(bc, 2, 5, "others")[3]
+    assert not bc.replace_from(2, blocks)
+    assert [block.hash for block in bc.chain] == before
+
+
+def test_replace_from_rechecks_the_fork_block(bc):
+    blocks = fork_of(bc, 2, 5, "theirs")
+    # The chain moved below the tip since the blocks were validated
+    assert bc.replace_from(1, fork_of(bc, 1, 6, "others"))
+    before = [block.hash for block in bc.chain]
+    assert not bc.replace_from(2, blocks)
+    assert [block.hash for block in bc.chain] == before
+
+
+def test_replace_from_rejects_a_chain_which_is_no_longer_longer(bc):
+    blocks = fork_of(bc, 2, 4, "theirs")
+    mine_blocks(bc, 1, "late")
+    before = [block.hash for block in bc.chain]
+    assert not bc.replace_from(2, blocks)
+    assert [block.hash for block in bc.chain] == before
+
+
+def mine_at(bc, timestamp, tag="timed"):
+    block = bc.block_class(bc.last_block.index + 1, [{"tag": tag}], timestamp,
+                           bc.last_block.hash, target=bc.next_target())
+    return bc.add_block(block, bc.proof_of_work(block))
+
+
+def test_add_block_rejects_a_timestamp_at_the_median_time(bc):
+    median = sorted(block.timestamp for block in bc.chain)[len(bc.chain) // 2]
+    assert not mine_at(bc, median)
+    assert mine_at(bc, median + 0.5)
+
+
+def test_add_block_rejects_a_timestamp_far_in_the_future(bc):
+    assert not mine_at(bc, time.time() + config.MAX_FUTURE_DRIFT + 60)
+
+
+def test_replace_from_follows_the_work_not_the_length(monkeypatch):
+    monkeypatch.setattr(config, "RETARGET_INTERVAL", 4)
+    start = time.time() - 10 ** 6
+    # Blocks 1 to 7 at BLOCK_INTERVAL keep the legacy target at 8
+    ours = new_chain()
+    for height in range(1, 8):
+        assert mine_at(ours, start + height * config.BLOCK_INTERVAL)
+    theirs = new_chain()
+    for block in ours.chain[1:]:
+        assert theirs.add_block(block, block.hash)
+    # Slow blocks make ours easier from height 12 on, fast ones theirs harder
+    for height in range(8, 17):
+        assert mine_at(ours, start + height * 10 ** 4, "ours")
+    for height in range(8, 13):
+        assert mine_at(theirs, start + 70 + height * 0.001, "theirs")
+    assert ours.chain[12].target > ours.chain[11].target > theirs.chain[12].target
+
+    shorter = theirs.chain[8:]
+    assert theirs.work_above(7) > ours.work_above(7)
+    assert not theirs.replace_from(7, ours.chain[8:])
+    assert ours.replace_from(7, shorter)
+    assert [block.hash for block in ours.chain] == [block.hash for block in theirs.chain]
+    assert ours.work == theirs.work == Difficulty.chain_work(ours.chain)
+
+
+def entry(i, tag):
+    # Read by all the indexes below; keys and tokens come back
+    return {"from": "%02d" % (i % 3), "to": "%02d" % (i % 4), "value": i, "description": "tx " + tag,
+            "public_key": "user%d" % (i % 5), "tokenId": "token%d" % (i % 6)}
+
+
+def attach(bc, path):
+    bc.register_index("addresses", Transactions.AddressIndex())
+    bc.register_index("search", Search.SearchIndex(path, Transactions.amount))
+    bc.register_index("registry", Users.UserRegistry())
+    bc.register_index("tokens", NFT.TokenIndex(bc))
+    return bc
+
+
+def mine_entries(bc, numbers, tag, per_block=3):
+    for i in numbers:
+        bc.add_new_info(entry(i, tag))
+        if i % per_block == per_block - 1:
+            assert bc.mine()
+
+
+def index_states(bc):
+    states = {name: json.loads(json.dumps(index.state(), sort_keys=True, default=lambda obj: obj.to_json()))
+              for name, index in bc.indexes.items() if name != "search"}
+    search = bc.indexes["search"]
+    states["search"] = {"docs": [search.transaction(doc) for doc in search.search(limit=10 ** 6)],
+                        "values": search.search(min_value=5, max_value=20, limit=10 ** 6),
+                        "postings": {word: list(ids) for word, ids in search.postings.items()}}
+    return states
+
+
+def test_reorg_undoes_the_dropped_blocks_without_a_rebuild(tmp_path, monkeypatch):
+    ours = attach(new_chain(), str(tmp_path / "ours"))
+    mine_entries(ours, range(12), "ours")
+    ours.add_new_info(entry(50, "pending"))
+    theirs = new_chain()
+    for block in ours.chain[1:3]:
+        assert theirs.add_block(block, block.hash)
+    mine_entries(theirs, range(6, 15), "theirs")
+
+    for index in ours.indexes.values():
+        monkeypatch.setattr(index, "rebuild", lambda chain: pytest.fail("rebuilt"))
+    assert ours.replace_from(2, theirs.chain[3:])
+
+    rebuilt = new_chain()
+    for block in ours.chain[1:]:
+        assert rebuilt.add_block(block, block.hash)
+    rebuilt.add_new_infos(list(ours.unconfirmed_info))
+    attach(rebuilt, str(tmp_path / "rebuilt"))
+    assert index_states(ours) == index_states(rebuilt)
+
+
+def admit(bc, numbers, tag):
+    Transactions.admit_transactions(bc, [entry(i, tag) for i in numbers])
+
+
+def idx(bc):
+    return {key: list(values) for key, values in bc.bc_idx.items() if values}
+
+
+@pytest.mark.parametrize("mode", ["pickle", "wal", "sqlite"])
+def test_reorg_undoes_the_index_changes_of_lost_entries(tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(config, "INDEX_MODE", mode)
+    ours = new_chain()
+    ours.op = str(tmp_path / config.TRANSACTION_INDEX)
+    admit(ours, range(3), "kept")
+    assert ours.mine()
+    before = idx(ours)
+    admit(ours, range(3, 6), "lost")
+    assert ours.mine()
+    theirs = new_chain()
+    assert theirs.add_block(ours.chain[1], ours.chain[1].hash)
+    mine_entries(theirs, range(3), "theirs", per_block=1)
+
+    # No room for the dropped entries
+    ours.unconfirmed_info.max_size = 0
+    assert ours.replace_from(1, theirs.chain[2:])
+    assert not ours.unconfirmed_info
+    assert idx(ours) == before
+    assert ours.check_index_validity()
+    # Saved, so the next block commits to it
+    assert ours.compute_prev_index() == IndexCommitment(ours.bc_idx).hexdigest()
+
+
+def test_reorg_keeps_the_index_changes_of_entries_pending_again(tmp_path):
+    ours = new_chain()
+    ours.op = str(tmp_path / config.TRANSACTION_INDEX)
+    admit(ours, range(6), "ours")
+    assert ours.mine()
+    expected = idx(ours)
+    theirs = new_chain()
+    mine_entries(theirs, range(2), "theirs", per_block=1)
+
+    assert ours.replace_from(0, theirs.chain[1:])
+    assert len(ours.unconfirmed_info) == 6
+    assert idx(ours) == expected
+    # Once mined again, a later reorg can still undo them
+    assert ours.mine()
+    ours.unconfirmed_info.max_size = 0
+    other = new_chain()
+    for block in ours.chain[1:3]:
+        assert other.add_block(block, block.hash)
+    mine_entries(other, range(2), "other", per_block=1)
+    assert ours.replace_from(2, other.chain[3:])
+    assert idx(ours) == {}
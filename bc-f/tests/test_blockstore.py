@@ -0,0 +1,179 @@
+import os
+import random
+import sys
+import threading
+
+import pytest
+
+from Block import Block
+from BlockStore import BlockStore
+
+
+def make_block(index, previous_hash="0"):
+    block = Block(index, [{"n": index, "pad": "x" * (index % 50)}], float(index), previous_hash)
+    block.nonce = index
+    return block
+
+
+def fill(store, count):
+    blocks, previous_hash = [], "0"
+    for index in range(len(store), len(store) + count):
+        block = make_block(index, previous_hash)
+        store.append(block)
+        blocks.append(block)
+        previous_hash = block.hash
+    return blocks
+
+
+def hashes(store):
+    return [block.hash for block in store]
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return str(tmp_path / "chain")
+
+
+def open_store(folder, **kwargs):
+    return BlockStore(folder, fsync=False, **kwargs)
+
+
+def segment(folder, number=0):
+    return os.path.join(folder, "blocks-{:06d}.seg".format(number))
+
+
+def index(folder):
+    return os.path.join(folder, "offsets.idx")
+
+
+def chop(path, count):
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - count)
+
+
+def test_reopen_keeps_blocks(folder):
+    store = open_store(folder, segment_size=300)
+    blocks = fill(store, 20)
+    store.close()
+    store = open_store(folder)
+    assert hashes(store) == [block.hash for block in blocks]
+    assert all(block.sealed for block in store)
+    assert store[-1].to_dict() == blocks[-1].to_dict()
+
+
+def test_torn_final_record_is_dropped(folder):
+    store = open_store(folder)
+    blocks = fill(store, 5)
+    store.close()
+    chop(segment(folder), 3)
+
+    store = open_store(folder)
+    assert hashes(store) == [block.hash for block in blocks[:4]]
+
+
+def test_corrupt_final_record_is_dropped(folder):
+    store = open_store(folder)
+    blocks = fill(store, 5)
+    store.close()
+    with open(segment(folder), "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    store = open_store(folder)
+    assert hashes(store) == [block.hash for block in blocks[:4]]
+
+
+def test_partial_offset_entry_is_dropped(folder):
+    store = open_store(folder)
+    blocks = fill(store, 5)
+    store.close()
+    chop(index(folder), 5)
+
+    store = open_store(folder)
+    assert hashes(store) == [block.hash for block in blocks[:4]]
+    assert os.path.getsize(index(folder)) == 4 * 12
+
+
+def test_unindexed_record_is_cut(folder):
+    # Crash after the record was written, before its offset entry
+    store = open_store(folder)
+    blocks = fill(store, 5)
+    store.close()
+    chop(index(folder), 12)
+
+    store = open_store(folder)
+    assert hashes(store) == [block.hash for block in blocks[:4]]
+    fill(store, 1)
+    store.close()
+    assert len(open_store(folder)) == 5
+
+
+@pytest.mark.parametrize("damage", [
+    lambda folder: chop(segment(folder), 3),
+    lambda folder: chop(index(folder), 5),
+    lambda folder: chop(index(folder), 12),
+])
+def test_append_after_recovery(folder, damage):
+    store = open_store(folder)
+    fill(store, 5)
+    store.close()
+    damage(folder)
+
+    store = open_store(folder)
+    recovered = hashes(store)
+    added = fill(store, 3)
+    assert hashes(store) == recovered + [block.hash for block in added]
+    store.close()
+    assert hashes(open_store(folder)) == recovered + [block.hash for block in added]
+
+
+def test_truncate_across_segments(folder):
+    store = open_store(folder, segment_size=200)
+    blocks = fill(store, 12)
+    del store[4:]
+    assert hashes(store) == [block.hash for block in blocks[:4]]
+    added = fill(store, 2)
+    store.close()
+    assert hashes(open_store(folder)) == [block.hash for block in blocks[:4] + added]
+
+
+def test_reads_while_appending_and_truncating(folder):
+    # Small segments and growing records make readers remap often
+    store = open_store(folder, segment_size=4096)
+    fill(store, 10)
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                length = len(store)
+                for height in random.sample(range(length), min(length, 20)):
+                    try:
+                        block = store[height]
+                    except IndexError:
+                        continue
+                    assert block.index == height
+                store[-1]
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    for reader in readers:
+        reader.start()
+    try:
+        for round_ in range(100):
+            fill(store, 40)
+            del store[len(store) - 15:]
+    finally:
+        done.set()
+        sys.setswitchinterval(switch_interval)
+        for reader in readers:
+            reader.join()
+    assert errors == []
+    assert [block.index for block in store] == list(range(len(store)))
+    assert store[-1].index == len(store) - 1
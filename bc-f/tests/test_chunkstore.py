@@ -0,0 +1,103 @@
+import hashlib
+import io
+import os
+import sys
+import threading
+import tracemalloc
+
+from ChunkStore import ChunkStore
+
+
+def test_round_trip_and_dedup(tmp_path):
+    store = ChunkStore(str(tmp_path), chunk_size=1024)
+    data = os.urandom(2048) * 2 + b"tail"
+    tokenId, manifest = store.put_stream(io.BytesIO(data), "f.bin")
+    store.save_manifest(tokenId, manifest)
+    assert b"".join(store.read(tokenId)) == data
+    assert len(set(manifest["chunks"])) == 3
+
+
+def test_concurrent_identical_uploads(tmp_path):
+    data = os.urandom(8192)
+    results, errors = [], []
+    store, start = None, threading.Barrier(8)
+
+    def upload():
+        start.wait()
+        try:
+            results.append(store.put_stream(io.BytesIO(data), "f.bin"))
+        except Exception as e:
+            errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for round_ in range(30):
+            # Fresh chunks each round, so the uploads race to write them
+            store = ChunkStore(str(tmp_path / str(round_)), chunk_size=1024)
+            threads = [threading.Thread(target=upload) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert len({tokenId for tokenId, _ in results}) == 1
+    leftovers = [name for _, _, names in os.walk(str(tmp_path)) for name in names if name.endswith(".tmp")]
+    assert leftovers == []
+
+
+class GeneratedStream:
+    """
+    A file-like body read from a generator, never held in memory whole.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.buffer = b""
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            part = next(self.parts, b"")
+            if not part:
+                break
+            self.buffer += part
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def test_memory_stays_bounded_for_a_large_upload(tmp_path):
+    chunk_size, total = 256 * 1024, 64 * 1024 * 1024
+    digest = hashlib.sha256()
+
+    def body():
+        # Reads of an odd size, so chunks straddle them
+        for _ in range(total // 100003):
+            part = os.urandom(100003)
+            digest.update(part)
+            yield part
+        tail = os.urandom(total % 100003)
+        digest.update(tail)
+        yield tail
+
+    store = ChunkStore(str(tmp_path), chunk_size=chunk_size)
+    tracemalloc.start()
+    try:
+        tokenId, manifest = store.put_stream(GeneratedStream(body()), "big.bin")
+        _, upload_peak = tracemalloc.get_traced_memory()
+        store.save_manifest(tokenId, manifest)
+        tracemalloc.reset_peak()
+        read_back, size = hashlib.sha256(), 0
+        for chunk in store.read(tokenId):
+            read_back.update(chunk)
+            size += len(chunk)
+        _, read_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert tokenId == digest.hexdigest() == read_back.hexdigest()
+    assert manifest["size"] == size == total
+    # A few chunks at most, against 64 MiB of content
+    assert upload_peak < 8 * chunk_size
+    assert read_peak < 4 * chunk_size
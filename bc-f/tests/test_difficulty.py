@@ -0,0 +1,48 @@
+import pytest
+
+import config
+import Difficulty
+
+
+def test_retarget_rejects_a_window_below_one_millisecond():
+    with pytest.raises(ValueError):
+        Difficulty.retarget(Difficulty.LEGACY_TARGET, 0.0001, interval=0.0001, blocks=5)
+
+
+def test_retarget_of_a_millisecond_window():
+    assert Difficulty.retarget(1000, 0.001, interval=0.001, blocks=1) == 1000
+
+
+def test_block_work():
+    assert Difficulty.block_work(Difficulty.MAX_TARGET) == 1
+    assert Difficulty.block_work(None) == 16 ** config.LEGACY_DIFFICULTY
+
+
+def schedule(*timestamps):
+    return Difficulty.TargetSchedule([(timestamp, None) for timestamp in timestamps])
+
+
+def test_timestamp_must_exceed_the_median_time():
+    recent = schedule(10.0, 50.0, 20.0, 40.0, 30.0)
+    assert recent.median_time() == 30.0
+    assert not recent.accepts_timestamp(30.0, now=100.0)
+    assert not recent.accepts_timestamp(25, now=100.0)
+    assert recent.accepts_timestamp(30.5, now=100.0)
+
+
+def test_median_time_covers_the_last_blocks_only(monkeypatch):
+    monkeypatch.setattr(config, "MEDIAN_TIME_BLOCKS", 3)
+    assert schedule(100.0, 1.0, 2.0, 3.0).median_time() == 2.0
+
+
+def test_timestamp_far_in_the_future_is_rejected():
+    recent = schedule(10.0)
+    assert recent.accepts_timestamp(100.0 + config.MAX_FUTURE_DRIFT, now=100.0)
+    assert not recent.accepts_timestamp(100.5 + config.MAX_FUTURE_DRIFT, now=100.0)
+    assert not recent.accepts_timestamp(float("inf"), now=100.0)
+    assert not recent.accepts_timestamp(float("nan"), now=100.0)
+
+
+@pytest.mark.parametrize("timestamp", ["1600000000", True, None])
+def test_timestamp_must_be_a_number(timestamp):
+    assert not schedule(0.0).accepts_timestamp(timestamp, now=2e9)
@@ -0,0 +1,87 @@
+import collections
+import random
+
+import pytest
+
+from IndexCommitment import IndexCommitment, entries, verify
+import IndexStore
+
+
+def nft_mutations():
+    return [("set", "token%d" % (i % 5), "field%d" % i, {"owner": i % 3, "tags": ["a", i]}) for i in range(30)]
+
+
+def tx_mutations():
+    return [("append", ("from%d" % (i % 3), "to%d" % (i % 4)), (i, "tx %d" % i)) for i in range(30)]
+
+
+def build(kind, mutations):
+    bc_idx = collections.defaultdict(kind)
+    commitment = IndexCommitment()
+    for mutation in mutations:
+        commitment.update(bc_idx, mutation)
+        IndexStore.apply_mutation(bc_idx, mutation)
+    return bc_idx, commitment
+
+
+@pytest.mark.parametrize("kind, mutations", [(dict, nft_mutations()), (list, tx_mutations())])
+def test_commitment_does_not_depend_on_the_insertion_order(kind, mutations):
+    bc_idx, commitment = build(kind, mutations)
+    assert commitment.hexdigest() == IndexCommitment(bc_idx).hexdigest()
+    assert verify(bc_idx, commitment.hexdigest())
+    shuffled = list(mutations)
+    for seed in range(5):
+        random.Random(seed).shuffle(shuffled)
+        _, other = build(kind, shuffled)
+        assert other.hexdigest() == commitment.hexdigest()
+        assert other.state() == commitment.state()
+        # Nor on the order of the entries when built from scratch
+        entry_list = list(entries(bc_idx))
+        random.Random(seed).shuffle(entry_list)
+        from_entries = IndexCommitment()
+        for entry in entry_list:
+            from_entries.add(entry)
+        assert from_entries.hexdigest() == commitment.hexdigest()
+
+
+@pytest.mark.parametrize("kind, mutations", [(dict, nft_mutations()), (list, tx_mutations())])
+def test_commitment_changes_on_add_and_remove(kind, mutations):
+    bc_idx, commitment = build(kind, mutations)
+    before = commitment.hexdigest()
+    seen = {before}
+    key = mutations[0][1]
+    changes = ([("set", key, "field0", "other"), ("set", key, "new", 1), ("delete", key, "new")] if kind is dict
+               else [("append", key, (99, "tx 99")), ("append", key, (99, "tx 99")), ("remove", key, (99, "tx 99"))])
+    for mutation in changes:
+        commitment.update(bc_idx, mutation)
+        IndexStore.apply_mutation(bc_idx, mutation)
+        assert commitment.hexdigest() == IndexCommitment(bc_idx).hexdigest()
+        seen.add(commitment.hexdigest())
+    # Each change gave a new value, the last one undid the one before it
+    assert len(seen) == 3
+    assert commitment.hexdigest() != before
+    entry = next(entries(bc_idx))
+    commitment.remove(entry)
+    assert commitment.hexdigest() not in seen
+    commitment.add(entry)
+    assert commitment.hexdigest() == IndexCommitment(bc_idx).hexdigest()
+
+
+def test_tuples_and_lists_do_not_collide():
+    assert IndexCommitment({("a", "b"): [1]}).hexdigest() != IndexCommitment({"x": []}).hexdigest()
+    assert IndexCommitment().hexdigest() != IndexCommitment({("a", "b"): [1]}).hexdigest()
+    commitment = IndexCommitment()
+    commitment.add([("a", "b"), 1])
+    other = IndexCommitment()
+    other.add([["a", "b"], 1])
+    assert commitment.hexdigest() != other.hexdigest()
+
+
+def test_state_round_trip():
+    _, commitment = build(list, tx_mutations())
+    restored = IndexCommitment.from_state(commitment.state())
+    assert restored.hexdigest() == commitment.hexdigest()
+    assert len(commitment.hexdigest()) == 64
+    # Saved by a version with a 256-bit sum, or damaged: rebuilt instead
+    for state in ("ab" * 32, "zz" * 512, None, commitment.state()[1:]):
+        assert IndexCommitment.from_state(state) is None
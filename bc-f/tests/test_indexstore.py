@@ -0,0 +1,180 @@
+import collections
+import copy
+import os
+
+import pytest
+
+from IndexCommitment import IndexCommitment
+import IndexStore
+
+
+def test_sqlite_load_does_not_count_the_keys(tmp_path, monkeypatch):
+    store = IndexStore.SqliteIndexStore(str(tmp_path / "index.pkl"))
+    index, _ = store.open(collections.defaultdict(dict))
+
+    def counting(self):
+        raise AssertionError("len() of the index was called")
+
+    monkeypatch.setattr(IndexStore.SqliteIndex, "__len__", counting)
+    assert store.load() is index
+
+
+def nft_index():
+    bc_idx = collections.defaultdict(dict)
+    for i in range(20):
+        bc_idx["token%d" % i].update(owner="user%d" % (i % 3), price=i * 1.5, meta={"n": [i, None]})
+    return bc_idx, ("set", "token3", "owner", "user9")
+
+
+def tx_index():
+    bc_idx = collections.defaultdict(list)
+    for i in range(20):
+        bc_idx[("from%d" % (i % 3), "to%d" % (i % 4))].append((i, "tx %d" % i))
+    return bc_idx, ("append", ("from0", "to0"), (99, "tx 99"))
+
+
+def contents(bc_idx):
+    return dict(bc_idx.items())
+
+
+@pytest.mark.parametrize("saved_by", [IndexStore.PickleIndexStore, IndexStore.WalIndexStore])
+@pytest.mark.parametrize("build", [nft_index, tx_index])
+def test_pickle_index_is_migrated_on_first_open(tmp_path, saved_by, build):
+    path = str(tmp_path / "index.pkl")
+    bc_idx, mutation = build()
+    old = saved_by(path)
+    old.reset(copy.deepcopy(bc_idx))
+    # The WAL store keeps this one in its log only
+    IndexStore.apply_mutation(bc_idx, mutation)
+    old.save(bc_idx, [mutation])
+
+    index, commitment = IndexStore.SqliteIndexStore(path).open(collections.defaultdict(bc_idx.default_factory))
+    assert os.path.exists(str(tmp_path / "index.sqlite"))
+    assert contents(index) == contents(bc_idx)
+    assert commitment == IndexCommitment(bc_idx).state()
+    index.close()
+
+    # Only once: the sqlite file is used from then on
+    os.remove(path)
+    index, _ = IndexStore.SqliteIndexStore(path).open(collections.defaultdict(bc_idx.default_factory))
+    assert contents(index) == contents(bc_idx)
+    index.close()
+
+
+@pytest.mark.parametrize("build", [nft_index, tx_index])
+def test_sqlite_index_survives_close_and_reopen(tmp_path, build):
+    path = str(tmp_path / "index.pkl")
+    expected, mutation = build()
+    store = IndexStore.SqliteIndexStore(path)
+    index, commitment = store.open(collections.defaultdict(expected.default_factory))
+    assert commitment is None
+    mutations = [("append", key, value) if isinstance(values, list) else ("set", key, field, value)
+                 for key, values in expected.items()
+                 for field, value in (enumerate(values) if isinstance(values, list) else values.items())]
+    for change in mutations + [mutation]:
+        IndexStore.apply_mutation(index, change)
+    IndexStore.apply_mutation(expected, mutation)
+    store.save(index, mutations, "ab" * 32)
+    # Not saved: lost on close
+    IndexStore.apply_mutation(index, mutation)
+    index.close()
+
+    store = IndexStore.SqliteIndexStore(path)
+    index, commitment = store.open(collections.defaultdict(expected.default_factory))
+    assert commitment == "ab" * 32
+    assert contents(index) == contents(expected)
+    assert store.load() is index
+    index.close()
+
+
+def test_sqlite_getitem_returns_a_copy(tmp_path):
+    store = IndexStore.SqliteIndexStore(str(tmp_path / "index.pkl"))
+    index, _ = store.open(collections.defaultdict(dict))
+    IndexStore.apply_mutation(index, ("set", "token", "owner", "a"))
+    IndexStore.apply_mutation(index, ("set", "token", "meta", {"tags": ["x"]}))
+
+    entry = index["token"]
+    entry["owner"] = "b"
+    entry["meta"]["tags"].append("y")
+    del entry["meta"]
+    assert index["token"] == {"owner": "a", "meta": {"tags": ["x"]}}
+    index.close()
+
+    store = IndexStore.SqliteIndexStore(str(tmp_path / "list.pkl"))
+    index, _ = store.open(collections.defaultdict(list))
+    IndexStore.apply_mutation(index, ("append", ("a", "b"), (1, "tx")))
+    index[("a", "b")].append((2, "tx"))
+    assert index[("a", "b")] == [(1, "tx")]
+    index.close()
+
+
+def wal_store(tmp_path, compact_every=100):
+    bc_idx = collections.defaultdict(list)
+    store = IndexStore.WalIndexStore(str(tmp_path / "index.pkl"), compact_every)
+    store.reset(bc_idx)
+    return store, bc_idx
+
+
+def appends(i):
+    return [("append", ("a", "b"), (i, "tx %d" % i)), ("append", ("b", "c"), (i, "tx %d" % i))]
+
+
+def save_appends(store, bc_idx, numbers):
+    for i in numbers:
+        mutations = appends(i)
+        for mutation in mutations:
+            IndexStore.apply_mutation(bc_idx, mutation)
+        store.save(bc_idx, mutations)
+
+
+def test_wal_is_replayed_after_a_crash(tmp_path):
+    store, bc_idx = wal_store(tmp_path, compact_every=4)
+    # One compaction, then records left in the log
+    save_appends(store, bc_idx, range(6))
+    del store
+
+    reopened = IndexStore.WalIndexStore(str(tmp_path / "index.pkl"), 4)
+    assert contents(reopened.load()) == contents(bc_idx)
+    # It goes on from there, compacting after 4 records in total
+    loaded = reopened.load()
+    save_appends(reopened, loaded, range(6, 8))
+    assert os.path.getsize(str(tmp_path / "index.pkl.wal")) == 0
+    save_appends(reopened, loaded, range(8, 9))
+    assert contents(IndexStore.WalIndexStore(str(tmp_path / "index.pkl")).load()) == contents(loaded)
+
+
+def test_wal_records_already_compacted_are_skipped(tmp_path):
+    store, bc_idx = wal_store(tmp_path)
+    save_appends(store, bc_idx, range(3))
+    with open(str(tmp_path / "index.pkl.wal"), "rb") as f:
+        log = f.read()
+    # Crash after the new snapshot was written, before the log was emptied
+    store.compact(bc_idx)
+    with open(str(tmp_path / "index.pkl.wal"), "wb") as f:
+        f.write(log)
+
+    reopened = IndexStore.WalIndexStore(str(tmp_path / "index.pkl"))
+    assert contents(reopened.load()) == contents(bc_idx)
+
+
+@pytest.mark.parametrize("cut", [1, 5, "record"])
+def test_truncated_last_wal_record_is_cut_off(tmp_path, cut):
+    store, bc_idx = wal_store(tmp_path)
+    save_appends(store, bc_idx, range(3))
+    wal_path = str(tmp_path / "index.pkl.wal")
+    complete = os.path.getsize(wal_path)
+    expected = copy.deepcopy(bc_idx)
+    save_appends(store, bc_idx, range(3, 4))
+    torn = complete + 3 if cut == "record" else os.path.getsize(wal_path) - cut
+    with open(wal_path, "r+b") as f:
+        f.truncate(torn)
+
+    reopened = IndexStore.WalIndexStore(str(tmp_path / "index.pkl"))
+    loaded = reopened.load()
+    assert contents(loaded) == contents(expected)
+    assert os.path.getsize(wal_path) == complete
+    # New records follow the last complete one
+    save_appends(reopened, loaded, range(10, 11))
+    for mutation in appends(10):
+        IndexStore.apply_mutation(expected, mutation)
+    assert contents(IndexStore.WalIndexStore(str(tmp_path / "index.pkl")).load()) == contents(expected)
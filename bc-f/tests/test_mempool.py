@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from Blockchain import Blockchain
+import config
+from Mempool import Mempool, MempoolFull
+import Miner
+import Transactions
+import Users
+
+
+class JsonRequest:
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self):
+        return self.data
+
+
+def test_entries_are_deduplicated_by_leaf_hash():
+    pool = Mempool(max_size=10)
+    assert pool.add({"from": "a", "to": "b", "value": 1})
+    # The same entry with its keys in another order
+    assert not pool.add({"value": 1, "to": "b", "from": "a"})
+    assert {"to": "b", "value": 1, "from": "a"} in pool
+    batch = [{"n": 1}, {"n": 1}, {"n": 2}, {"from": "a", "to": "b", "value": 1}]
+    assert pool.add_batch(batch) == [{"n": 1}, {"n": 2}]
+    assert pool.snapshot() == [{"from": "a", "to": "b", "value": 1}, {"n": 1}, {"n": 2}]
+    pool.remove([{"n": 1}, {"n": 3}])
+    assert len(pool) == 2 and {"n": 1} not in pool
+
+
+def test_full_pool_admits_a_batch_entirely_or_not_at_all():
+    pool = Mempool(max_size=3)
+    pool.add_batch([{"n": 0}, {"n": 1}])
+    with pytest.raises(MempoolFull):
+        pool.add_batch([{"n": 2}, {"n": 3}])
+    assert pool.snapshot() == [{"n": 0}, {"n": 1}]
+    # Duplicates take no room
+    assert pool.add_batch([{"n": 0}, {"n": 1}, {"n": 2}]) == [{"n": 2}]
+    assert not pool.add({"n": 0})
+    with pytest.raises(MempoolFull):
+        pool.add({"n": 4})
+
+
+@pytest.fixture
+def tx(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MEMPOOL_MAX_SIZE", 3)
+    tx = Blockchain(Miner.SerialMiner(), "legacy")
+    tx.op = os.path.join(str(tmp_path), config.TRANSACTION_INDEX)
+    Transactions.attach_indexes(tx)
+    return tx
+
+
+def transaction(i, description=None):
+    private_key = "key%d" % i
+    return {"from": Users.public_key_of(private_key), "to": "to%d" % i, "value": i + 1,
+            "private_key": private_key, "description": description or "tx %d" % i}
+
+
+def test_transactions_are_refused_with_429_when_the_pool_is_full(tx):
+    for i in range(3):
+        assert Transactions.new_transaction(tx, JsonRequest(transaction(i))) == ("Success", 201)
+    assert Transactions.new_transaction(tx, JsonRequest(transaction(3))) == ("Too many pending transactions", 429)
+    batch = [transaction(4), transaction(5)]
+    assert Transactions.new_transactions(tx, JsonRequest(batch)) == ("Too many pending transactions", 429)
+    # The refused ones left no trace in the mempool or the index
+    assert len(tx.unconfirmed_info) == 3
+    refused = transaction(3)
+    assert (refused["from"], refused["to"]) not in tx.bc_idx
+    assert tx.indexes["addresses"].balance(refused["to"])["pending_received"] == 0
+
+    # Room again once they are mined
+    assert tx.mine()
+    assert Transactions.new_transaction(tx, JsonRequest(transaction(3))) == ("Success", 201)
+
+
+def test_resubmitted_transaction_is_kept_and_indexed_once(tx):
+    batch = [transaction(0), transaction(1)]
+    assert Transactions.new_transactions(tx, JsonRequest([dict(t) for t in batch])) == \
+        ({"admitted": 2, "duplicates": 0}, 201)
+    pending = tx.unconfirmed_info.snapshot()
+    # The same transactions again, as a peer or a retrying client sends them
+    assert tx.add_new_infos(pending) == []
+    Transactions.admit_transactions(tx, [dict(pending[0])])
+    assert len(tx.unconfirmed_info) == 2
+    assert tx.bc_idx[(pending[0]["from"], pending[0]["to"])] == [(1, "tx 0")]
+    assert tx.indexes["addresses"].balance(pending[0]["to"])["pending_received"] == 1
+
+
+def test_users_are_refused_with_429_when_the_pool_is_full(monkeypatch):
+    monkeypatch.setattr(config, "MEMPOOL_MAX_SIZE", 2)
+    users = Blockchain(Miner.SerialMiner(), "legacy")
+    request = JsonRequest({"access_key": "PASSWORD", "users": [{"name": "u%d" % i, "description": "d"}
+                                                                for i in range(3)]})
+    assert Users.new_users_bulk(users, request) == ("Too many pending users", 429)
+    assert len(users.unconfirmed_info) == 0
+    # A single user raises, which the app answers with 429
+    users.add_new_infos([{"name": "a"}, {"name": "b"}])
+    with pytest.raises(MempoolFull):
+        Users.new_users(users, JsonRequest({"access_key": "PASSWORD", "name": "c", "description": "d"}))
@@ -0,0 +1,73 @@
+import pytest
+
+from Block import MerkleBlock
+import Merkle
+
+COUNTS = [1, 2, 3, 4, 7, 8, 9]
+
+
+def leaves(count):
+    return [Merkle.leaf_hash({"from": "a", "to": "b", "value": i}) for i in range(count)]
+
+
+def tampered(digest):
+    return ("1" if digest[0] == "0" else "0") + digest[1:]
+
+
+@pytest.mark.parametrize("count", COUNTS)
+def test_every_leaf_proof_verifies(count):
+    hashes = leaves(count)
+    root = Merkle.merkle_root(hashes)
+    for i, leaf in enumerate(hashes):
+        proof = Merkle.merkle_proof(hashes, i)
+        assert Merkle.verify_proof(leaf, proof, root)
+        # Odd levels carry their last node up without a sibling
+        assert len(proof) <= max(1, (count - 1).bit_length())
+    assert Merkle.merkle_root(hashes[:1]) == hashes[0]
+
+
+@pytest.mark.parametrize("count", COUNTS)
+def test_tampered_leaf_or_path_is_rejected(count):
+    hashes = leaves(count)
+    root = Merkle.merkle_root(hashes)
+    for i, leaf in enumerate(hashes):
+        proof = Merkle.merkle_proof(hashes, i)
+        assert not Merkle.verify_proof(tampered(leaf), proof, root)
+        assert not Merkle.verify_proof(leaf, proof, tampered(root))
+        for step in range(len(proof)):
+            sibling, side = proof[step]
+            for changed in ([tampered(sibling), side], [sibling, "R" if side == "L" else "L"], [sibling, "X"]):
+                assert not Merkle.verify_proof(leaf, proof[:step] + [changed] + proof[step + 1:], root)
+            assert not Merkle.verify_proof(leaf, proof[:step] + proof[step + 1:], root)
+        # The proof of one leaf does not prove another
+        for j, other in enumerate(hashes):
+            if j != i:
+                assert not Merkle.verify_proof(other, proof, root)
+
+
+def test_leaf_changes_change_the_root():
+    hashes = leaves(7)
+    root = Merkle.merkle_root(hashes)
+    for i in range(7):
+        assert Merkle.merkle_root(hashes[:i] + [tampered(hashes[i])] + hashes[i + 1:]) != root
+
+
+def test_empty_tree_and_out_of_range_leaf():
+    assert Merkle.merkle_root([]) == Merkle.EMPTY_ROOT
+    with pytest.raises(IndexError):
+        Merkle.merkle_proof(leaves(3), 3)
+    with pytest.raises(IndexError):
+        Merkle.merkle_proof([], 0)
+
+
+@pytest.mark.parametrize("count", [1, 2, 7])
+def test_block_proofs_verify_against_the_header(count):
+    info = [{"from": "a", "to": "b", "value": i} for i in range(count)]
+    block = MerkleBlock(1, info, 1600000000.0, "ab" * 32)
+    root = block.header()["merkle_root"]
+    for i, entry in enumerate(info):
+        leaf, proof = block.proof(tx_index=i)
+        assert leaf == Merkle.leaf_hash(entry)
+        assert block.proof(tx_hash=leaf) == (leaf, proof)
+        assert Merkle.verify_proof(leaf, proof, root)
+        assert not Merkle.verify_proof(Merkle.leaf_hash(dict(entry, value=-1)), proof, root)
@@ -0,0 +1,31 @@
+import pytest
+
+from Block import Block, MerkleBlock
+from Difficulty import meets_target
+import Miner
+
+TARGET = 2 ** 249
+
+
+def block(block_class, index):
+    return block_class(index, [{"from": "a", "to": "b", "value": index}, {"n": index}],
+                       1600000000.0 + index, "ab" * 32, 0, TARGET)
+
+
+@pytest.mark.parametrize("block_class", [Block, MerkleBlock])
+def test_parallel_miner_finds_the_serial_nonce(block_class):
+    miner = Miner.ParallelMiner(workers=2, chunk_size=16)
+    for index in range(3):
+        serial, parallel = block(block_class, index), block(block_class, index)
+        serial_hash = Miner.SerialMiner().search(serial, TARGET)
+        assert miner.search(parallel, TARGET) == serial_hash
+        assert parallel.nonce == serial.nonce
+        assert parallel.compute_hash() == serial_hash
+        assert meets_target(serial_hash, TARGET)
+        # The lowest nonce wins, as the serial search tries them in order
+        assert not any(meets_target(block_hash, TARGET) for block_hash in
+                       map(serial.nonce_hasher(), range(serial.nonce)))
+
+
+def test_workers_are_not_forked_from_the_node():
+    assert Miner._context.get_start_method() in ("forkserver", "spawn")
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from Blockchain import Blockchain
+import config
+import Miner
+import NFT
+
+
+class JsonRequest:
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self):
+        return dict(self.data)
+
+
+def keypair(name):
+    return hashlib.sha256(name.encode()).hexdigest(), name
+
+
+@pytest.fixture
+def nfts(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "UPLOAD_FOLDER", str(tmp_path))
+    nfts = Blockchain(Miner.SerialMiner(), "legacy")
+    nfts.op = os.path.join(str(tmp_path), config.NFT_INDEX)
+    NFT.attach_indexes(nfts)
+    return nfts
+
+
+def mint(nfts, owner, tokenId):
+    nfts.add_new_info({"from": "0", "to": owner, "tokenId": tokenId, "timestamp": 1.0})
+    nfts.index_set(owner, tokenId, "/manifests/" + tokenId)
+
+
+def transfer(nfts, sender, recipient, tokenId):
+    return NFT.transfer(nfts, JsonRequest({"from": sender[0], "to": recipient,
+                                           "private_key": sender[1], "tokenId": tokenId}))
+
+
+def test_transfer_moves_the_token(nfts):
+    alice, bob = keypair("alice"), keypair("bob")
+    mint(nfts, alice[0], "t1")
+    assert transfer(nfts, alice, bob[0], "t1") == ("Success", 201)
+    assert NFT.ownerOf(nfts, "t1") == bob[0]
+    assert nfts.bc_idx[bob[0]]["t1"] == "/manifests/t1"
+    # Spent: a second transfer by the old owner is refused
+    assert transfer(nfts, alice, keypair("carol")[0], "t1") == ("Forbidden", 403)
+
+
+def test_concurrent_transfers_spend_a_token_once(nfts):
+    alice = keypair("alice")
+    results = []
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for round_ in range(20):
+            tokenId = "token%d" % round_
+            mint(nfts, alice[0], tokenId)
+            start = threading.Barrier(4)
+
+            def spend(recipient):
+                start.wait()
+                results.append((tokenId, transfer(nfts, alice, recipient, tokenId)[1]))
+
+            threads = [threading.Thread(target=spend, args=(keypair("r%d" % i)[0],)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    for round_ in range(20):
+        tokenId = "token%d" % round_
+        statuses = sorted(status for token, status in results if token == tokenId)
+        assert statuses == [201, 403, 403, 403]
+        spends = [info for info in nfts.unconfirmed_info if info["tokenId"] == tokenId and info["from"] != "0"]
+        assert len(spends) == 1
+
+
+def test_transfer_of_a_token_from_a_peer_block(nfts):
+    # Minted in a block from a peer: in the token index, not in bc_idx
+    alice, bob = keypair("alice"), keypair("bob")
+    nfts.add_new_info({"from": "0", "to": alice[0], "tokenId": "t2", "timestamp": 1.0})
+    assert transfer(nfts, alice, bob[0], "t2") == ("Success", 201)
+    assert NFT.ownerOf(nfts, "t2") == bob[0]
+
+
+def test_token_index_follows_pending_sealed_and_dropped_blocks(nfts):
+    alice, bob = keypair("alice"), keypair("bob")
+    index = nfts.indexes["tokens"]
+    mint(nfts, alice[0], "t1")
+    assert "t1" in index and "t2" not in index
+    assert index.owner("t1") == alice[0]
+    assert index.owner("t1", include_pending=False) is None
+    assert nfts.mine()
+    minted = nfts.last_block
+    assert index.owner("t1", include_pending=False) == alice[0]
+    assert index.get("t1") == {"owner": alice[0], "filepath": "/manifests/t1", "height": 1}
+
+    assert transfer(nfts, alice, bob[0], "t1") == ("Success", 201)
+    assert (index.owner("t1"), index.owner("t1", include_pending=False)) == (bob[0], alice[0])
+    assert nfts.mine()
+    assert index.owner("t1", include_pending=False) == bob[0]
+    assert index.get("t1")["filepath"] == "/manifests/t1"
+    assert len(index) == 1
+
+    # Built from the chain, or through JSON, it is the same
+    rebuilt = NFT.TokenIndex(nfts)
+    rebuilt.rebuild(nfts.chain)
+    assert rebuilt.state() == index.state()
+    loaded = NFT.TokenIndex(nfts)
+    loaded.load_state(json.loads(json.dumps(index.state())))
+    assert loaded.state() == index.state()
+
+    # Dropping the transfer gives the token back to alice, dropping the
+    # mint removes it
+    index.remove_block(nfts.last_block)
+    assert index.get("t1") == {"owner": alice[0], "filepath": "/manifests/t1", "height": 1}
+    index.remove_block(minted)
+    assert "t1" not in index and len(index) == 0
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_token_set_claim_and_release(tmp_path, on_disk):
+    tokens = NFT.TokenSet(str(tmp_path / "tokens.sqlite") if on_disk else None, bloom_capacity=100)
+    assert "t1" not in tokens
+    assert tokens.claim("t1")
+    assert not tokens.claim("t1")
+    assert "t1" in tokens
+    tokens.release("t1")
+    # Still set in the Bloom filter, but gone from the exact set
+    assert "t1" not in tokens
+    assert tokens.claim("t1")
+
+    block = SimpleNamespace(info=[{"tokenId": "t1"}, {"tokenId": "t2"}])
+    tokens.apply_block(block)
+    tokens.remove_block(block)
+    assert "t2" in tokens and not tokens.claim("t2")
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = NFT.BloomFilter(1000, error_rate=0.01)
+    keys = ["%064x" % i for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum("other%d" % i in bloom for i in range(10000))
+    assert false_positives < 10000 * 0.03
+
+    # Over capacity it only gets less selective
+    full = NFT.BloomFilter(10)
+    for key in keys:
+        full.add(key)
+    assert all(key in full for key in keys)
+
+
+def test_token_set_on_disk_survives_a_restart(tmp_path):
+    path = str(tmp_path / "tokens.sqlite")
+    tokens = NFT.TokenSet(path, bloom_capacity=10)
+    claimed = ["%064x" % i for i in range(200)]
+    for tokenId in claimed:
+        assert tokens.claim(tokenId)
+    tokens.release(claimed[0])
+    assert tokens.state() is None
+
+    # A new process reads the table back and refills the filter
+    reopened = NFT.TokenSet(path, bloom_capacity=10)
+    assert claimed[0] not in reopened
+    assert all(tokenId in reopened for tokenId in claimed[1:])
+    assert not reopened.claim(claimed[1])
+    assert reopened.claim(claimed[0])
+    # A filter far over capacity answers "maybe" for everything: the
+    # table has the final say
+    assert "%064x" % 10 ** 6 not in reopened
+
+
+def test_token_set_in_memory_state_round_trip():
+    tokens = NFT.TokenSet()
+    for tokenId in ("a", "b"):
+        tokens.claim(tokenId)
+    loaded = NFT.TokenSet()
+    loaded.load_state(json.loads(json.dumps(tokens.state())))
+    assert "a" in loaded and "b" in loaded and "c" not in loaded
@@ -0,0 +1,111 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+import requests
+
+import config
+import Peers
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    /ok/<n>   answers 200 with n
+    /slow     answers after `server.delay` seconds
+    /error    answers 503, counting the attempts
+    """
+
+    def do_GET(self):
+        path = self.path.partition("?")[0]
+        if path == "/slow":
+            time.sleep(self.server.delay)
+        if path == "/error":
+            self.server.errors += 1
+            status, body = 503, b"busy"
+        else:
+            status, body = 200, self.path.encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(config, "PEER_TIMEOUT", (1, 0.2))
+    monkeypatch.setattr(config, "PEER_RETRIES", 1)
+    monkeypatch.setattr(config, "PEER_BACKOFF", 0.01)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.delay, httpd.errors = 2.0, 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd, "http://127.0.0.1:%d" % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def closed_port():
+    with ThreadingHTTPServer(("127.0.0.1", 0), Handler) as httpd:
+        return httpd.server_address[1]
+
+
+def body(peer):
+    return Peers.get(peer).text
+
+
+def test_fan_out_skips_peers_which_time_out_or_are_down(server):
+    httpd, url = server
+    ok = [url + "/ok/%d" % i for i in range(5)]
+    down = "http://127.0.0.1:%d/ok/down" % closed_port()
+    start = time.perf_counter()
+    results = Peers.fan_out(ok + [url + "/slow", down], body)
+    elapsed = time.perf_counter() - start
+    assert results == {peer: peer[len(url):] for peer in ok}
+    # Two timed out attempts of the slow peer, not its full delay
+    assert elapsed < httpd.delay
+
+
+def test_fan_out_waits_about_as_long_as_the_slowest_peer(server):
+    httpd, url = server
+    httpd.delay = 0.15
+    peers = [url + "/slow?peer=%d" % i for i in range(8)]
+
+    start = time.perf_counter()
+    results = Peers.fan_out(peers, body)
+    elapsed = time.perf_counter() - start
+    assert results == {peer: peer[len(url):] for peer in peers}
+    assert elapsed < 8 * httpd.delay / 2
+
+
+def test_server_errors_are_retried(server):
+    httpd, url = server
+    results = Peers.fan_out([url + "/error"], lambda peer: Peers.get(peer).status_code)
+    assert results == {url + "/error": 503}
+    assert httpd.errors == config.PEER_RETRIES + 1
+
+
+def test_broadcast_returns_before_the_peers_answer(server):
+    httpd, url = server
+    httpd.delay = 0.5
+    peers = [url + "/slow", url + "/ok/1"]
+    start = time.perf_counter()
+    futures = Peers.broadcast(peers, body)
+    assert time.perf_counter() - start < httpd.delay / 2
+    assert not futures[0].done()
+    with pytest.raises(requests.Timeout):
+        futures[0].result()
+    assert futures[1].result() == "/ok/1"
+
+
+def test_sessions_are_per_thread():
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.extend([Peers.session(), Peers.session()]))
+    thread.start()
+    thread.join()
+    assert sessions[0] is sessions[1]
+    assert Peers.session() is Peers.session() is not sessions[0]
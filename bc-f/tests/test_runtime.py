@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+import time
+
+from flask import Flask, Response, request
+import pytest
+
+import Runtime
+
+# Not forked: the test process runs other tests' threads
+_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+class Unpicklable(Exception):
+    def __init__(self):
+        super().__init__("unpicklable")
+        self.callback = lambda: None
+
+
+class EchoNode:
+    """
+    A ChainNode stand-in with one op per kind of reply.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def call(self, op, *args):
+        self.calls += 1
+        if op == "echo":
+            return args
+        if op == "registered":
+            return args[0] == "alice"
+        if op == "json":
+            return args[0].get_json(), args[0].args.get("page")
+        if op == "stream":
+            return Response(("part %d\n" % i for i in range(args[0])), status=207,
+                            headers={"X-Parts": str(args[0])})
+        if op == "broken_stream":
+            def parts():
+                yield "first\n"
+                raise KeyError("lost")
+            return Response(parts())
+        if op == "sleep":
+            time.sleep(args[0])
+            return "woke"
+        if op == "unpicklable":
+            raise Unpicklable()
+        raise ValueError("Unknown operation {}".format(op))
+
+
+def serve(conn, other):
+    """
+    Worker side: answers calls on `conn` until told to stop.
+    """
+    if other is not None:
+        other.close()
+    pool = ThreadPoolExecutor(4)
+    Runtime._serve_pipe(EchoNode(), conn, pool)
+    pool.shutdown(wait=False)
+
+
+@pytest.fixture(params=["thread", "process"])
+def worker(request):
+    front, back = _context.Pipe()
+    if request.param == "thread":
+        runner = threading.Thread(target=serve, args=(back, None), daemon=True)
+    else:
+        runner = _context.Process(target=serve, args=(back, front))
+    runner.start()
+    if request.param == "process":
+        back.close()
+    client = Runtime.ChainClient(front)
+    yield client, runner
+    client.close()
+    runner.join(10)
+    if request.param == "process" and runner.is_alive():
+        runner.terminate()
+
+
+def test_call_round_trip(worker):
+    client, _ = worker
+    assert client.call("echo", 1, [2, {"three": 3}]) == (1, [2, {"three": 3}])
+    registry = Runtime.RemoteRegistry(client)
+    assert "alice" in registry and "bob" not in registry
+
+    response = client.call("stream", 3)
+    assert response.status_code == 207 and response.headers["X-Parts"] == "3"
+    assert response.get_data() == b"part 0\npart 1\npart 2\n"
+
+
+def test_concurrent_calls_get_their_own_replies(worker):
+    client, _ = worker
+    results = {}
+
+    def call(i):
+        results[i] = client.call("echo", i)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: (i,) for i in range(20)}
+
+
+def test_flask_request_reaches_the_worker(worker):
+    client, _ = worker
+    app = Flask("front")
+
+    @app.route("/call", methods=["POST"])
+    def call():
+        return {"seen": client.call("json", request)}
+
+    reply = app.test_client().post("/call?page=2", json={"n": [1, 2]})
+    assert reply.get_json() == {"seen": [{"n": [1, 2]}, "2"]}
+
+
+def test_worker_errors_surface_in_the_caller(worker):
+    client, _ = worker
+    with pytest.raises(ValueError, match="Unknown operation nope"):
+        client.call("nope")
+    with pytest.raises(Runtime.WorkerError, match="Unpicklable"):
+        client.call("unpicklable")
+    response = client.call("broken_stream")
+    with pytest.raises(KeyError):
+        response.get_data()
+    # The worker goes on serving
+    assert client.call("echo", "still here") == ("still here",)
+
+
+def test_shutdown_stops_the_worker_and_fails_later_calls(worker):
+    client, runner = worker
+    assert client.call("echo", 1) == (1,)
+    client.close()
+    runner.join(10)
+    assert not runner.is_alive()
+    if isinstance(runner, multiprocessing.process.BaseProcess):
+        assert runner.exitcode == 0
+    with pytest.raises(Runtime.WorkerError):
+        client.call("echo", 2)
+
+
+def test_calls_waiting_on_a_dead_worker_fail():
+    front, back = _context.Pipe()
+    process = _context.Process(target=serve, args=(back, front))
+    process.start()
+    back.close()
+    client = Runtime.ChainClient(front)
+    failures = []
+
+    def call():
+        try:
+            client.call("sleep", 30)
+        except Runtime.WorkerError as e:
+            failures.append(e)
+
+    waiting = threading.Thread(target=call)
+    waiting.start()
+    time.sleep(0.5)
+    process.terminate()
+    waiting.join(10)
+    assert not waiting.is_alive() and len(failures) == 1
+    client.close()
+
+
+def test_remote_registry_remembers_registered_users():
+    node = EchoNode()
+    registry = Runtime.RemoteRegistry(Runtime.LocalChain(node))
+    assert "alice" in registry and "bob" not in registry
+    calls = node.calls
+    assert "alice" in registry
+    assert "bob" not in registry
+    # Only the unregistered one is asked again
+    assert node.calls == calls + 1
@@ -0,0 +1,109 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import config
+import Scheduler
+
+
+class Chain:
+    """
+    Just the pending entries a scheduler looks at; mining seals them all.
+    """
+
+    def __init__(self):
+        self.unconfirmed_info = []
+        self.mined = []
+        self.lock = threading.Lock()
+
+    def mine(self):
+        with self.lock:
+            self.mined.append(len(self.unconfirmed_info))
+            self.unconfirmed_info.clear()
+        return "mined", 200
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(config, "MINING_POLL_INTERVAL", 0.01)
+
+
+def jobs_of(name):
+    with Scheduler._jobs_lock:
+        return [dict(job) for job in Scheduler._jobs.values() if job["chain"] == name]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_block_size_triggers_a_job(request):
+    chain = Chain()
+    scheduler = Scheduler.MiningScheduler(chain, request.node.name, chain.mine, block_size=3, max_age=60).start()
+    chain.unconfirmed_info.extend(["a", "b"])
+    time.sleep(0.1)
+    assert chain.mined == [] and jobs_of(scheduler.name) == []
+    assert scheduler.status()["pending"] == 2
+    assert scheduler.status()["pending_age"] is not None
+
+    chain.unconfirmed_info.append("c")
+    wait_for(lambda: jobs_of(scheduler.name) and jobs_of(scheduler.name)[0]["status"] == "done")
+    job, = jobs_of(scheduler.name)
+    assert job["trigger"] == "size" and job["result"] == ["mined", 200]
+    assert chain.mined == [3]
+    assert scheduler.status()["pending_age"] is None
+
+
+def test_age_triggers_a_job(request):
+    chain = Chain()
+    scheduler = Scheduler.MiningScheduler(chain, request.node.name, chain.mine, block_size=100, max_age=0.3).start()
+    time.sleep(0.05)
+    start = time.time()
+    chain.unconfirmed_info.append("a")
+    wait_for(lambda: chain.mined)
+    assert time.time() - start >= 0.3 - 0.02
+    wait_for(lambda: jobs_of(scheduler.name)[0]["status"] == "done")
+    assert [job["trigger"] for job in jobs_of(scheduler.name)] == ["age"]
+    assert chain.mined == [1]
+
+
+def test_nothing_pending_mines_nothing(request):
+    chain = Chain()
+    Scheduler.MiningScheduler(chain, request.node.name, chain.mine, block_size=1, max_age=0).start()
+    time.sleep(0.1)
+    assert chain.mined == [] and jobs_of(request.node.name) == []
+
+
+def test_requested_jobs_are_queued_once_and_report_failures(request):
+    release = threading.Event()
+    calls = []
+
+    def mine():
+        calls.append(time.time())
+        release.wait(5)
+        if len(calls) == 2:
+            raise RuntimeError("no luck")
+        return "mined", 200
+
+    scheduler = Scheduler.MiningScheduler(SimpleNamespace(unconfirmed_info=[]), request.node.name, mine,
+                                          block_size=100, max_age=60)
+    first = scheduler.submit()
+    assert scheduler.submit() is first
+    scheduler.start()
+    wait_for(lambda: calls)
+    # The first one runs: a new request queues a second job
+    second = scheduler.submit()
+    assert second["id"] != first["id"] and scheduler.submit() is second
+    assert scheduler.status()["running"] == first["id"]
+    assert scheduler.status()["queued"] == [second["id"]]
+    release.set()
+    wait_for(lambda: Scheduler.job_status(second["id"])["status"] == "failed")
+    assert Scheduler.job_status(first["id"])["status"] == "done"
+    status = Scheduler.job_status(second["id"])
+    assert status["trigger"] == "request" and status["result"] == ["RuntimeError('no luck')", 500]
+    assert status["submitted"] <= status["started"] <= status["finished"]
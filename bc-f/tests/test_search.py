@@ -0,0 +1,175 @@
+import json
+import pickle
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import config
+from IndexStore import atomic_write
+import Search
+import Transactions
+
+
+def test_non_finite_values_and_timestamps_do_not_break_the_ranges(tmp_path):
+    index = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+    special = [float("nan"), float("inf"), "nan", "-inf", 10 ** 400]
+    for height in range(20):
+        info = [{"value": i, "timestamp": 1000.0 + i, "description": "tx"} for i in range(100)]
+        info += [{"value": value, "timestamp": value, "description": "odd"} for value in special]
+        index.apply_block(SimpleNamespace(index=height, info=info, timestamp=500.0))
+
+    assert len(index.search(min_value=10, max_value=20, limit=10 ** 6)) == 20 * 11
+    assert len(index.search(since=1090, until=2000, limit=10 ** 6)) == 20 * 10
+    # Values and timestamps of the odd ones count 0 and the block's
+    assert len(index.search(max_value=0, limit=10 ** 6)) == 20 * (1 + len(special))
+    assert len(index.search(since=500, until=500, limit=10 ** 6)) == 20 * len(special)
+
+
+def tx_block(height, count=50):
+    info = [{"value": (height * count + i) % 997, "timestamp": 1000.0 + height * count + i,
+             "description": "tx {}".format(i % 7)} for i in range(count)]
+    return SimpleNamespace(index=height, info=info, timestamp=1000.0, hash="%064x" % height)
+
+
+def test_range_queries_while_blocks_are_added(tmp_path, monkeypatch):
+    sys_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        chain = []
+        index = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+        index.rebuild(chain)
+        errors = []
+        done = threading.Event()
+
+        def query():
+            while not done.is_set():
+                try:
+                    matches = index.search(min_value=100, max_value=200, limit=10 ** 6)
+                    assert len(set(matches)) == len(matches)
+                    for doc in matches:
+                        assert 100 <= index.values[doc] <= 200
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        threads = [threading.Thread(target=query) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for height in range(300):
+            chain.append(tx_block(height))
+            index.apply_block(chain[-1])
+        done.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(sys_interval)
+    assert not errors
+    expected = sum(1 for block in chain for tx in block.info if 100 <= tx["value"] <= 200)
+    assert len(index.search(min_value=100, max_value=200, limit=10 ** 6)) == expected
+
+
+def test_apply_block_does_not_wait_for_the_save(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_SAVE_EVERY", 2)
+    writing, release = threading.Event(), threading.Event()
+    timed_out = []
+
+    def slow_write(path, data):
+        writing.set()
+        timed_out.append(not release.wait(5))
+        atomic_write(path, data)
+
+    monkeypatch.setattr(Search, "atomic_write", slow_write)
+    chain = []
+    index = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+    index.rebuild(chain)
+    for height in range(3):
+        chain.append(tx_block(height))
+        index.apply_block(chain[-1])
+    assert writing.wait(10)
+    # Blocks and queries go on while the file is written
+    chain.append(tx_block(3))
+    index.apply_block(chain[-1])
+    assert len(index.search(limit=10 ** 6)) == 4 * 50
+    release.set()
+    assert not any(timed_out)
+
+    for _ in range(100):
+        if index.saved_height >= 2:
+            break
+        time.sleep(0.05)
+    loaded = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+    loaded.rebuild(chain)
+    assert len(loaded) == 4 * 50
+
+
+def wait_for_save(index, height):
+    for _ in range(100):
+        if index.saved_height >= height:
+            return
+        time.sleep(0.05)
+    raise AssertionError("the index was not saved")
+
+
+def test_saved_index_loads_back_the_same(tmp_path):
+    chain = [tx_block(height) for height in range(5)]
+    index = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+    index.rebuild(chain)
+    wait_for_save(index, 4)
+    with open(str(tmp_path / "search"), "rb") as f:
+        assert json.loads(f.read())["height"] == 4
+
+    chain.append(tx_block(5))
+    loaded = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+    loaded.rebuild(chain)
+    index.apply_block(chain[-1])
+    for query in ({"q": "tx 3"}, {"min_value": 100, "max_value": 300}, {"since": 1010, "until": 1200}, {}):
+        assert loaded.search(limit=10 ** 6, **query) == index.search(limit=10 ** 6, **query)
+    assert {word: list(ids) for word, ids in loaded.postings.items()} == \
+        {word: list(ids) for word, ids in index.postings.items()}
+
+
+class Exploit:
+    ran = []
+
+    def __reduce__(self):
+        return Exploit.ran.append, ("unpickled",)
+
+
+def test_pickled_or_torn_index_is_rebuilt(tmp_path):
+    chain = [tx_block(height) for height in range(3)]
+    path = str(tmp_path / "search")
+    index = Search.SearchIndex(path, Transactions.amount)
+    index.rebuild(chain)
+    wait_for_save(index, 2)
+    with open(path, "rb") as f:
+        saved = f.read()
+
+    for data in (pickle.dumps({"height": 2, "hash": chain[2].hash, "exploit": Exploit()}),
+                 saved[:len(saved) // 2],
+                 saved.replace(b'"heights":"', b'"heights":"A')):
+        atomic_write(path, data)
+        loaded = Search.SearchIndex(path, Transactions.amount)
+        loaded.rebuild(chain)
+        assert len(loaded) == 3 * 50
+        assert loaded.search(q="tx 3", limit=10 ** 6) == index.search(q="tx 3", limit=10 ** 6)
+        wait_for_save(loaded, 2)
+    assert not Exploit.ran
+
+
+def test_rebuild_does_not_wait_for_the_save(tmp_path, monkeypatch):
+    writing, release = threading.Event(), threading.Event()
+
+    def slow_write(path, data):
+        writing.set()
+        release.wait(5)
+        atomic_write(path, data)
+
+    monkeypatch.setattr(Search, "atomic_write", slow_write)
+    chain = [tx_block(height) for height in range(3)]
+    index = Search.SearchIndex(str(tmp_path / "search"), Transactions.amount)
+    index.rebuild(chain)
+    assert writing.wait(10)
+    assert index.saved_height == -1
+    release.set()
+    wait_for_save(index, 2)
@@ -0,0 +1,168 @@
+import json
+import pickle
+import threading
+
+import pytest
+
+from Blockchain import Blockchain
+import Miner
+import NFT
+import Snapshot
+import Transactions
+import Users
+
+
+def new_chain():
+    return Blockchain(Miner.SerialMiner(), "legacy")
+
+
+def attach(bc):
+    bc.register_index("addresses", Transactions.AddressIndex())
+    bc.register_index("registry", Users.UserRegistry())
+    bc.register_index("tokens", NFT.TokenIndex(bc))
+    bc.register_index("token_set", NFT.TokenSet())
+    return bc
+
+
+def entry(i):
+    # Read by all four indexes; address 0 also sends to itself
+    return {"from": "%02d" % (i % 3), "to": "%02d" % (i % 4), "value": i, "description": "tx",
+            "public_key": "user%d" % (i % 5), "name": "n%d" % i, "tokenId": "token%d" % (i % 6)}
+
+
+@pytest.fixture
+def bc():
+    bc = attach(new_chain())
+    for i in range(30):
+        bc.add_new_info(entry(i))
+        if i % 7 == 6:
+            assert bc.mine()
+    return bc
+
+
+def states(bc):
+    states = {name: json.loads(json.dumps(index.state(), sort_keys=True, default=lambda obj: obj.to_json()))
+              for name, index in bc.indexes.items()}
+    # A set, in any order
+    states["token_set"].sort()
+    return states
+
+
+def test_restored_indexes_match_the_rebuilt_ones(bc, tmp_path):
+    path = str(tmp_path / "tx.snap")
+    assert Snapshot.save(bc, path) == len(bc.chain) - 1
+
+    copy = new_chain()
+    for block in bc.chain[1:]:
+        assert copy.add_block(block, block.hash)
+    assert Snapshot.restore(copy, path) == len(bc.chain) - 1
+    attach(copy)
+    assert states(copy) == states(bc)
+
+    # Both go on with the same blocks, some histories read before
+    assert copy.indexes["addresses"].history("01", "received").keys
+    for i in range(30, 40):
+        bc.add_new_info(entry(i))
+    assert bc.mine()
+    assert copy.add_block(bc.last_block, bc.last_block.hash)
+
+    assert states(copy) == states(bc)
+    assert list(copy.unconfirmed_info) == list(bc.unconfirmed_info)
+    for address in ("00", "01", "02", "03"):
+        for role in Transactions.AddressIndex.ROLES:
+            ours = bc.indexes["addresses"].history(address, role)
+            theirs = copy.indexes["addresses"].history(address, role)
+            assert (ours.keys, ours.txs) == (theirs.keys, theirs.txs)
+            assert theirs.page((0, 0), 100) == ours.page((0, 0), 100)
+        assert copy.indexes["addresses"].balance(address) == bc.indexes["addresses"].balance(address)
+    assert copy.indexes["tokens"].get("token1") == bc.indexes["tokens"].get("token1")
+
+
+def test_snapshot_is_encoded_outside_the_chain_lock(bc, tmp_path, monkeypatch):
+    held = []
+    dumps = json.dumps
+
+    def probe():
+        acquired = bc.lock.acquire(timeout=0.5)
+        if acquired:
+            bc.lock.release()
+        held.append(not acquired)
+
+    def checking_dumps(*args, **kwargs):
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        return dumps(*args, **kwargs)
+
+    monkeypatch.setattr(Snapshot.json, "dumps", checking_dumps)
+    Snapshot.save(bc, str(tmp_path / "tx.snap"))
+    assert held == [False]
+
+
+class Exploit:
+    def __reduce__(self):
+        return (exec, ("import builtins; builtins.snapshot_exploited = True",))
+
+
+def test_pickled_snapshot_is_not_loaded(tmp_path):
+    import builtins
+    import zlib
+    path = str(tmp_path / "tx.snap")
+    payload = pickle.dumps({"height": 0, "exploit": Exploit()})
+    for magic in (b"BCSNAP1\n", Snapshot._MAGIC):
+        with open(path, "wb") as f:
+            f.write(Snapshot._HEADER.pack(magic, len(payload), zlib.crc32(payload)) + payload)
+        assert Snapshot.load(path) is None
+    assert not hasattr(builtins, "snapshot_exploited")
+
+
+def restart(bc, path, op):
+    # Unsaved index changes are lost with the process
+    if hasattr(bc.bc_idx, "close"):
+        bc.bc_idx.close()
+    copy = new_chain()
+    for block in bc.chain[1:]:
+        assert copy.add_block(block, block.hash)
+    Snapshot.restore(copy, path)
+    copy.op = op
+    return copy
+
+
+@pytest.mark.parametrize("mode", ["pickle", "wal", "sqlite"])
+def test_pending_index_changes_survive_a_restart(tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(Snapshot.config, "INDEX_MODE", mode)
+    op = str(tmp_path / Snapshot.config.TRANSACTION_INDEX)
+    path = str(tmp_path / "tx.snap")
+    bc = new_chain()
+    bc.op = op
+    Transactions.admit_transactions(bc, [entry(1)])
+    assert bc.mine()
+    # Saved with the block, then one more pending
+    Transactions.admit_transactions(bc, [entry(2)])
+    expected = {key: list(values) for key, values in bc.bc_idx.items()}
+    Snapshot.save(bc, path)
+
+    copy = restart(bc, path, op)
+    assert list(copy.unconfirmed_info) == [entry(2)]
+    assert {key: list(values) for key, values in copy.bc_idx.items()} == expected
+    assert copy.mine()
+    assert copy.check_index_validity()
+
+    # Saved with the new block
+    again = restart(copy, str(tmp_path / "none.snap"), op)
+    assert {key: list(values) for key, values in again.bc_idx.items()} == expected
+
+
+def test_index_saved_after_the_snapshot_is_not_changed_twice(tmp_path):
+    op = str(tmp_path / Snapshot.config.TRANSACTION_INDEX)
+    path = str(tmp_path / "tx.snap")
+    bc = new_chain()
+    bc.op = op
+    Transactions.admit_transactions(bc, [entry(1)])
+    Snapshot.save(bc, path)
+    assert bc.mine()
+    expected = {key: list(values) for key, values in bc.bc_idx.items()}
+
+    copy = restart(bc, path, op)
+    assert {key: list(values) for key, values in copy.bc_idx.items()} == expected
+    assert copy.check_index_validity()
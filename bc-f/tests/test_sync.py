@@ -0,0 +1,151 @@
+import json
+
+from flask import Flask, request
+import pytest
+
+import config
+import Peers
+import Runtime
+import Sync
+import Users
+
+
+def serve(node):
+    app = Flask(node.name)
+
+    @app.route("/tx/tip")
+    def tip():
+        return node.call("tip")
+
+    @app.route("/tx/locate", methods=["POST"])
+    def locate():
+        return node.call("locate", request)
+
+    @app.route("/tx/chain")
+    def chain():
+        return node.call("chain", request)
+
+    @app.route("/tx/new_transaction", methods=["POST"])
+    def new_transaction():
+        return node.call("new_transaction", request)
+
+    return app
+
+
+@pytest.fixture
+def start(network, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MINING_BLOCK_SIZE", 10 ** 6)
+    monkeypatch.setattr(config, "MINING_MAX_AGE", 10 ** 6)
+    monkeypatch.setattr(config, "SNAPSHOT_INTERVAL", 10 ** 6)
+    nodes = []
+
+    def start(name):
+        folder = tmp_path / name
+        monkeypatch.setattr(config, "UPLOAD_FOLDER", str(folder))
+        monkeypatch.setattr(config, "CHAIN_FOLDER", str(folder / "chains"))
+        monkeypatch.setattr(config, "SNAPSHOT_FOLDER", str(folder / "snapshots"))
+        folder.mkdir()
+        node = Runtime.TxNode()
+        nodes.append(node)
+        return node, network.add(name, serve(node))
+
+    yield start
+    for node in nodes:
+        node.close()
+
+
+def submit(url, i, tag):
+    private_key = "key%d" % (i % 3)
+    tx_data = {"from": Users.public_key_of(private_key), "to": "%02d" % (i % 4), "value": i + 1,
+               "private_key": private_key, "description": "tx {} {}".format(tag, i)}
+    assert Peers.post(url + "/tx/new_transaction", json=tx_data).status_code == 201
+
+
+def mine(node, url, numbers, tag):
+    for i in numbers:
+        submit(url, i, tag)
+        assert node.bc.mine()
+
+
+def sync(node, *peers):
+    node.add_peers(set(peers))
+    return json.loads(node.call("sync").get_data())["adopted"]
+
+
+def confirmed_state(node):
+    """
+    The indexes of the sealed blocks; pending parts may differ.
+    """
+    addresses = node.bc.indexes["addresses"]
+    search = node.bc.indexes["search"]
+    known = sorted(addresses.totals)
+    return {"hashes": [block.hash for block in node.bc.chain],
+            "histories": {address: {role: (history.keys, history.txs) for role, history in
+                                    (("sent", addresses.history(address, "sent")),
+                                     ("received", addresses.history(address, "received")),
+                                     ("all", addresses.history(address, "all")))}
+                          for address in known},
+            "balances": {address: addresses.balance(address)["balance"] for address in known},
+            "search": [search.transaction(doc) for doc in search.search(limit=10 ** 6)],
+            "words": {word: list(ids) for word, ids in search.postings.items()}}
+
+
+def test_two_nodes_fork_reorg_and_catch_up(start):
+    a, a_url = start("a")
+    b, b_url = start("b")
+
+    # Catch-up from genesis, then one block on top
+    mine(a, a_url, range(3), "a")
+    assert sync(b, a_url) == 3
+    mine(a, a_url, range(3, 4), "a")
+    assert sync(b, a_url) == 1
+    assert confirmed_state(b) == confirmed_state(a)
+
+    # Fork at height 4: b's side carries more work
+    mine(a, a_url, range(10, 11), "a")
+    mine(b, b_url, range(20, 22), "b")
+    assert sync(a, b_url) == 2
+    assert confirmed_state(a) == confirmed_state(b)
+    dropped = a.bc.unconfirmed_info.snapshot()
+    assert [tx["description"] for tx in dropped] == ["tx a 10"]
+    assert a.bc.indexes["addresses"].balance(dropped[0]["to"])["pending_received"] == 11
+    # Still in a's own index, as it is pending again
+    assert (11, "tx a 10") in a.bc.bc_idx[(dropped[0]["from"], dropped[0]["to"])]
+
+    # a mines it again and b catches up
+    assert a.bc.mine()
+    assert sync(b, a_url) == 1
+    assert confirmed_state(b) == confirmed_state(a)
+    assert not a.bc.unconfirmed_info and not b.bc.unconfirmed_info
+    for node in (a, b):
+        assert node.bc.indexes["addresses"].balance(dropped[0]["to"])["pending_received"] == 0
+
+
+def test_malformed_peer_replies_are_skipped(network, start, monkeypatch):
+    a, a_url = start("a")
+    b, b_url = start("b")
+    mine(a, a_url, range(3), "a")
+    failures = []
+
+    def liar(reply):
+        # Claims more work than anyone, then answers `reply` to /locate
+        app = Flask("liar")
+        app.add_url_rule("/tx/tip", "tip", lambda: {"height": 100, "hash": "00", "work": "f" * 80})
+        app.add_url_rule("/tx/locate", "locate", lambda: reply, methods=["POST"])
+        app.add_url_rule("/tx/chain", "chain", lambda: {"chain": [{"_Block__index": 1}], "next_cursor": None})
+        return app
+
+    liars = [network.add("liar%d" % i, liar(reply)) for i, reply in enumerate(
+        [{}, {"fork_height": "0"}, {"fork_height": 10 ** 6}, {"fork_height": 0}, "not json"])]
+    monkeypatch.setattr(Sync, "print", lambda *args: failures.append(args), raising=False)
+
+    assert sync(b, *liars, a_url) == 3
+    assert [block.hash for block in b.bc.chain] == [block.hash for block in a.bc.chain]
+    assert len(failures) == len(liars)
+
+
+def test_find_fork_skips_malformed_locator_entries(start):
+    a, _ = start("a")
+    genesis = a.bc.chain[0].hash
+    locator = [[0, genesis], "x", [1], ["1", genesis], [None, None], [5, "00"]]
+    assert Sync.find_fork(a.bc, locator) == 0
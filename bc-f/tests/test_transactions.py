@@ -0,0 +1,18 @@
+import pytest
+
+import Transactions
+
+
+@pytest.mark.parametrize("value, expected", [
+    (5, 5), (2.5, 2.5), ("7", 7.0), ("abc", 0), (None, 0), (True, 1.0),
+    (float("nan"), 0), (float("inf"), 0), (-float("inf"), 0), ("nan", 0), ("-inf", 0),
+    (10 ** 400, 0),
+])
+def test_amount(value, expected):
+    assert Transactions.amount({"value": value}) == expected
+
+
+@pytest.mark.parametrize("value", [float("nan"), float("inf"), "NaN", "-Infinity", 10 ** 400])
+def test_check_transaction_rejects_non_finite_values(value):
+    tx_data = {"from": "a", "to": "b", "value": value, "private_key": "k", "description": "d"}
+    assert Transactions.check_transaction(tx_data) == ("Invalid transaction value", 404)
@@ -0,0 +1,131 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from Blockchain import Blockchain
+import config
+import Miner
+import Users
+
+
+class JsonRequest:
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self):
+        return self.data
+
+
+@pytest.fixture
+def users():
+    users = Blockchain(Miner.SerialMiner(), "legacy")
+    Users.attach_indexes(users)
+    return users
+
+
+def register(users, name):
+    response, status = Users.new_users(users, JsonRequest({"access_key": "PASSWORD", "name": name,
+                                                           "description": "user " + name}))
+    assert status == 201
+    return response["public_key"], response["private_key"]
+
+
+def test_registry_sees_new_and_changed_users_at_once(users, monkeypatch):
+    monkeypatch.setattr(config, "REQUIRE_REGISTERED_USERS", True)
+    registry = users.indexes["registry"]
+    alice, _ = register(users, "alice")
+    bob = Users.public_key_of("bob")
+    assert Users.check_participants(registry, alice) is None
+    assert Users.check_participants(registry, alice, bob) == ("Unknown user {}".format(bob), 404)
+    assert registry.get(alice) == {"name": "alice", "description": "user alice", "height": None}
+    assert registry.get(alice, include_pending=False) is None
+
+    assert users.mine()
+    registered = users.last_block
+    assert registry.get(alice)["height"] == 1
+    assert Users.get_user(registry, alice) == (dict(registry.get(alice), public_key=alice, pending=False), 200)
+
+    # A new record for the same key replaces the old one, and a dropped
+    # block brings the old one back
+    users.add_new_info({"name": "alice2", "description": "renamed", "public_key": alice, "timestamp": 2.0})
+    assert registry.get(alice)["name"] == "alice2"
+    assert users.mine()
+    assert registry.get(alice) == {"name": "alice2", "description": "renamed", "height": 2}
+    rebuilt = Users.UserRegistry()
+    rebuilt.rebuild(users.chain)
+    assert rebuilt.state() == registry.state()
+    registry.remove_block(users.last_block)
+    assert registry.get(alice)["name"] == "alice"
+    registry.remove_block(registered)
+    assert alice not in registry
+    assert Users.check_participants(registry, alice) == ("Unknown user {}".format(alice), 404)
+
+
+def test_keypair_checks_are_cached():
+    Users.public_key_of.cache_clear()
+    private_key, public_key = Users.generate_keypairs(1)[0]
+    for _ in range(3):
+        assert Users.verify_keypair(public_key, private_key)
+    info = Users.public_key_of.cache_info()
+    assert (info.misses, info.hits) == (1, 2)
+    assert not Users.verify_keypair(public_key, Users.generate_keypairs(1)[0][0])
+    assert not Users.verify_keypair(public_key, None)
+    assert not Users.verify_keypair(public_key, 42)
+    assert Users.public_key_of.cache_info().maxsize == config.KEYPAIR_CACHE_SIZE
+
+
+def test_users_without_a_public_key_are_not_registered():
+    registry = Users.UserRegistry()
+    registry.apply_pending({"name": "old"})
+    registry.apply_block(SimpleNamespace(index=1, info=[{"name": "old"}]))
+    assert len(registry) == 0
+
+
+def test_bulk_registration_streams_one_keypair_per_user(users):
+    names = ["user%d" % i for i in range(50)]
+    request = JsonRequest({"access_key": "PASSWORD", "users": [{"name": name, "description": "bulk"}
+                                                                for name in names]})
+    lines, status = Users.new_users_bulk(users, request)
+    assert status == 201
+    created = [json.loads(line) for line in lines]
+    assert [user["name"] for user in created] == names
+    assert len({user["public_key"] for user in created}) == len(names)
+    assert all(Users.verify_keypair(user["public_key"], user["private_key"]) for user in created)
+
+    # All pending at once, with one timestamp and without private keys
+    pending = users.unconfirmed_info.snapshot()
+    assert [user["public_key"] for user in pending] == [user["public_key"] for user in created]
+    assert len({user["timestamp"] for user in pending}) == 1
+    assert not any("private_key" in user or "access_key" in user for user in pending)
+    registry = users.indexes["registry"]
+    assert all(user["public_key"] in registry for user in created)
+    assert users.mine()
+    assert len(users.last_block.info) == len(names)
+
+
+@pytest.mark.parametrize("data, expected", [
+    ({"access_key": "WRONG", "users": [{"name": "a", "description": "d"}]}, ("Forbidden", 403)),
+    ({"access_key": "PASSWORD", "users": []}, ("Invalid User Info", 404)),
+    ({"access_key": "PASSWORD", "users": {"name": "a"}}, ("Invalid User Info", 404)),
+    ([{"name": "a", "description": "d"}], ("Invalid User Info", 404)),
+    ({"access_key": "PASSWORD", "users": [{"name": "a", "description": "d"}, {"name": "b"}]},
+     ({"position": 1, "error": "Invalid User Info"}, 404)),
+    ({"access_key": "PASSWORD", "users": [{"name": "a", "description": "d"}, "b"]},
+     ({"position": 1, "error": "Invalid User Info"}, 404)),
+    ({"access_key": "PASSWORD", "users": [{"name": "u", "description": "d"}] * 4},
+     ("At most 3 users per batch", 413)),
+])
+def test_bulk_registration_refuses_the_whole_batch(users, monkeypatch, data, expected):
+    monkeypatch.setattr(config, "USER_BATCH_LIMIT", 3)
+    assert Users.new_users_bulk(users, JsonRequest(data)) == expected
+    assert len(users.unconfirmed_info) == 0
+
+
+def test_generated_keypairs_are_distinct_and_valid():
+    keypairs = Users.generate_keypairs(1000)
+    assert len({private_key for private_key, _ in keypairs}) == 1000
+    for private_key, public_key in keypairs:
+        assert len(private_key) == 64 and int(private_key, 16) >= 0
+        assert Users.public_key_of(private_key) == public_key
+    assert Users.generate_keypairs(0) == []
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from Blockchain import Blockchain, target_history
+import config
+import Miner
+import Validator
+
+
+@pytest.fixture
+def bc(monkeypatch):
+    # Short retarget windows, so a few blocks cross a retarget
+    monkeypatch.setattr(config, "RETARGET_INTERVAL", 4)
+    bc = Blockchain(Miner.SerialMiner(), "legacy")
+    for i in range(10):
+        bc.add_new_info({"n": i})
+        assert bc.mine()
+    return bc
+
+
+def test_retargets_happen(bc):
+    assert bc.chain[8].target != bc.chain[7].target
+
+
+def test_checkpoint_keeps_the_history_before_the_blocks(bc):
+    # Blocks 6.. with the checkpoint at 6: the retarget at 8 needs the
+    # timestamps of blocks 3 to 7, three of them from the caller's history
+    report = Validator.validate_chain(bc.chain[6:], start_height=6,
+                                      previous_hash=bc.chain[5].hash,
+                                      history=target_history(bc.chain, 6),
+                                      checkpoint=(6, bc.chain[6].hash), workers=1)
+    assert report, report.reason
+    assert report.hashes == [block.hash for block in bc.chain[6:]]
+
+
+def tampered_copy(chain, height):
+    blocks = [block.to_dict() for block in chain]
+    blocks[height]["_Block__info"] = [{"n": "forged"}]
+    return blocks
+
+
+def test_tampered_block_below_the_checkpoint_is_rejected(bc):
+    # Block 3 keeps its stored hash, which block 4 links to
+    blocks = tampered_copy(bc.chain, 3)[1:]
+    report = Validator.validate_chain(blocks, start_height=1, previous_hash=bc.chain[0].hash,
+                                      checkpoint=(5, bc.chain[5].hash), workers=1)
+    assert not report
+    assert (report.failed_height, report.reason) == (4, "previous_hash mismatch")
+
+
+def test_tampered_checkpoint_block_is_rejected(bc):
+    report = Validator.validate_chain(tampered_copy(bc.chain, 5), checkpoint=(5, bc.chain[5].hash),
+                                      workers=1)
+    assert (report.failed_height, report.reason) == (5, "checkpoint mismatch")
+
+
+def test_proof_of_work_below_the_checkpoint_is_not_checked(bc, monkeypatch):
+    checked = []
+    meets_target = Validator.Difficulty.meets_target
+    monkeypatch.setattr(Validator.Difficulty, "meets_target",
+                        lambda block_hash, target: checked.append(block_hash) or meets_target(block_hash, target))
+    report = Validator.validate_chain(bc.chain, checkpoint=(5, bc.chain[5].hash), workers=1)
+    assert report, report.reason
+    assert checked == [block.hash for block in bc.chain[6:]]
+
+
+def test_remember_hashes_stores_the_computed_hashes(bc, monkeypatch):
+    blocks = bc.chain[3:]
+    report = Validator.validate_chain(blocks, start_height=3, previous_hash=bc.chain[2].hash,
+                                      history=target_history(bc.chain, 3),
+                                      checkpoint=(5, bc.chain[5].hash), workers=1)
+    assert report
+    hashes = [block.hash for block in blocks]
+    for block in blocks:
+        block.remember_hash(None)
+    report.remember_hashes(blocks)
+    monkeypatch.setattr(type(blocks[0]), "compute_hash", lambda block: pytest.fail("rehashed"))
+    assert [block.hash for block in blocks] == hashes
+
+
+def test_timestamp_far_in_the_future_is_rejected(bc):
+    chain = [block.to_dict() for block in bc.chain]
+    chain[-1]["_Block__timestamp"] = time.time() + config.MAX_FUTURE_DRIFT + 60
+    report = Validator.validate_chain(chain, workers=1)
+    assert not report
+    assert (report.failed_height, report.reason) == (len(chain) - 1, "timestamp out of range")
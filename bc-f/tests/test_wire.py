@@ -0,0 +1,99 @@
+import json
+
+from flask import Flask, request
+import pytest
+
+from Block import BINARY_MIMETYPE, Block, block_from_dict, decode_chain
+import config
+import Wire
+
+
+def make_chain(length):
+    chain, previous_hash = [], "0"
+    for height in range(length):
+        block = Block(height, [{"from": "a", "to": "b", "value": height}], float(height), previous_hash)
+        chain.append(block)
+        previous_hash = block.hash
+    return chain
+
+
+@pytest.fixture
+def chain():
+    return make_chain(7)
+
+
+@pytest.fixture
+def client(chain, monkeypatch):
+    monkeypatch.setattr(config, "CHAIN_PAGE_LIMIT", 3)
+    app = Flask("wire")
+    app.add_url_rule("/tx/chain", "chain", lambda: Wire.chain_response(chain, request))
+    return app.test_client()
+
+
+def page(client, **args):
+    data = client.get("/tx/chain", query_string=args).get_json(force=True)
+    return [block["_Block__index"] for block in data["chain"]], data.get("next_cursor", "absent")
+
+
+def test_pages_end_with_a_null_cursor(client):
+    assert page(client, limit=3) == ([0, 1, 2], 3)
+    assert page(client, cursor=3) == ([3, 4, 5], 6)
+    assert page(client, cursor=6) == ([6], None)
+    # A page which ends exactly at the tip has no next one either
+    assert page(client, cursor=4, limit=3) == ([4, 5, 6], None)
+    assert page(client, from_height=1, to_height=3, limit=3) == ([1, 2, 3], None)
+    assert page(client, from_height=1, to_height=4, limit=3) == ([1, 2, 3], 4)
+    # Past the tip: an empty last page
+    assert page(client, cursor=7) == ([], None)
+    assert page(client, cursor=100) == ([], None)
+
+
+def test_limits_are_clamped(client):
+    assert page(client, limit=0) == ([0], 1)
+    assert page(client, limit=-5) == ([0], 1)
+    assert page(client, limit=10 ** 6) == ([0, 1, 2], 3)
+    assert page(client, from_height=-3, limit=2) == ([0, 1], 2)
+    assert page(client, from_height=5, to_height=10 ** 6) == ([5, 6], None)
+    assert page(client, from_height=4, to_height=2) == ([], None)
+
+
+def test_without_range_arguments_the_whole_chain_is_sent(client):
+    assert page(client) == (list(range(7)), "absent")
+
+
+@pytest.mark.parametrize("how", [{"headers": {"Accept": Wire.NDJSON_MIMETYPE}},
+                                 {"query_string": {"stream": "1"}}])
+def test_ndjson_round_trip(client, chain, how):
+    query = dict(how.get("query_string", {}), cursor=2)
+    response = client.get("/tx/chain", headers=how.get("headers"), query_string=query)
+    assert response.mimetype == Wire.NDJSON_MIMETYPE
+    assert response.headers["X-Next-Cursor"] == "5"
+    assert response.headers["X-Chain-Length"] == "6"
+    lines = response.get_data().decode().splitlines()
+    blocks = [block_from_dict(json.loads(line)) for line in lines]
+    assert [block.hash for block in blocks] == [block.hash for block in chain[2:5]]
+
+
+def test_binary_round_trip(client, chain):
+    response = client.get("/tx/chain", headers={"Accept": BINARY_MIMETYPE}, query_string={"cursor": 5})
+    assert response.mimetype == BINARY_MIMETYPE
+    assert "X-Next-Cursor" not in response.headers
+    blocks = list(decode_chain(response.get_data()))
+    assert [block.hash for block in blocks] == [block.hash for block in chain[5:]]
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_fetch_blocks_follows_the_cursors(network, chain, monkeypatch, binary):
+    monkeypatch.setattr(config, "CHAIN_PAGE_LIMIT", 2)
+    app = Flask("peer")
+
+    def serve():
+        if not binary:
+            # An older node, which only speaks JSON
+            request.environ["HTTP_ACCEPT"] = "application/json"
+        return Wire.chain_response(chain, request)
+
+    app.add_url_rule("/tx/chain", "chain", serve)
+    url = network.add("peer", app) + "/tx/chain"
+    assert [block.hash for block in Wire.fetch_blocks(url, 1)] == [block.hash for block in chain[1:]]
+    assert list(Wire.fetch_blocks(url, 7)) == []